@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Batched alignment of node dependencies
+
+Replaces the per-flight pre_aligned dict of get_deps_series.  For each
+(source frequency, offset, length) -> (target frequency, offset) an
+interpolation plan (lower/upper sample index, weight, in-range mask) is worked
+out once per process and kept.  All the dependencies of a node that share a
+source rate are stacked and interpolated in one vectorized pass with that plan.
+
+Only plain DerivedParameterNodes (continuous values, linear interpolation) are
+batched.  Multistate parameters, KPV/KTI/section nodes and anything else go
+through their own get_aligned.  A plan is checked against get_aligned until it
+has matched on CHECK_USES dependencies whose unmasked data varies (a constant or
+fully masked dependency would match whatever the plan did); if the results
+differ the plan falls back to get_aligned for the rest of the process and a
+warning is logged.
+
+Aligned results are memoized per flight by (name, frequency, offset) as before,
+until release(name) drops them, and the engine keeps alignment time, bytes
+produced and batched/fallback counts.
+"""
+import copy
+import time
+import logging
+import threading
+
+import numpy as np
+
+from analysis_engine.node import DerivedParameterNode
+
+logger = logging.getLogger(__name__)
+
+MAX_PLANS = 256
+CHECK_USES = 3  # matches on varying, unmasked dependencies before a plan is trusted
+
+_plans = {}        # (src freq, src offset, length, tgt freq, tgt offset) -> (i0, i1, w, outside)
+_rejected = set()  # plan keys whose batched result did not match get_aligned
+_verified = set()  # plan keys checked against get_aligned
+_checks = {}       # plan key -> matches so far, until verified
+_check_lock = threading.Lock()  # guards _verified, _rejected and _checks while a plan is checked
+
+
+def interpolation_plan(src_frequency, src_offset, length, tgt_frequency, tgt_offset):
+    '''(i0, i1, weight, outside) to linearly interpolate a length-sample series sampled at
+       src_frequency/src_offset onto tgt_frequency/tgt_offset over the same duration'''
+    key = (src_frequency, src_offset, length, tgt_frequency, tgt_offset)
+    plan = _plans.get(key)
+    if plan is None:
+        out_length = int(round(length * float(tgt_frequency) / src_frequency))
+        # position of each target sample in source samples
+        position = (np.arange(out_length) / float(tgt_frequency) + tgt_offset - src_offset) * src_frequency
+        i0 = np.floor(position).astype(np.intp)
+        weight = position - i0
+        exact = np.abs(weight) < 1e-9
+        weight[exact] = 0.0
+        i1 = np.where(exact, i0, i0 + 1)
+        outside = (i0 < 0) | (i1 >= length)
+        np.clip(i0, 0, length-1, out=i0)
+        np.clip(i1, 0, length-1, out=i1)
+        if len(_plans) >= MAX_PLANS:
+            _plans.clear()
+        plan = _plans[key] = (i0, i1, weight, outside)
+    return plan
+
+
+def interpolate_stack(arrays, plan):
+    '''apply a plan to a list of masked arrays of the same length in one pass'''
+    i0, i1, weight, outside = plan
+    data = np.vstack([np.ma.getdata(a).astype(np.float64) for a in arrays])
+    mask = np.vstack([np.ma.getmaskarray(a) for a in arrays])
+    values = data[:, i0] * (1.0 - weight) + data[:, i1] * weight
+    masked = mask[:, i0] | (mask[:, i1] & (weight > 0)) | outside
+    return [np.ma.array(values[k], mask=masked[k]) for k in range(len(arrays))]
+
+
+def _batchable(dep):
+    return type(dep) is DerivedParameterNode and dep.frequency and np.ma.getdata(dep.array).dtype.kind in 'fiu'
+
+
+def _same(batched, reference):
+    reference = np.ma.asarray(reference)
+    if batched.shape != reference.shape:
+        return False
+    if not np.array_equal(np.ma.getmaskarray(batched), np.ma.getmaskarray(reference)):
+        return False
+    valid = ~np.ma.getmaskarray(batched)
+    return np.allclose(np.ma.getdata(batched)[valid], np.ma.getdata(reference)[valid], rtol=1e-9, atol=1e-9)
+
+
+def _varies(array):
+    '''True if array has at least two different unmasked values'''
+    valid = np.ma.compressed(np.ma.asarray(array))
+    return valid.size > 1 and not (valid == valid[0]).all()
+
+
+def _check_plan(key, batched, deps, target):
+    '''True if the plan of key may be used.  Until the plan is verified, the batched results
+       of deps are compared with dep.get_aligned(target): those of dependencies whose data varies
+       count towards CHECK_USES; if none varies, the first is still compared but does not count.
+       Any difference rejects the plan.'''
+    with _check_lock:
+        if key in _verified:
+            return True
+        if key in _rejected:
+            return False
+        done = _checks.get(key, 0)
+        checks = [(array, dep) for array, dep in zip(batched, deps) if _varies(dep.array)][:CHECK_USES-done]
+        for array, dep in checks or [(batched[0], deps[0])]:
+            if not _same(array, dep.get_aligned(target).array):
+                logger.warning('align_engine: batched alignment %s differs from get_aligned for %s; '
+                               'using get_aligned', key, dep.name)
+                _rejected.add(key)
+                _checks.pop(key, None)
+                return False
+        _checks[key] = done + len(checks)
+        if _checks[key] >= CHECK_USES:
+            _verified.add(key)
+            del _checks[key]
+        return True
+
+
+class AlignmentEngine(object):
+    '''one per flight; see module docstring.  align() may be called from several threads
+       (see dag_scheduler); two threads may then align the same dependency, the first result is kept.'''
+    def __init__(self):
+        self.aligned = {}  # (name, frequency, offset) -> aligned node
+        self._lock = threading.Lock()
+        self.stats = {'seconds': 0.0, 'bytes': 0, 'batched': 0, 'fallback': 0, 'reused': 0, 'released': 0}
+
+    def align(self, deps, target):
+        '''deps (some possibly None) aligned to target's frequency and offset, in order'''
+        start = time.time()
+        results = [None] * len(deps)
+        groups = {}  # plan key -> positions in deps
+        for pos, dep in enumerate(deps):
+            if dep is None:
+                continue
+            memo = (dep.name, target.frequency, target.offset)
+            with self._lock:
+                reused = self.aligned.get(memo)
+                if reused is not None:
+                    self.stats['reused'] += 1
+            if reused is not None:
+                results[pos] = reused
+                continue
+            key = None
+            if _batchable(dep):
+                key = (dep.frequency, dep.offset, len(dep.array), target.frequency, target.offset)
+            if key is None or key in _rejected:
+                results[pos] = self._store(memo, dep.get_aligned(target), 'fallback')
+            else:
+                groups.setdefault(key, []).append(pos)
+
+        for key, positions in groups.items():
+            arrays = interpolate_stack([deps[pos].array for pos in positions], interpolation_plan(*key))
+            if not _check_plan(key, arrays, [deps[pos] for pos in positions], target):
+                for pos in positions:
+                    dep = deps[pos]
+                    results[pos] = self._store((dep.name, target.frequency, target.offset),
+                                               dep.get_aligned(target), 'fallback')
+                continue
+            for pos, array in zip(positions, arrays):
+                dep = deps[pos]
+                aligned = copy.copy(dep)
+                aligned.array = array
+                aligned.frequency = target.frequency
+                aligned.offset = target.offset
+                results[pos] = self._store((dep.name, target.frequency, target.offset), aligned, 'batched')
+        with self._lock:
+            self.stats['seconds'] += time.time() - start
+        return results
+
+    def release(self, name):
+        '''forget the aligned copies of name, e.g. after its last consumer; returns bytes released'''
+        released = 0
+        with self._lock:
+            for memo in [k for k in self.aligned if k[0]==name]:
+                array = getattr(self.aligned.pop(memo), 'array', None)
+                if isinstance(array, np.ndarray):
+                    released += np.ma.getdata(array).nbytes + np.ma.getmaskarray(array).nbytes
+            self.stats['released'] += released
+        return released
+
+    def _store(self, memo, aligned, how):
+        with self._lock:
+            if memo in self.aligned:  # aligned meanwhile in another thread
+                return self.aligned[memo]
+            self.aligned[memo] = aligned
+            self.stats[how] += 1
+            array = getattr(aligned, 'array', None)
+            if isinstance(array, np.ndarray):
+                self.stats['bytes'] += np.ma.getdata(array).nbytes + np.ma.getmaskarray(array).nbytes
+        return aligned
+
+    def report(self):
+        return 'alignment %.3f s, %.1f MB (%.1f MB released early), batched %d, get_aligned %d, re-used %d' % (
+            self.stats['seconds'], self.stats['bytes']/1048576., self.stats['released']/1048576.,
+            self.stats['batched'], self.stats['fallback'], self.stats['reused'])
@@ -16,6 +16,42 @@ PROFILE_REPORTS_PATH = 'c:/asias_fds/profile_reports/'
 # API Handler  -- use of the Web API requires coordination with Flight Data Services
 #API_HANDLER = 'analysis_engine.api_handler_analysis_engine.AnalysisEngineAPIHandlerHTTP'
 API_HANDLER = 'analysis_engine.api_handler_analysis_engine.AnalysisEngineAPIHandlerLocal'
+# nearest airport/runway from the local airport/runway snapshot (APT_RWY_CACHE_PATH, see spatial_index.py)
+#API_HANDLER = 'spatial_index.SpatialAPIHandler'
 
 # Set the base URL for the API handler:
-BASE_URL = '' #if API_HANDLER is local
\ No newline at end of file
+BASE_URL = '' #if API_HANDLER is local
+
+# Caches used by staged_helper.run_analyzer
+# dependency plans (process order) per LFL and recorded-parameter set, e.g. 'c:/asias_fds/cache/plans/';
+# None keeps them in memory only
+PLAN_CACHE_PATH = None
+# precomputed base nodes, keyed by base file content, analyzer version and node code,
+# e.g. 'c:/asias_fds/cache/params/'; None disables.  PARAM_STORE_MAX_MB caps its size
+PARAM_STORE_PATH = None
+PARAM_STORE_MAX_MB = 20000
+# per-flight node results for incremental re-analysis; None derives every node on every run
+INCREMENTAL_PATH = None
+
+# Database used by run_analyzer (see fds_db.py): 'oracle', or 'sqlite' for offline runs
+DB_BACKEND = 'oracle'
+SQLITE_DB_PATH = 'c:/asias_fds/cache/asias_fds.sqlite'
+# folder for columnar KPV/KTI/phase files (see columnar_sink.py); None writes none
+COLUMNAR_SINK_PATH = None
+# airport/runway reference data: Jeppesen cycle, and the folder of its snapshot (see load_apt_rwy.py)
+APT_RWY_CYCLE = 1204
+APT_RWY_CACHE_PATH = 'c:/asias_fds/cache/apt_rwy/'
+# time every node of every flight in run_analyzer and save to fds_node_timing (see node_profiler.py)
+PROFILE_NODES = False
+# threads deriving independent nodes of one flight in run_analyzer (see dag_scheduler.py)
+DERIVE_THREADS = 1
+# folder of run journals for runs without a database (see run_journal.py); None keeps none
+RUN_JOURNAL_PATH = None
+# sqlite catalog of flight file metadata used for planning runs (see flight_catalog.py),
+# e.g. 'c:/asias_fds/cache/flight_catalog.sqlite'; None disables
+FLIGHT_CATALOG_PATH = None
+# storage of series in base hdf5 output (see hdf5_storage.py): None keeps hdfaccess's defaults,
+# else 'lzf', 'deflate1', 'deflate' or 'none'; rules are [(parameter name pattern, filter)]
+HDF5_STORAGE_FILTER = None
+HDF5_STORAGE_RULES = []
+HDF5_COMPACT_MASKS = True
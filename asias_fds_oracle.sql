@@ -118,4 +118,38 @@ alter table fds_flight_record add (
 alter table fds_kpv add (file_repository varchar2(128));
 alter table fds_kpv add (profile_set varchar2(96));
 
-update fds_phase set profile_set='base' where profile='base'
+update fds_phase set profile_set='base' where profile='base';
+
+-- columns written by fds_oracle.py since the tables were created
+alter table fds_kti add (file_repository varchar2(128), run_time timestamp);
+alter table fds_phase add (file_repository varchar2(128), run_time timestamp);
+alter table fds_kpv add (run_time timestamp);
+alter table fds_jobs add (file_repository varchar2(128), username varchar2(32));
+alter table fds_processing_time add (file_repository varchar2(128), username varchar2(32));
+alter table fds_flight_record add (file_repository varchar2(128), start_month timestamp, download_datestr varchar2(32));
+
+-- per-node timing, written by node_profiler.py when run_analyzer profiles nodes
+create table fds_node_timing (
+	run_time		timestamp,
+	stage			varchar2(64),
+	profile		varchar2(128),
+	node_name		varchar2(128),
+	node_type		varchar2(64),
+	calls			number,
+	deps_seconds	number,
+	derive_seconds	number,
+	post_seconds	number,
+	total_seconds	number,
+	output_mb		number
+);
+
+-- flights finished by a run, written by run_journal.py; run_analyzer(resume_from=run_time) skips the 'ok' ones
+create table fds_run_journal (
+	run_time		timestamp,
+	stage			varchar2(64),
+	profile		varchar2(128),
+	source_file		varchar2(128),
+	status			varchar2(32),
+	file_repository	varchar2(128)
+);
+create index fds_run_journal_ix on fds_run_journal (run_time, profile, source_file);
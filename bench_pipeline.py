@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the analyzer pipeline on synthetic flights
+
+synthetic_flight() writes an hdf5 flight file through hdfaccess: a core set
+of recorded parameters with a plausible climb/cruise/descent profile, so the
+base nodes find phases, KPVs and KTIs, plus filler parameters up to the
+requested count.  Duration, parameter count, sample rates and the fraction of
+masked samples are all configurable.
+
+run_benchmark() times each stage of one flight separately:
+    load       Flight.load_from_hdf5
+    prep       prep_nodes + prep_order
+    derive     derive_parameters_series
+    save       Flight.save_to_hdf5
+    results    dump_results
+    export     fds_oracle.analyzer_to_oracle into a local fds_db sqlite database
+and appends the timings as one json line to a history file.  compare() flags
+stages slower than the median of earlier runs of the same configuration, so a
+regression shows up before a production run:
+
+    python bench_pipeline.py [duration_s] [n_params] [repeat]
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import traceback
+from datetime import datetime
+
+import numpy as np
+import simplejson as json
+
+from hdfaccess.file import hdf_file
+import hdfaccess.file
+
+import fds_db
+import fds_oracle
+import staged_helper
+
+logger = logging.getLogger(__name__)
+
+HISTORY_PATH = 'bench_history.jsonl'
+STAGES = ('load', 'prep', 'derive', 'save', 'results', 'export')
+RATES = (0.25, 1.0, 2.0, 4.0, 8.0, 16.0)
+REGRESSION_THRESHOLD = 1.2   # slower than 1.2 x the median of earlier runs
+AIRCRAFT_INFO = {'Tail Number': 'BENCH01', 'Frame': 'bench', 'Manufacturer': 'Boeing',
+                 'Model': 'B737-800', 'Series': 'B737-800', 'Family': 'B737 NG',
+                 'Engine Count': 2, 'Precise Positioning': True}
+
+# core recorded parameters: name, frequency, units, shape (see _core_array)
+CORE_PARAMETERS = [('Altitude STD', 4.0, 'ft', 'altitude'),
+                   ('Altitude Radio', 4.0, 'ft', 'radio'),
+                   ('Airspeed', 2.0, 'kt', 'airspeed'),
+                   ('Heading', 4.0, 'deg', 'heading'),
+                   ('Pitch', 8.0, 'deg', 'pitch'),
+                   ('Roll', 8.0, 'deg', 'noise'),
+                   ('Acceleration Normal', 16.0, 'g', 'one'),
+                   ('Latitude', 1.0, 'deg', 'latitude'),
+                   ('Longitude', 1.0, 'deg', 'longitude'),
+                   ('Eng (1) N1', 4.0, '%', 'n1'),
+                   ('Eng (2) N1', 4.0, '%', 'n1'),
+                   ('Gear Down', 1.0, None, 'gear')]
+
+
+def flight_profile(t, duration):
+    '''fraction of cruise altitude at times t: taxi, climb, cruise, descent, taxi'''
+    x = t / float(duration)
+    return np.interp(x, [0.0, 0.05, 0.25, 0.70, 0.95, 1.0], [0.0, 0.0, 1.0, 1.0, 0.0, 0.0])
+
+
+def _core_array(shape, t, duration, rng):
+    level = flight_profile(t, duration)
+    airborne = level > 0
+    if shape=='altitude':
+        return 35000.0*level + rng.normal(0, 5, len(t))
+    if shape=='radio':
+        return np.where(level < 0.1, 25000.0*level, 2500.0) + rng.normal(0, 1, len(t))
+    if shape=='airspeed':
+        return np.where(airborne, 150.0 + 150.0*level, 15.0) + rng.normal(0, 1, len(t))
+    if shape=='heading':
+        return (90.0 + np.cumsum(rng.normal(0, 0.05, len(t)))) % 360.0
+    if shape=='pitch':
+        return np.gradient(level) * len(t) * 0.5 + rng.normal(0, 0.2, len(t))
+    if shape=='one':
+        return 1.0 + rng.normal(0, 0.02, len(t))
+    if shape=='latitude':
+        return 40.69 + 1.5*t/float(duration)
+    if shape=='longitude':
+        return -74.17 - 3.0*t/float(duration)
+    if shape=='n1':
+        return np.where(airborne, 60.0 + 30.0*level, 22.0) + rng.normal(0, 0.5, len(t))
+    if shape=='gear':
+        return (level < 0.05).astype(np.int32)
+    return rng.normal(0, 1, len(t))
+
+
+def _masked(values, mask_fraction, rng):
+    '''values with about mask_fraction of samples masked, in short runs as in real data'''
+    mask = np.zeros(len(values), dtype=np.bool_)
+    if mask_fraction > 0 and len(values):
+        run = 8
+        starts = rng.randint(0, len(values), max(1, int(len(values)*mask_fraction/run)))
+        for s in starts:
+            mask[s:s+run] = True
+    return np.ma.array(values, mask=mask)
+
+
+def synthetic_flight(hdf5_path, duration=3600, n_params=200, rates=RATES, mask_fraction=0.01, seed=0,
+                     start_datetime=datetime(2012, 4, 1, 12, 0, 0)):
+    '''write a synthetic flight of duration seconds with n_params recorded parameters
+       (at least the core ones), filler parameters cycling through rates'''
+    from hdfaccess.parameter import Parameter
+    rng = np.random.RandomState(seed)
+    with hdf_file(hdf5_path, cache_param_list=[], create=True) as hfile:
+        hfile.hdf.attrs['duration'] = duration
+        hfile.hdf.attrs['start_timestamp'] = time.mktime(start_datetime.timetuple())
+        hfile.hdf.attrs['superframe_present'] = 0
+        hfile.hdf.attrs['hdfaccess_version'] = hdfaccess.file.HDFACCESS_VERSION
+        hfile.hdf.attrs['reliable_frame_counter'] = 1
+        hfile.hdf.attrs['aircraft_info'] = json.dumps(AIRCRAFT_INFO)
+        specs = list(CORE_PARAMETERS)
+        for i in xrange(max(0, n_params - len(specs))):
+            specs.append(('Synthetic Param %03d' % i, rates[i % len(rates)], 'unit', 'noise'))
+        for name, frequency, units, shape in specs:
+            offset = round(rng.uniform(0, 1.0/frequency), 4)
+            t = np.arange(int(duration*frequency)) / frequency + offset
+            values = _core_array(shape, t, duration, rng)
+            values_mapping = None
+            if shape=='gear':
+                values_mapping = {0: 'Up', 1: 'Down'}
+            hfile.set_param(Parameter(name, array=_masked(values, mask_fraction, rng),
+                                      values_mapping=values_mapping, frequency=frequency, offset=offset,
+                                      units=units, lfl=True))
+    return hdf5_path
+
+
+class StageTimer(object):
+    '''seconds per stage; a failing stage is recorded with its error and stops the run'''
+    def __init__(self):
+        self.seconds = {}
+        self.error = None
+
+    def run(self, stage, function, *args, **kwargs):
+        if self.error:
+            return None
+        start = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.error = stage + ': ' + traceback.format_exc()
+            logger.warning('bench: stage %s failed\n%s', stage, self.error)
+            return None
+        self.seconds[stage] = time.time() - start
+        return result
+
+
+def run_benchmark(duration=3600, n_params=200, rates=RATES, mask_fraction=0.01, module_names=[],
+                  work_dir=None, history_path=HISTORY_PATH, seed=0):
+    '''time each stage of the base analysis of one synthetic flight; returns the history record'''
+    keep = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='fds_bench')
+    source = os.path.join(work_dir, 'bench_%d_%d.hdf5' % (duration, n_params))
+    output = source.replace('.hdf5', '_base.hdf5')
+    start = time.time()
+    synthetic_flight(source, duration, n_params, rates, mask_fraction, seed)
+    generate_seconds = time.time() - start
+
+    timer = StageTimer()
+    flight = staged_helper.Flight()
+    flight.file_repository = 'bench'
+    timer.run('load', flight.load_from_hdf5, {'filepath': source, 'aircraft_info': dict(AIRCRAFT_INFO)})
+
+    def prep():
+        requested_params, available_nodes = staged_helper.prep_nodes('base', module_names)
+        node_mgr, process_order = staged_helper.prep_order(flight, {}, flight.start_datetime,
+                                                           available_nodes, requested_params)
+        return node_mgr, process_order
+    planned = timer.run('prep', prep)
+
+    def derive():
+        node_mgr, process_order = planned
+        precomputed = staged_helper.get_precomputed_parameters(flight)
+        return staged_helper.derive_parameters_series(flight, node_mgr, process_order, precomputed)
+    derived = timer.run('derive', derive)
+    if derived:
+        res, params = derived
+        for k in res['series'].keys():
+            flight.parameters[k] = res['series'][k]
+    timer.run('save', flight.save_to_hdf5, output)
+    timer.run('results', lambda: staged_helper.dump_results(output, params, res, logger))
+
+    def export():
+        backend = fds_db.SQLiteBackend(os.path.join(work_dir, 'bench.sqlite'))
+        cn = backend.connect()
+        fds_oracle.analyzer_to_oracle(cn, 'base', res, params, flight, work_dir, output, datetime.now())
+        cn.close()
+    timer.run('export', export)
+
+    record = {'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {'duration': duration, 'n_params': n_params, 'rates': list(rates),
+                         'mask_fraction': mask_fraction, 'module_names': list(module_names)},
+              'generate_seconds': generate_seconds,
+              'input_mb': os.path.getsize(source)/1048576.,
+              'stages': timer.seconds,
+              'error': timer.error}
+    if derived:
+        record['counts'] = {'series': len(res['series']), 'kpv': len(res['kpv']),
+                            'kti': len(res['kti']), 'phase': len(res['phase'])}
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if history_path:
+        with open(history_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    return record
+
+
+def read_history(history_path=HISTORY_PATH):
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record, history, threshold=REGRESSION_THRESHOLD, last=10):
+    '''{stage: (seconds, median seconds)} for stages of record slower than threshold x the median
+       of the last earlier runs with the same configuration'''
+    earlier = [h for h in history if h['config']==record['config']
+               and h['time'] < record['time'] and not h.get('error')][-last:]
+    slower = {}
+    for stage, seconds in record['stages'].items():
+        previous = [h['stages'][stage] for h in earlier if stage in h['stages']]
+        if previous:
+            median = float(np.median(previous))
+            if seconds > threshold*median:
+                slower[stage] = (seconds, median)
+    return slower
+
+
+def report(record, slower):
+    lines = ['%s  %ds flight, %d params, %.1f MB' % (record['time'], record['config']['duration'],
+                                                     record['config']['n_params'], record['input_mb'])]
+    for stage in STAGES:
+        if stage in record['stages']:
+            flag = ''
+            if stage in slower:
+                flag = '  REGRESSION (median %.3f s)' % slower[stage][1]
+            lines.append('  %-8s %9.3f s%s' % (stage, record['stages'][stage], flag))
+    if record.get('counts'):
+        lines.append('  ' + ', '.join('%s %d' % kv for kv in sorted(record['counts'].items())))
+    if record['error']:
+        lines.append('  FAILED ' + record['error'].splitlines()[0])
+    return '\n'.join(lines)
+
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.WARNING)
+    duration = int(sys.argv[1]) if len(sys.argv) > 1 else 3600
+    n_params = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    for i in xrange(repeat):
+        record = run_benchmark(duration, n_params)
+        print report(record, compare(record, read_history()))
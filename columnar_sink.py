@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar file sink for KPV, KTI and phase results
+
+An alternative to fds_oracle.analyzer_to_oracle for local analysis.  A
+ColumnarSink buffers the rows of many flights and writes them as column files,
+partitioned by profile and run:
+
+    <sink_dir>/profile=<profile>/run_time=<YYYYmmddTHHMMSS.ffffff>/<table>-<pid>-<n>.npz
+
+Each part file is an uncompressed .npz with one array per column.  Numbers are
+float64; string columns (name, source_file, base_file_path, units,
+file_repository) are dictionary-encoded as int32 codes plus a '<column>.dict'
+array of the distinct values, so nothing needs unpickling and filters on names
+only compare the dictionaries.
+
+read_table() reads a table across partitions, pruning by profile and run time
+and filtering by name; bulk_load() inserts one back into fds_kpv/kti/phase
+through any fds_db connection.
+"""
+import os
+import re
+import logging
+from datetime import datetime
+
+import numpy as np
+
+import fds_oracle
+
+logger = logging.getLogger(__name__)
+
+ROWS_PER_FILE = 500000
+RUN_TIME_FORMAT = '%Y%m%dT%H%M%S.%f'  # in full, so loaded rows join to fds_jobs and fds_processing_time
+OLD_RUN_TIME_FORMAT = '%Y%m%dT%H%M%S'  # partitions written before microseconds were kept
+
+# columns per table, in fds_oracle insert order (profile and run_time are partition keys)
+TABLES = {
+    'kpv':   ['source_file', 'name', 'time_index', 'value', 'base_file_path', 'units', 'file_repository'],
+    'kti':   ['source_file', 'name', 'time_index', 'base_file_path', 'file_repository'],
+    'phase': ['source_file', 'name', 'time_index', 'stop_edge', 'duration', 'base_file_path', 'file_repository'],
+}
+STRING_COLUMNS = frozenset(['source_file', 'name', 'base_file_path', 'units', 'file_repository'])
+INSERT_SQL = {'kpv': fds_oracle.KPV_INSERT_SQL, 'kti': fds_oracle.KTI_INSERT_SQL, 'phase': fds_oracle.PHASE_INSERT_SQL}
+
+
+def partition_path(sink_dir, profile, run_time):
+    return os.path.join(sink_dir, 'profile=' + profile, 'run_time=' + run_time.strftime(RUN_TIME_FORMAT))
+
+
+def parse_run_time(text):
+    '''run time of a partition name, in RUN_TIME_FORMAT or OLD_RUN_TIME_FORMAT'''
+    try:
+        return datetime.strptime(text, RUN_TIME_FORMAT)
+    except ValueError:
+        return datetime.strptime(text, OLD_RUN_TIME_FORMAT)
+
+
+def _encode(values):
+    '''(int32 codes, sorted dictionary as a bytes array) for a list of strings; None becomes '' '''
+    values = [('' if v is None else v) for v in values]
+    values = [v.encode('utf-8') if isinstance(v, unicode) else str(v) for v in values]
+    dictionary, codes = np.unique(np.array(values, dtype=np.string_), return_inverse=True)
+    return codes.astype(np.int32), dictionary
+
+
+class ColumnarSink(object):
+    '''see module docstring.  One per process and run; close() writes whatever is buffered.'''
+    def __init__(self, sink_dir, profile, run_time, rows_per_file=ROWS_PER_FILE):
+        self.path = partition_path(sink_dir, profile, run_time)
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:  # another worker made it
+                pass
+        self.profile = profile
+        self.rows_per_file = rows_per_file
+        self.parts = 0
+        self._rows = dict((table, dict((col, []) for col in columns)) for table, columns in TABLES.items())
+
+    def add_results(self, flight, res, params, output_path_and_file):
+        '''buffer the KPV, KTI and phase rows of one flight, as analyzer_to_oracle would save them'''
+        flight_file = os.path.basename(flight.filepath)
+        if self.profile=='base':
+            base_file = os.path.basename(output_path_and_file)
+        else:
+            base_file = flight_file
+        common = {'source_file': flight_file, 'base_file_path': base_file, 'file_repository': flight.file_repository}
+
+        for value in res['kpv']:
+            try:
+                units = params.get(value.name).units
+            except:
+                units = None
+            self._add('kpv', common, name=value.name, time_index=float(value.index), value=float(value.value), units=units)
+        for value in res['kti']:
+            if value.index and value.index>=0:  # as kti_to_oracle
+                self._add('kti', common, name=value.name, time_index=float(value.index))
+        for value in res['phase']:
+            self._add('phase', common, name=value.name, time_index=float(value.start_edge),
+                      stop_edge=float(value.stop_edge), duration=value.stop_edge-value.start_edge)
+        for table in TABLES:
+            if len(self._rows[table]['name']) >= self.rows_per_file:
+                self.write(table)
+
+    def _add(self, table, common, **values):
+        columns = self._rows[table]
+        for col in columns:
+            columns[col].append(values[col] if col in values else common[col])
+
+    def write(self, table):
+        '''write the rows buffered for table as one part file'''
+        columns = self._rows[table]
+        if not columns['name']:
+            return None
+        arrays = {}
+        for col, values in columns.items():
+            if col in STRING_COLUMNS:
+                arrays[col], arrays[col + '.dict'] = _encode(values)
+            else:
+                arrays[col] = np.array(values, dtype=np.float64)
+        self.parts += 1
+        path = os.path.join(self.path, '%s-%d-%d.npz' % (table, os.getpid(), self.parts))
+        tmp = path + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp, path)
+        self._rows[table] = dict((col, []) for col in TABLES[table])
+        return path
+
+    def close(self):
+        for table in TABLES:
+            self.write(table)
+
+
+### reading
+def _partitions(sink_dir, profile=None, run_from=None, run_to=None):
+    '''[(profile, run_time, folder)] of the partitions matching profile and run_from <= run_time <= run_to'''
+    found = []
+    if not os.path.isdir(sink_dir):
+        return found
+    for pdir in sorted(os.listdir(sink_dir)):
+        if not pdir.startswith('profile=') or (profile and pdir[len('profile='):] != profile):
+            continue
+        for rdir in sorted(os.listdir(os.path.join(sink_dir, pdir))):
+            if not rdir.startswith('run_time='):
+                continue
+            run_time = parse_run_time(rdir[len('run_time='):])
+            if (run_from and run_time < run_from) or (run_to and run_time > run_to):
+                continue
+            found.append((pdir[len('profile='):], run_time, os.path.join(sink_dir, pdir, rdir)))
+    return found
+
+
+def read_table(sink_dir, table, profile=None, run_from=None, run_to=None, names=None, columns=None):
+    '''one table as {column: array} across the matching partitions.
+       String columns come back decoded (bytes arrays), plus 'profile' and 'run_time' columns.
+       names limits rows to those KPV/KTI/phase names; columns limits what is read.
+    '''
+    columns = columns or TABLES[table]
+    out = dict((col, []) for col in list(columns) + ['profile', 'run_time'])
+    part_pattern = re.compile(re.escape(table) + r'-\d+-\d+\.npz$')
+    for part_profile, run_time, folder in _partitions(sink_dir, profile, run_from, run_to):
+        for fname in sorted(os.listdir(folder)):
+            if not part_pattern.match(fname):
+                continue
+            part = np.load(os.path.join(folder, fname))
+            try:
+                mask = None
+                if names is not None:
+                    wanted = np.in1d(part['name.dict'], np.array(list(names), dtype=np.string_))
+                    mask = wanted[part['name']]
+                    if not mask.any():
+                        continue
+                for col in columns:
+                    values = part[col]
+                    if col in STRING_COLUMNS:
+                        values = part[col + '.dict'][values]
+                    out[col].append(values if mask is None else values[mask])
+            finally:
+                part.close()
+            count = len(out[columns[0]][-1])
+            out['profile'].append(np.repeat(np.array([part_profile], dtype=np.string_), count))
+            out['run_time'].append(np.repeat(np.array([run_time.strftime(RUN_TIME_FORMAT)], dtype=np.string_), count))
+    return dict((col, np.concatenate(arrays) if arrays else np.array([])) for col, arrays in out.items())
+
+
+def bulk_load(cn, sink_dir, table, profile=None, run_from=None, run_to=None, batch_rows=fds_oracle.BULK_ARRAYSIZE*10):
+    '''insert a table's rows from the sink into fds_<table> through cn (any fds_db connection)'''
+    data = read_table(sink_dir, table, profile, run_from, run_to)
+    count = len(data['profile'])
+    rows = []
+    for i in xrange(count):
+        row = [str(data['profile'][i])]
+        for col in TABLES[table]:
+            value = data[col][i]
+            if col not in STRING_COLUMNS:
+                value = float(value)
+            elif col=='units' and value=='':
+                value = None
+            else:
+                value = str(value)
+            row.append(value)
+        rows.append(row + [datetime.strptime(data['run_time'][i], RUN_TIME_FORMAT)])  # as read_table wrote it
+        if len(rows) >= batch_rows:
+            fds_oracle.oracle_executemany(cn, INSERT_SQL[table], rows)
+            rows = []
+    if rows:
+        fds_oracle.oracle_executemany(cn, INSERT_SQL[table], rows)
+    return count
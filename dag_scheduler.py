@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Run the nodes of a dependency DAG concurrently, committing them in order
+
+derive_parameters_series splits each node into compute (gather and align its
+dependencies, derive) and commit (post-process, add to params and results).
+run_in_order() runs compute for up to `threads` nodes at a time in a thread
+pool, starting a node once every node it depends on has been committed, and
+calls commit on the calling thread strictly in the given order.  Results are
+therefore the same, in the same order, as a sequential run, and only the
+calling thread ever writes params or res; the heavy numpy work in derive and
+alignment releases the GIL and overlaps.
+
+With threads <= 1 it is a plain loop: compute then commit, one name at a time.
+"""
+import sys
+import Queue
+import logging
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+def run_in_order(names, dependencies, compute, commit, threads=1):
+    '''compute(name) for each of names, commit(name, result) in the order of names.
+       dependencies: name -> names it needs; only those earlier in names are waited for.
+       An exception from compute is re-raised here; nodes already running are let finish.
+    '''
+    if threads <= 1:
+        for name in names:
+            commit(name, compute(name))
+        return
+
+    position = dict((name, i) for i, name in enumerate(names))
+    waiting = {}     # name -> uncommitted names it needs
+    dependents = {}  # name -> names waiting for it
+    for name in names:
+        needs = set(d for d in dependencies.get(name, ()) if position.get(d, len(names)) < position[name])
+        waiting[name] = needs
+        for d in needs:
+            dependents.setdefault(d, []).append(name)
+
+    completed = Queue.Queue()
+    def run(name):
+        try:
+            completed.put((name, compute(name), None))
+        except Exception:
+            completed.put((name, None, sys.exc_info()))
+
+    pool = ThreadPool(threads)
+    try:
+        for name in names:
+            if not waiting[name]:
+                pool.apply_async(run, (name,))
+        done = {}
+        next_commit = 0
+        while next_commit < len(names):
+            name, result, error = completed.get(True, 1e9)  # a timeout keeps ctrl-c working
+            if error is not None:
+                raise error[0], error[1], error[2]
+            done[name] = result
+            while next_commit < len(names) and names[next_commit] in done:
+                committed = names[next_commit]
+                commit(committed, done.pop(committed))
+                next_commit += 1
+                for dependent in dependents.get(committed, ()):
+                    waiting[dependent].discard(committed)
+                    if not waiting[dependent]:
+                        pool.apply_async(run, (dependent,))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Database backends for run_analyzer
+
+The fds_oracle routines (analyzer_to_oracle, report_timing, report_job, ...)
+only need a DB-API connection with cursor/commit and :name binds.  A backend
+hands out such connections and wraps the few other things a run needs from
+the database:  bulk inserts, queries, the flight record upsert and the
+airport/runway data.
+
+    oracle   fds_oracle's pooled cx_Oracle sessions (the default)
+    sqlite   a local file, created from asias_fds_oracle.sql on first use, for
+             offline runs and benchmarks.  Airport/runway data comes from the
+             load_apt_rwy snapshot only.
+
+Pick one with analyser_custom_settings.DB_BACKEND or run_analyzer(db_backend=...).
+"""
+import os
+import re
+import time
+import sqlite3
+import logging
+from datetime import datetime
+from collections import OrderedDict
+
+import analyser_custom_settings
+
+logger = logging.getLogger(__name__)
+
+DB_BACKEND = getattr(analyser_custom_settings, 'DB_BACKEND', 'oracle')
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asias_fds_oracle.sql')
+
+_backends = {}  # name -> backend, one per process
+
+
+class OracleBackend(object):
+    '''see module docstring'''
+    name = 'oracle'
+
+    def __init__(self):
+        import fds_oracle  # here rather than at import, so the sqlite backend never loads cx_Oracle
+        self.fds_oracle = fds_oracle
+
+    def connect(self):
+        return self.fds_oracle.get_connection()
+
+    def insert_many(self, cn, sql, rows):
+        self.fds_oracle.oracle_executemany(cn, sql, rows)
+
+    def query(self, cn, sql, binds=None):
+        cur = cn.cursor()
+        cur.execute(sql, binds or [])
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+    def upsert_flight_record(self, cn, flight_record):
+        self.fds_oracle.save_flight_record(cn, flight_record, None, None)
+
+    def load_apt_rwy(self, cn):
+        '''(apt_dict, apt_rwy_dict) from the snapshot cache, else the Jeppesen tables'''
+        import load_apt_rwy
+        return load_apt_rwy.cached_apt_rwy(cn, load_apt_rwy.APT_RWY_CACHE_PATH)
+
+    def close(self):
+        self.fds_oracle.close_pool()
+
+
+### sqlite
+def _statements(sql_text):
+    '''the ';'-separated statements of a sql script, without -- comments'''
+    text = '\n'.join(line.split('--')[0] for line in sql_text.splitlines())
+    return [s.strip() for s in text.split(';') if s.strip()]
+
+
+def _column_defs(text):
+    '''[(name, type)] from "a varchar2(5), b number" (commas inside parentheses are kept)'''
+    columns = []
+    for col in re.split(r',(?![^(]*\))', text):
+        parts = col.split(None, 1)
+        if len(parts) == 2 and parts[0].lower() != 'primary':
+            columns.append((parts[0].lower(), ' '.join(parts[1].split())))
+    return columns
+
+
+def oracle_schema(sql_path=SCHEMA_PATH):
+    '''{table: OrderedDict(column: oracle type)} from the create and alter ... add statements of sql_path'''
+    with open(sql_path) as f:
+        statements = _statements(f.read())
+    tables = OrderedDict()
+    for statement in statements:
+        create = re.match(r'create\s+table\s+(\w+)\s*\((.*)\)\s*$', statement, re.I | re.S)
+        alter = re.match(r'alter\s+table\s+(\w+)\s+add\s*\(?(.*?)\)?\s*$', statement, re.I | re.S)
+        if create:
+            tables[create.group(1).lower()] = OrderedDict(_column_defs(create.group(2)))
+        elif alter and alter.group(1).lower() in tables:
+            table = tables[alter.group(1).lower()]
+            for name, coltype in _column_defs(alter.group(2)):
+                table.setdefault(name, coltype)
+    return tables
+
+
+def sqlite_type(oracle_type):
+    '''sqlite declared type for an oracle column type.  timestamp is kept so that
+       detect_types=PARSE_DECLTYPES returns datetimes'''
+    t = oracle_type.lower()
+    if t.startswith('varchar2') or t.startswith('clob'):
+        return 'text'
+    if t.startswith('number'):
+        return 'real' if t == 'number' else 'numeric'
+    return t.split()[0]
+
+
+def sqlite_ddl(tables):
+    statements = []
+    for table, columns in tables.items():
+        cols = ', '.join('%s %s' % (name, sqlite_type(coltype)) for name, coltype in columns.items())
+        statements.append('create table if not exists %s (%s)' % (table, cols))
+    return statements
+
+
+class SQLiteBackend(object):
+    '''see module docstring'''
+    name = 'sqlite'
+
+    def __init__(self, db_path=None, schema_path=SCHEMA_PATH):
+        self.db_path = db_path or getattr(analyser_custom_settings, 'SQLITE_DB_PATH', 'asias_fds.sqlite')
+        self.schema_path = schema_path
+        self._schema_ready = False
+
+    def connect(self):
+        '''a new connection; usable from the result writer's thread'''
+        cn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        cn.execute('pragma journal_mode=wal')   # pool workers write while others read
+        cn.execute('pragma synchronous=normal')
+        if not self._schema_ready:
+            for statement in sqlite_ddl(oracle_schema(self.schema_path)):
+                cn.execute(statement)
+            cn.commit()
+            self._schema_ready = True
+        return cn
+
+    def insert_many(self, cn, sql, rows):
+        import fds_oracle  # plain DB-API routines; cx_Oracle itself is optional there
+        fds_oracle.oracle_executemany(cn, sql, rows)
+
+    def query(self, cn, sql, binds=None):
+        return cn.execute(sql, binds or []).fetchall()
+
+    def upsert_flight_record(self, cn, flight_record):
+        import fds_oracle
+        fds_oracle.save_flight_record(cn, flight_record, None, None)
+
+    def load_apt_rwy(self, cn):
+        '''(apt_dict, apt_rwy_dict) from the snapshot cache; the Jeppesen tables are not available here'''
+        import load_apt_rwy
+        return load_apt_rwy.cached_apt_rwy(None, load_apt_rwy.APT_RWY_CACHE_PATH)
+
+    def close(self):
+        pass
+
+
+BACKENDS = {'oracle': OracleBackend, 'sqlite': SQLiteBackend}
+
+
+def get_backend(name=None):
+    '''the backend of this process called name (default settings.DB_BACKEND)'''
+    name = name or DB_BACKEND
+    if name not in _backends:
+        if name not in BACKENDS:
+            raise ValueError('unknown db backend: ' + name + '. Use one of ' + ', '.join(sorted(BACKENDS)))
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def benchmark_write_path(backend, n_rows=100000, batch_rows=1000):
+    '''rows per second for KPV inserts through backend.insert_many, in batches of batch_rows.
+       Rows go in under profile 'bench' and are deleted again; point oracle at a test schema.
+    '''
+    import fds_oracle
+    cn = backend.connect()
+    run_time = datetime.now()
+    rows = [['bench', 'bench_%05d.hdf5' % (i % 1000), 'Bench KPV %03d' % (i % 300), float(i % 5000), i*0.5,
+             'bench_base.hdf5', 'kt', 'bench', run_time] for i in xrange(n_rows)]
+    start = time.time()
+    for i in xrange(0, n_rows, batch_rows):
+        backend.insert_many(cn, fds_oracle.KPV_INSERT_SQL, rows[i:i+batch_rows])
+    rate = n_rows/(time.time()-start)
+    fds_oracle.oracle_execute(cn, "delete from fds_kpv where profile='bench' and file_repository='bench'")
+    cn.close()
+    print '%-8s %10.0f rows/s' % (backend.name, rate)
+    return rate
+
+
+if __name__=='__main__':
+    import sys
+    for backend_name in sys.argv[1:] or ['sqlite']:
+        benchmark_write_path(get_backend(backend_name))
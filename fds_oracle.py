@@ -9,28 +9,114 @@ import time
 import getpass
 from datetime import datetime
 from collections import OrderedDict
-import cx_Oracle as ora
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+try:
+    import cx_Oracle as ora
+except ImportError:  # offline runs on fds_db's sqlite backend don't need the Oracle client
+    ora = None
 import analyser_custom_settings
 
-def get_connection():
-    ''' connect to Oracle
-    
-        connection.txt should contain a single connection string,
+# session pool: one per process, sized by analyser_custom_settings if set there
+POOL_MIN = getattr(analyser_custom_settings, 'ORACLE_POOL_MIN', 1)
+POOL_MAX = getattr(analyser_custom_settings, 'ORACLE_POOL_MAX', 4)
+_pool = None
+_pool_pid = None
+
+
+def read_connection_string():
+    ''' connection.txt should contain a single connection string,
         e.g. scott/tiger@servername   (username/password@server)
         
         The server needs to have been previously configured in Oracle client,
           for example using a TNSnames entry or an LDAP connection.
     '''
     with open(analyser_custom_settings.SHARED_CODE_PATH+'connection.txt') as f:
-        connection_string = f.read()
-        
-    cn = ora.connect(connection_string)
-    return cn 
+        connection_string = f.read().strip()
+    return connection_string
+
+
+def parse_connection_string(connection_string):
+    '''(user, password, dsn) of a username/password@server string, or None for anything else,
+       e.g. external authentication (/@server) or a string without a server'''
+    if '/' not in connection_string or '@' not in connection_string:
+        return None
+    user, rest = connection_string.split('/', 1)
+    password, dsn = rest.rsplit('@', 1)
+    if not (user and password and dsn):
+        return None
+    return user, password, dsn
+
+
+def get_pool(min_sessions=None, max_sessions=None):
+    '''the session pool of this process, created on first use, or None if the connection
+       string can't be used for a pool (then get_connection() connects directly).
+       A forked worker process gets its own pool rather than sharing its parent's sessions.
+       The pool is closed when the process exits.
+    '''
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = None
+        _pool_pid = os.getpid()
+        credentials = parse_connection_string(read_connection_string())
+        if credentials is None:
+            return None
+        user, password, dsn = credentials
+        _pool = ora.SessionPool(user, password, dsn, 
+                                min_sessions or POOL_MIN, max_sessions or POOL_MAX, 1, 
+                                threaded=True)
+        # runs at exit in pool workers too, after their own connections are closed (see Finalize)
+        Finalize(None, close_pool, exitpriority=0)
+    return _pool
+
+
+def close_pool():
+    '''close this process's session pool, e.g. at the end of a run'''
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        try:
+            _pool.close()
+        except ora.DatabaseError, e:  # sessions still checked out
+            print 'close_pool: ', e
+    _pool = None
+    _pool_pid = None
+
+
+def get_connection(pooled=True):
+    ''' connect to Oracle
+    
+        Returns a session from this process's pool, checked with a ping; close() returns it to the pool.
+        pooled=False, or a connection string get_pool() can't use, opens a separate, unpooled connection.
+        See read_connection_string() for connection.txt.
+    '''
+    if ora is None:
+        raise ImportError('cx_Oracle is not installed; for offline runs use the sqlite backend (see fds_db)')
+    pool = get_pool() if pooled else None
+    if pool is None:
+        return ora.connect(read_connection_string())
+    for attempt in range(POOL_MAX):
+        cn = pool.acquire()
+        try:
+            cn.ping()
+            return cn
+        except ora.DatabaseError:  # dead session, e.g. after a network drop
+            pool.drop(cn)
+    return pool.acquire()
+
+
+@contextmanager
+def borrowed_connection():
+    '''with borrowed_connection() as cn:  ... a pooled connection, released again afterwards'''
+    cn = get_connection()
+    try:
+        yield cn
+    finally:
+        cn.close()
 
     
 def insert_from_ordered_dict(my_record, table):
     '''appends a recond to Oracle from an OrderedDict.  It does NOT check integrity or uniqueness!'''
-    with get_connection() as cn:
+    with borrowed_connection() as cn:
         cur =cn.cursor()
         cols = ','.join(my_record.keys())
         colsyms = ','.join([':'+k for k in my_record.keys()])
@@ -44,7 +130,7 @@ def flight_record_filepaths(query):
     '''Pass query like 'select file_path from fds_flight_record where ...'
        Get back a list of files to process in your profile
     '''
-    with get_connection() as cn:
+    with borrowed_connection() as cn:
         cur = cn.cursor()
         cur.execute(query)       
         files_to_process = [fld[0] for fld in cur.fetchall()]
@@ -53,7 +139,12 @@ def flight_record_filepaths(query):
 
                
 def oracle_execute(connection, sql, values=None):
-    '''run and commit some sql'''
+    '''run and commit some sql.  
+       connection may also be a result_writer.BatchedResultWriter, which queues the statement instead
+    '''
+    if hasattr(connection, 'queue_rows'):
+        connection.queue_rows(sql, [values])
+        return
     cur =connection.cursor()
     if values:
         cur.execute(sql, values)
@@ -64,13 +155,171 @@ def oracle_execute(connection, sql, values=None):
  
        
 def oracle_executemany(connection, sql, values):
-    '''run and commit some sql'''
+    '''run and commit some sql.  see oracle_execute for BatchedResultWriter.
+       On Oracle, inserts listed in TYPED_INSERTS go through a BulkInserter.
+    '''
+    if hasattr(connection, 'queue_rows'):
+        connection.queue_rows(sql, values)
+        return
+    if sql in TYPED_INSERTS and is_oracle(connection):
+        cached_inserter(connection, sql).insert(values)
+        connection.commit()
+        return
     cur =connection.cursor()
     cur.executemany(sql, values)
     connection.commit()
     cur.close()
 
 
+### typed bulk inserts for the result tables
+BULK_ARRAYSIZE = 1000  # rows per round trip
+
+KTI_INSERT_SQL = """insert /*append*/ into fds_kti (profile, source_file,  name,  time_index, base_file_path, file_repository, run_time) 
+                                    values (:profile, :source_file, :name, :time_index, :base_file_path, :file_repository, :run_time)"""                
+KPV_INSERT_SQL = """insert /*append*/ into fds_kpv (profile, source_file,  name,  time_index,  value,  base_file_path,  units, file_repository, run_time) 
+                                    values (:profile, :source_file, :name, :time_index, :value, :base_file_path, :units, :file_repository, :run_time)"""
+PHASE_INSERT_SQL = """insert /*append*/ into fds_phase (profile, source_file,  name,  time_index,  stop_edge, duration, base_file_path, file_repository, run_time) 
+                                    values (:profile, :source_file, :name,   :time_index, :stop_edge, :duration, :base_file_path, :file_repository, :run_time)"""
+
+# bind types in column order: varchar2 lengths as in asias_fds_oracle.sql, numbers as native floats
+_FLOAT = getattr(ora, 'NATIVE_FLOAT', None)
+_TIMESTAMP = getattr(ora, 'TIMESTAMP', None)
+TYPED_INSERTS = {
+    KTI_INSERT_SQL:   ('fds_kti',   [128, 128, 128, _FLOAT, 96, 128, _TIMESTAMP]),
+    KPV_INSERT_SQL:   ('fds_kpv',   [128, 128, 128, _FLOAT, _FLOAT, 96, 48, 128, _TIMESTAMP]),
+    PHASE_INSERT_SQL: ('fds_phase', [128, 128, 128, _FLOAT, _FLOAT, _FLOAT, 96, 128, _TIMESTAMP]),
+    }
+
+
+class BulkInserter(object):
+    '''one prepared insert with declared bind types, sent in chunks of arraysize rows.
+       Keep it for the life of its connection to re-use the prepared statement (oracle_executemany
+       does, see cached_inserter()).
+       staging=True inserts into the table's staging copy instead; see swap_in_staging().
+    '''
+    def __init__(self, connection, sql, input_sizes=None, arraysize=BULK_ARRAYSIZE, staging=False):
+        table, typed_sizes = TYPED_INSERTS.get(sql, (None, None))
+        self.input_sizes = input_sizes if input_sizes is not None else typed_sizes
+        if staging:
+            sql = staged_sql(sql, table)
+        self.sql = sql
+        self.table = table
+        self.arraysize = arraysize
+        self.rows = 0
+        self.cursor = connection.cursor()
+        self.cursor.prepare(sql)
+
+    def insert(self, rows):
+        '''insert rows (lists of values in statement order); the caller commits'''
+        for start in xrange(0, len(rows), self.arraysize):
+            if self.input_sizes:
+                self.cursor.setinputsizes(*self.input_sizes)
+            self.cursor.executemany(None, rows[start:start+self.arraysize])
+        self.rows += len(rows)
+
+    def close(self):
+        self.cursor.close()
+
+
+# prepared BulkInserters of the last few connections used by oracle_executemany:
+# id(connection) -> (connection, {sql: BulkInserter}), most recently used last
+_inserters = OrderedDict()
+INSERTER_CONNECTIONS = 4
+
+
+def cached_inserter(connection, sql):
+    '''the BulkInserter for sql on connection, prepared on first use and kept while the
+       connection is among the INSERTER_CONNECTIONS most recently used'''
+    entry = _inserters.pop(id(connection), None)
+    if entry is None or entry[0] is not connection:
+        entry = (connection, {})
+    _inserters[id(connection)] = entry
+    while len(_inserters) > INSERTER_CONNECTIONS:
+        for inserter in _inserters.popitem(last=False)[1][1].values():
+            try:
+                inserter.close()
+            except ora.Error:  # its connection is closed already
+                pass
+    if sql not in entry[1]:
+        entry[1][sql] = BulkInserter(connection, sql)
+    return entry[1][sql]
+
+
+def is_oracle(connection):
+    '''False for other DB-API connections, e.g. fds_db's sqlite backend'''
+    return ora is not None and isinstance(connection, ora.Connection)
+
+
+def staging_table(table):
+    return table + '_stage'
+
+
+def staged_sql(sql, table):
+    '''an insert into table rewritten to insert into its staging table'''
+    return sql.replace(' into '+table+' ', ' into '+staging_table(table)+' ', 1)
+
+
+def create_staging_table(connection, table):
+    '''empty copy of table's columns, if it doesn't exist yet.
+       It is a global temporary table, so every session (writer, pool worker) only sees its own rows.
+    '''
+    stage = staging_table(table)
+    cur = connection.cursor()
+    try:
+        cur.execute('create global temporary table STAGE on commit preserve rows as select * from TABLE where 1=0'.replace('STAGE', stage).replace('TABLE', table))
+    except ora.DatabaseError, e:
+        if 'ORA-00955' not in str(e):  # name is already used by an existing object
+            raise
+        cur.execute('select temporary from user_tables where table_name=:name', [stage.upper()])
+        row = cur.fetchone()
+        if row is None or row[0] != 'Y':
+            cur.close()
+            raise RuntimeError(stage + ' exists but is not a global temporary table, so sessions would '
+                               'share its rows.  Drop it to let create_staging_table() re-create it.')
+    cur.close()
+
+
+def swap_in_staging(connection, table):
+    '''move this session's staged rows into table with one direct-path insert and empty its staging
+       rows, in one transaction'''
+    cur = connection.cursor()
+    cur.execute('insert /*+ append */ into TABLE select * from STAGE'.replace('STAGE', staging_table(table)).replace('TABLE', table))
+    cur.execute('delete from ' + staging_table(table))
+    connection.commit()
+    cur.close()
+
+
+def benchmark_bulk_insert(connection, n_rows=100000, arraysizes=(100, 1000, 5000)):
+    '''rows per second into the fds_kpv staging table: plain executemany vs typed BulkInserter.
+       Everything is rolled back.
+    '''
+    create_staging_table(connection, 'fds_kpv')
+    run_time = datetime.now()
+    rows = [['bench', 'bench_%05d.hdf5' % (i % 1000), 'Bench KPV %03d' % (i % 300), float(i % 5000), i*0.5,
+             'bench_base.hdf5', 'kt', 'bench', run_time] for i in xrange(n_rows)]
+    sql = staged_sql(KPV_INSERT_SQL, 'fds_kpv')
+    rates = OrderedDict()
+
+    cur = connection.cursor()
+    start = time.time()
+    cur.executemany(sql, rows)
+    rates['executemany'] = n_rows/(time.time()-start)
+    cur.close()
+    connection.rollback()
+
+    for arraysize in arraysizes:
+        inserter = BulkInserter(connection, KPV_INSERT_SQL, arraysize=arraysize, staging=True)
+        start = time.time()
+        inserter.insert(rows)
+        rates['typed arraysize=%d' % arraysize] = n_rows/(time.time()-start)
+        inserter.close()
+        connection.rollback()
+
+    for k, v in rates.items():
+        print '%-24s %10.0f rows/s' % (k, v)
+    return rates
+
+
 def record_to_csv(record, dest_path):
     '''append data from a list as a record to a CSV file.  assumes simple fields.'''
     #header = record.keys()
@@ -190,8 +439,8 @@ def save_flight_record(cn, flight_record, OUTPUT_DIR, output_path_and_file):
      #record_to_csv(flight_record.values(), OUTPUT_DIR+'flight_record.csv')
      repo = flight_record['file_repository']
      src = flight_record['source_file']
-     dsql= """delete from fds_flight_record where file_repository='REPO' and source_file='SRC'""".replace('REPO',repo).replace('SRC', src)
-     oracle_execute(cn, dsql)
+     dsql= """delete from fds_flight_record where file_repository=:repo and source_file=:src"""
+     oracle_execute(cn, dsql, [repo, src])
      #with hdfaccess.file.hdf_file(output_path_and_file) as hfile:
      #    flight_record['recorded_parameters'] = ','.join(hfile.lfl_keys())
      dict_to_oracle(cn, flight_record, 'fds_flight_record')
@@ -215,9 +464,7 @@ def kti_to_oracle(cn, profile, flight_file, output_path_and_file, kti, file_repo
     #dsql= """delete from fds_kti where file_repository='REPO' and source_file='SRC' and profile='PROFILE'""".replace('PROFILE',profile).replace('REPO',file_repository).replace('SRC', flight_file)
     #oracle_execute(cn, dsql)
 
-    isql = """insert /*append*/ into fds_kti (profile, source_file,  name,  time_index, base_file_path, file_repository, run_time) 
-                                    values (:profile, :source_file, :name, :time_index, :base_file_path, :file_repository, :run_time)"""                
-    oracle_executemany(cn, isql, rows)
+    oracle_executemany(cn, KTI_INSERT_SQL, rows)
 
 
 def kpv_to_oracle(cn, profile, flight_file, output_path_and_file, params, kpv, file_repository='linux', run_time=None):
@@ -237,9 +484,7 @@ def kpv_to_oracle(cn, profile, flight_file, output_path_and_file, params, kpv, f
         rows.append( vals )
     #dsql= """delete from fds_kpv where file_repository='REPO' and source_file='SRC' and profile='PROFILE'""".replace('PROFILE',profile).replace('REPO',file_repository).replace('SRC', flight_file)
     #oracle_execute(cn, dsql)
-    isql = """insert /*append*/ into fds_kpv (profile, source_file,  name,  time_index,  value,  base_file_path,  units, file_repository, run_time) 
-                                    values (:profile, :source_file, :name, :time_index, :value, :base_file_path, :units, :file_repository, :run_time)"""
-    oracle_executemany(cn, isql, rows)
+    oracle_executemany(cn, KPV_INSERT_SQL, rows)
 
     
 def phase_to_oracle(cn, profile, flight_file, output_path_and_file, phase_list, file_repository='linux', run_time=None):
@@ -254,9 +499,7 @@ def phase_to_oracle(cn, profile, flight_file, output_path_and_file, phase_list,
         rows.append( vals )
     #dsql= """delete from fds_phase where file_repository='REPO' and source_file='SRC' and profile='PROFILE'""".replace('PROFILE',profile).replace('REPO',file_repository).replace('SRC', flight_file)
     #oracle_execute(cn, dsql)
-    isql = """insert /*append*/ into fds_phase (profile, source_file,  name,  time_index,  stop_edge, duration, base_file_path, file_repository, run_time) 
-                                    values (:profile, :source_file, :name,   :time_index, :stop_edge, :duration, :base_file_path, :file_repository, :run_time)"""
-    oracle_executemany(cn, isql, rows)
+    oracle_executemany(cn, PHASE_INSERT_SQL, rows)
 
 
 ### job report 
@@ -347,4 +590,9 @@ def dump_flight_attributes(flight):
 
 
 if __name__=='__main__':
+    import sys
+    if 'bench_insert' in sys.argv:
+        bench_cn = get_connection()
+        benchmark_bulk_insert(bench_cn)
+        bench_cn.close()
     print 'loaded'
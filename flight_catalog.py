@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent catalog of flight file metadata
+
+Planning a run (grouping files by frame, choosing series_to_load, estimating
+costs) needs a few facts per file that otherwise mean opening every hdf5
+file.  The catalog keeps them in a sqlite file:
+
+    flight_file  path, size, mtime, file_repository, tail, frame, duration,
+                 start_datetime, the id of the file's parameter set, its
+                 aircraft info as json and a digest of the frame_dict that
+                 aircraft info was looked up in
+    param_set    distinct sets of recorded parameters as json
+                 [[name, frequency, offset], ...], shared by all files of an LFL
+
+refresh() stats the given files and only opens those that are new, whose
+size or mtime changed, or that were catalogued under another frame_dict; files that disappeared from a refreshed folder are
+dropped.  files(), fleet_groups(), durations(), aircraft_info() and parameters() then answer
+from the catalog without touching the hdf5 files.
+
+The catalog lives at settings.FLIGHT_CATALOG_PATH; get_catalog() keeps one per
+process.  simple_flight_sets.catalog_flights() builds flight sets from it.
+"""
+import os
+import glob
+import hashlib
+import sqlite3
+import logging
+
+import simplejson as json
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = ['''create table if not exists flight_file (
+                path text primary key, size integer, mtime real, file_repository text,
+                tail text, frame text, duration real, start_datetime timestamp, param_set_id integer,
+                frame_digest text, aircraft_info text)''',
+          '''create table if not exists param_set (id integer primary key, digest text unique, params text)''',
+          'create index if not exists flight_file_frame on flight_file (frame)',
+          'create index if not exists flight_file_start on flight_file (start_datetime)']
+COMMIT_EVERY = 500   # files per transaction during refresh
+
+_catalogs = {}  # db path -> FlightCatalog, one per process
+
+
+def frame_digest(frame_dict):
+    '''digest of frame_dict, to tell which frame_dict a catalog entry was made with (None for None)'''
+    if frame_dict is None:
+        return None
+    return hashlib.sha1(json.dumps(frame_dict, sort_keys=True, default=repr)).hexdigest()
+
+
+def read_metadata(path, frame_dict=None):
+    '''{tail, frame, aircraft_info, duration, start_datetime, params} of one hdf5 file, reading attributes only.
+       aircraft_info is get_aircraft_info(path, frame_dict), as in load_flight ({} without frame_dict);
+       tail and frame are taken from it'''
+    from hdfaccess.file import hdf_file
+    with hdf_file(path) as ff:
+        params = []
+        for name in ff.keys():
+            pattrs = ff.hdf['series'][name].attrs
+            params.append([name, float(pattrs.get('frequency', 1.0)),
+                           float(pattrs.get('supf_offset', pattrs.get('offset', 0.0)))])
+        meta = {'duration': ff.duration, 'start_datetime': ff.start_datetime, 'params': params}
+    aircraft_info = {}
+    if frame_dict is not None:
+        from frame_list import get_aircraft_info
+        aircraft_info = get_aircraft_info(path, frame_dict)
+    meta['tail'] = aircraft_info.get('Tail Number')
+    meta['frame'] = aircraft_info.get('Frame')
+    meta['aircraft_info'] = aircraft_info
+    return meta
+
+
+class FlightCatalog(object):
+    '''see module docstring'''
+    def __init__(self, db_path):
+        self.db_path = db_path
+        folder = os.path.dirname(db_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.cn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.cn.execute('pragma journal_mode=wal')
+        for statement in SCHEMA:
+            self.cn.execute(statement)
+        columns = [row[1] for row in self.cn.execute('pragma table_info(flight_file)')]
+        if 'frame_digest' not in columns:  # catalog from before frame_digest: entries are read again with a frame_dict
+            self.cn.execute('alter table flight_file add column frame_digest text')
+        if 'aircraft_info' not in columns:  # likewise, to fill in the aircraft info
+            self.cn.execute('alter table flight_file add column aircraft_info text')
+            self.cn.execute('update flight_file set frame_digest=null')
+        self.cn.commit()
+        self._param_sets = {}  # id -> [[name, frequency, offset]]
+
+    ### refresh
+    def _param_set_id(self, params):
+        text = json.dumps(sorted(params))
+        digest = hashlib.sha1(text).hexdigest()
+        row = self.cn.execute('select id from param_set where digest=?', [digest]).fetchone()
+        if row:
+            return row[0]
+        return self.cn.execute('insert into param_set (digest, params) values (?, ?)', [digest, text]).lastrowid
+
+    def refresh(self, paths, file_repository=None, frame_dict=None, reader=read_metadata):
+        '''bring the entries for paths up to date; returns (files read, files unchanged).
+           With frame_dict, entries made with another frame_dict (or none) are read again.'''
+        digest = frame_digest(frame_dict)
+        known = dict((row[0], (row[1], row[2], digest is None or digest == row[3])) for row in
+                     self.cn.execute('select path, size, mtime, frame_digest from flight_file'))
+        read = unchanged = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) == (st.st_size, st.st_mtime, True):
+                unchanged += 1
+                continue
+            try:
+                meta = reader(path, frame_dict)
+            except Exception:
+                logger.exception('flight_catalog: cannot read %s', path)
+                continue
+            self.cn.execute('insert or replace into flight_file values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            [path, st.st_size, st.st_mtime, file_repository, meta['tail'], meta['frame'],
+                             meta['duration'], meta['start_datetime'], self._param_set_id(meta['params']), digest,
+                             json.dumps(meta.get('aircraft_info') or {}, default=repr)])
+            read += 1
+            if read % COMMIT_EVERY == 0:
+                self.cn.commit()
+        self.cn.commit()
+        logger.info('flight_catalog: %d files read, %d unchanged', read, unchanged)
+        return read, unchanged
+
+    def refresh_folder(self, folder, pattern='*.hdf5', file_repository=None, frame_dict=None, reader=read_metadata):
+        '''refresh the files in folder matching pattern and forget those no longer there'''
+        paths = glob.glob(os.path.join(folder, pattern))
+        result = self.refresh(paths, file_repository, frame_dict, reader)
+        present = set(paths)
+        prefix = os.path.join(folder, '')
+        gone = [row[0] for row in self.cn.execute('select path from flight_file where substr(path, 1, ?)=?',
+                                                  [len(prefix), prefix])
+                if row[0] not in present and os.path.dirname(row[0]) == os.path.dirname(prefix)]
+        self.cn.executemany('delete from flight_file where path=?', [[p] for p in gone])
+        self.cn.commit()
+        return result
+
+    ### queries
+    def files(self, frame=None, tail=None, file_repository=None, folder=None, start_from=None, start_to=None,
+              min_duration=None, recorded=None):
+        '''paths of the catalogued files matching all the given filters, by path.
+           recorded: parameter names that must all be recorded'''
+        where, binds = [], []
+        for column, value in (('frame', frame), ('tail', tail), ('file_repository', file_repository)):
+            if value is not None:
+                where.append(column + '=?')
+                binds.append(value)
+        if folder is not None:
+            prefix = os.path.join(folder, '')
+            where.append('substr(path, 1, ?)=?')
+            binds.extend([len(prefix), prefix])
+        if start_from is not None:
+            where.append('start_datetime>=?')
+            binds.append(start_from)
+        if start_to is not None:
+            where.append('start_datetime<=?')
+            binds.append(start_to)
+        if min_duration is not None:
+            where.append('duration>=?')
+            binds.append(min_duration)
+        if recorded:
+            ids = [i for i in self._all_param_set_ids() if set(recorded) <= set(p[0] for p in self.param_set(i))]
+            if not ids:
+                return []
+            where.append('param_set_id in (%s)' % ','.join(str(i) for i in ids))
+        sql = 'select path from flight_file' + (' where ' + ' and '.join(where) if where else '') + ' order by path'
+        return [row[0] for row in self.cn.execute(sql, binds)]
+
+    def _all_param_set_ids(self):
+        return [row[0] for row in self.cn.execute('select id from param_set')]
+
+    def param_set(self, param_set_id):
+        if param_set_id not in self._param_sets:
+            row = self.cn.execute('select params from param_set where id=?', [param_set_id]).fetchone()
+            self._param_sets[param_set_id] = json.loads(row[0]) if row else []
+        return self._param_sets[param_set_id]
+
+    def lookup(self, column, paths):
+        '''{path: value of column} for the catalogued paths'''
+        found = {}
+        paths = list(paths)
+        for start in xrange(0, len(paths), 500):  # sqlite's bind limit
+            chunk = paths[start:start+500]
+            sql = 'select path, %s from flight_file where path in (%s)' % (column, ','.join('?'*len(chunk)))
+            found.update(self.cn.execute(sql, chunk).fetchall())
+        return found
+
+    def fleet_groups(self, paths):
+        '''({frame: [paths]}, [paths not catalogued or without a frame])'''
+        frames = self.lookup('frame', paths)
+        groups, missing = {}, []
+        for path in paths:
+            if frames.get(path):
+                groups.setdefault(frames[path], []).append(path)
+            else:
+                missing.append(path)
+        return groups, missing
+
+    def aircraft_info(self, paths):
+        '''{path: aircraft info dict} for the catalogued paths, as get_aircraft_info gave it'''
+        return dict((p, json.loads(info) if info else {}) for p, info in self.lookup('aircraft_info', paths).items())
+
+    def durations(self, paths):
+        '''{path: duration in seconds} for the catalogued paths'''
+        return dict((p, d) for p, d in self.lookup('duration', paths).items() if d is not None)
+
+    def parameters(self, path):
+        '''[[name, frequency, offset]] recorded in path, or None if it is not catalogued'''
+        found = self.lookup('param_set_id', [path])
+        if path not in found:
+            return None
+        return self.param_set(found[path])
+
+    def close(self):
+        self.cn.close()
+
+
+def get_catalog(db_path):
+    '''the FlightCatalog of this process for db_path, or None if db_path is None'''
+    if db_path is None:
+        return None
+    if db_path not in _catalogs:
+        _catalogs[db_path] = FlightCatalog(db_path)
+    return _catalogs[db_path]
+
+
+if __name__=='__main__':
+    import sys
+    import analyser_custom_settings
+    logging.basicConfig(level=logging.INFO)
+    catalog = get_catalog(getattr(analyser_custom_settings, 'FLIGHT_CATALOG_PATH', 'flight_catalog.sqlite'))
+    for folder in sys.argv[1:]:
+        print folder, catalog.refresh_folder(folder)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Storage policies for the series datasets of base hdf5 output
+
+Flight.save_to_hdf5 writes parameters through hdfaccess's set_param, which
+uses the same dataset settings for everything.  A StoragePolicy picks, per
+parameter, the h5py dataset settings:
+
+    compression   FILTERS entry: 'lzf' (fast, the default here), 'deflate'
+                  (shuffle + gzip 4, smaller), 'deflate1' (shuffle + gzip 1),
+                  'none', or None to keep hdfaccess's own settings
+    chunks        one chunk per series up to CHUNK_BYTES, as profiles read
+                  whole series; longer series get CHUNK_BYTES chunks
+    rules         [(fnmatch pattern, filter name)] overriding the filter for
+                  matching parameter names, first match wins
+    compact_masks masks are stored as shuffle + gzip 9 whatever the data
+                  filter: they are mostly long runs and shrink to almost nothing
+
+set_param has hdfaccess write a parameter's group and attributes only
+(save_data=False, save_mask=False) and creates the 'data' and 'mask' datasets
+itself with the policy's settings, so each dataset is written once.  Files stay
+plain hdfaccess files; h5py reads the filters transparently.  benchmark()
+compares policies on a real flight: write time, whole-file read time,
+one-series read time, and size against hdfaccess's defaults.
+
+Settings: HDF5_STORAGE_FILTER, HDF5_STORAGE_RULES, HDF5_COMPACT_MASKS.
+"""
+import os
+import time
+import shutil
+import fnmatch
+import inspect
+import logging
+import tempfile
+
+import numpy as np
+
+import analyser_custom_settings
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 1024*1024
+FILTERS = {'none': {},
+           'lzf': {'compression': 'lzf', 'shuffle': True},
+           'deflate1': {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True},
+           'deflate': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}}
+MASK_FILTER = {'compression': 'gzip', 'compression_opts': 9, 'shuffle': True}
+
+
+class StoragePolicy(object):
+    '''see module docstring'''
+    def __init__(self, compression='lzf', rules=(), compact_masks=True, chunk_bytes=CHUNK_BYTES):
+        for name in [compression] + [r[1] for r in rules]:
+            if name is not None and name not in FILTERS:
+                raise ValueError('unknown hdf5 filter: %s. Use one of %s' % (name, ', '.join(sorted(FILTERS))))
+        self.compression = compression
+        self.rules = list(rules)
+        self.compact_masks = compact_masks
+        self.chunk_bytes = chunk_bytes
+
+    def filter_for(self, name):
+        for pattern, compression in self.rules:
+            if fnmatch.fnmatchcase(name, pattern):
+                return compression
+        return self.compression
+
+    def dataset_kwargs(self, name, array):
+        '''h5py create_dataset keywords for the data of parameter name, or None for hdfaccess's own'''
+        compression = self.filter_for(name)
+        if compression is None:
+            return None
+        kwargs = dict(FILTERS[compression])
+        length = len(array)
+        if length:
+            itemsize = np.ma.getdata(array).dtype.itemsize
+            kwargs['chunks'] = (int(min(length, max(1, self.chunk_bytes // itemsize))),)
+        return kwargs
+
+    def mask_kwargs(self, name, array):
+        if not self.compact_masks or not len(array):
+            return None
+        kwargs = dict(MASK_FILTER)
+        kwargs['chunks'] = (int(min(len(array), self.chunk_bytes)),)
+        return kwargs
+
+    def __repr__(self):
+        return 'StoragePolicy(%r, rules=%r, compact_masks=%r)' % (self.compression, self.rules, self.compact_masks)
+
+
+def default_policy():
+    '''the policy from the settings; None (hdfaccess defaults) unless HDF5_STORAGE_FILTER is set'''
+    compression = getattr(analyser_custom_settings, 'HDF5_STORAGE_FILTER', None)
+    rules = getattr(analyser_custom_settings, 'HDF5_STORAGE_RULES', [])
+    if compression is None and not rules:
+        return None
+    return StoragePolicy(compression, rules, getattr(analyser_custom_settings, 'HDF5_COMPACT_MASKS', True))
+
+
+_warned = []  # hdfaccess without a way to pass dataset settings, warned once per process
+
+
+def _writes_attributes_only(hfile):
+    '''True if hfile.set_param can skip the data and mask datasets'''
+    try:
+        return 'save_data' in inspect.getargspec(hfile.set_param).args
+    except TypeError:
+        return False
+
+
+def _data_and_mask(param):
+    '''the arrays hdfaccess stores for param: raw values of multistates, mask in full'''
+    array = param.array
+    if not hasattr(array, 'mask'):
+        array = np.ma.masked_array(array, mask=False)
+    data = array.raw if getattr(param, 'values_mapping', None) and hasattr(array, 'raw') else array
+    return np.ma.getdata(data), np.ma.getmaskarray(array)
+
+
+def set_param(hfile, param, policy):
+    '''hfile.set_param(param) with the datasets stored as policy says'''
+    if policy is None:
+        hfile.set_param(param)
+        return
+    kwargs = policy.dataset_kwargs(param.name, param.array)
+    mask_kwargs = policy.mask_kwargs(param.name, param.array)
+    default = dict(getattr(hfile, 'DATASET_KWARGS', {}))
+    if _writes_attributes_only(hfile):
+        hfile.set_param(param, save_data=False, save_mask=False)
+        group = hfile.hdf['series'][param.name.replace('/', '_')]
+        data, mask = _data_and_mask(param)
+        for dataset, values, dataset_kwargs in (('data', data, kwargs), ('mask', mask, mask_kwargs or kwargs)):
+            if dataset in group:  # parameter written before
+                del group[dataset]
+            group.create_dataset(dataset, data=values, **(default if dataset_kwargs is None else dataset_kwargs))
+    elif hasattr(hfile, 'DATASET_KWARGS'):
+        # one setting for data and mask: the policy's masks are not available here
+        if kwargs is not None:
+            hfile.DATASET_KWARGS = kwargs   # instance attribute, used by set_param
+        else:
+            hfile.__dict__.pop('DATASET_KWARGS', None)  # back to the class's
+        hfile.set_param(param)
+    else:
+        if not _warned:
+            logger.warning('hdf5_storage: this hdfaccess cannot take dataset settings; using its defaults')
+            _warned.append(True)
+        hfile.set_param(param)
+
+
+### benchmark
+def _file_mb(path):
+    return os.path.getsize(path)/1048576.
+
+
+def benchmark(hdf5_path, policies=None, repeat=3, probe=None):
+    '''write the flight in hdf5_path with each policy and read it back.
+       policies: {label: StoragePolicy or None}; probe: series name for the one-series read.
+       returns {label: (write s, read all s, read one s, MB)}'''
+    import staged_helper
+    from hdfaccess.file import hdf_file
+    if policies is None:
+        policies = {}
+        for compression in sorted(FILTERS):
+            policies[compression] = StoragePolicy(compression)
+        policies['lzf, plain masks'] = StoragePolicy('lzf', compact_masks=False)
+    if None not in policies.values():
+        policies['hdfaccess'] = None  # the reference for sizes
+    flight = staged_helper.Flight()
+    flight.load_from_hdf5({'filepath': hdf5_path, 'aircraft_info': {}})
+    probe = probe or sorted(flight.parameters.keys(), key=lambda k: -len(flight.parameters[k].array))[0]
+    work_dir = tempfile.mkdtemp(prefix='fds_storage')
+    results = {}
+    try:
+        for label, policy in sorted(policies.items()):
+            path = os.path.join(work_dir, 'policy.hdf5')
+            write = read_all = read_one = 0.0
+            for i in xrange(repeat):
+                if os.path.exists(path):
+                    os.remove(path)
+                start = time.time()
+                flight.save_to_hdf5(path, storage=policy)
+                write += time.time() - start
+                start = time.time()
+                staged_helper.Flight().load_from_hdf5({'filepath': path, 'aircraft_info': {}})
+                read_all += time.time() - start
+                start = time.time()
+                with hdf_file(path) as ff:
+                    ff.get_param(probe, valid_only=False)
+                read_one += time.time() - start
+            results[label] = (write/repeat, read_all/repeat, read_one/repeat, _file_mb(path))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print '%s: %d series, %.1f MB as found; one-series read of %s' % (
+        os.path.basename(hdf5_path), len(flight.parameters), _file_mb(hdf5_path), probe)
+    default_mb = [results[label][3] for label in sorted(results) if policies[label] is None][0]
+    print '%-20s %9s %9s %9s %9s %11s' % ('policy', 'write s', 'read s', 'one s', 'MB', 'vs default')
+    for label, (write, read_all, read_one, mb) in sorted(results.items(), key=lambda item: item[1][3]):
+        print '%-20s %9.3f %9.3f %9.4f %9.1f %10.0f%%' % (label, write, read_all, read_one, mb,
+                                                          100.*mb/default_mb if default_mb else 0.)
+    return results
+
+
+if __name__=='__main__':
+    import sys
+    logging.basicConfig(level=logging.WARNING)
+    if len(sys.argv) > 1:
+        paths = sys.argv[1:]
+    else:  # no real flight given: a 4 hour synthetic one
+        import bench_pipeline
+        paths = [bench_pipeline.synthetic_flight(os.path.join(tempfile.mkdtemp(), 'synthetic.hdf5'), 4*3600, 300)]
+    for path in paths:
+        benchmark(path)
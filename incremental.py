@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-analysis
+
+After a run, the raw result of every node derived for a flight is stored with
+the node's fingerprint (node_fingerprint.node_fingerprints: its class source
+plus, transitively, its dependencies').  On the next run of the same profile
+over the same, unchanged file, derive_parameters_series re-uses each stored
+result whose fingerprint still matches, so only changed nodes and their
+descendants are derived again.
+
+One file per profile and flight:  <store_dir>/<profile>/<sha1 of source path>.pkl
+holding one pickle per node result, then a pickled index {name: (fingerprint,
+offset, length)} and the index's offset.  Results are written to the next
+run's file as they are recorded and read from the last one only when re-used,
+so neither run's results are held in memory as a whole.
+"""
+import os
+import struct
+import hashlib
+import logging
+import threading
+import cPickle as pickle
+
+import node_fingerprint
+
+logger = logging.getLogger(__name__)
+
+STORE_VERSION = 2   # 2: one pickle per node and an index, instead of one pickle of all nodes
+TRAILER = struct.Struct('<Q')  # offset of the index, at the end of the file
+
+_fingerprints = {}  # id(derived_nodes) -> (derived_nodes, {name: fingerprint}), one per process
+
+
+def fingerprints_for(derived_nodes):
+    '''node_fingerprints(derived_nodes), computed once per node dict'''
+    cached = _fingerprints.get(id(derived_nodes))
+    if cached is None or cached[0] is not derived_nodes:
+        cached = (derived_nodes, node_fingerprint.node_fingerprints(derived_nodes))
+        _fingerprints[id(derived_nodes)] = cached
+    return cached[1]
+
+
+def _source_stamp(source_path):
+    st = os.stat(source_path)
+    return (st.st_size, st.st_mtime)
+
+
+class IncrementalResults(object):
+    '''stored node results for one flight and profile; see module docstring'''
+    def __init__(self, store_dir, profile, source_path, fingerprints):
+        self.source_path = source_path
+        self.fingerprints = fingerprints
+        folder = os.path.join(store_dir, profile)
+        if not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:  # another worker made it
+                pass
+        self.path = os.path.join(folder, hashlib.sha1(os.path.abspath(source_path)).hexdigest() + '.pkl')
+        self.stored = {}    # name -> (fingerprint, offset, length) in the last run's file
+        self.current = {}   # name -> (fingerprint, offset, length) in this run's spool file
+        self.reused = 0
+        self.derived = 0
+        self._stored_file = None
+        self._spool = None
+        self._spool_path = self.path + '.tmp%d' % os.getpid()
+        self._lock = threading.Lock()  # lookups come from derive threads, records from the committing one
+        self.load()
+
+    def load(self):
+        '''read the index of the stored results, ignoring them if the source file changed or they are unreadable'''
+        if not os.path.exists(self.path):
+            return
+        f = open(self.path, 'rb')
+        try:
+            f.seek(-TRAILER.size, os.SEEK_END)
+            index_offset, = TRAILER.unpack(f.read(TRAILER.size))
+            f.seek(index_offset)
+            stored = pickle.load(f)
+        except Exception:
+            logger.warning('incremental: ignoring unreadable ' + self.path)
+            f.close()
+            return
+        if stored.get('version') != STORE_VERSION or stored.get('source_path') != self.source_path:
+            f.close()
+            return
+        if stored.get('source') != _source_stamp(self.source_path):
+            logger.info('incremental: source changed, deriving all nodes for ' + self.source_path)
+            f.close()
+            return
+        self.stored = stored['nodes']
+        self._stored_file = f
+
+    def _append(self, name, fingerprint, data):
+        if self._spool is None:
+            self._spool = open(self._spool_path, 'wb')
+        offset = self._spool.tell()
+        self._spool.write(data)
+        self.current[name] = (fingerprint, offset, len(data))
+
+    def lookup(self, name):
+        '''the stored result for name if its fingerprint is unchanged, else None'''
+        entry = self.stored.get(name)
+        fingerprint = self.fingerprints.get(name)
+        if entry is None or fingerprint is None or entry[0] != fingerprint:
+            return None
+        with self._lock:
+            self._stored_file.seek(entry[1])
+            data = self._stored_file.read(entry[2])
+            try:
+                result = pickle.loads(data)
+            except Exception:
+                logger.warning('incremental: cannot read %s from %s', name, self.path)
+                return None
+            self._append(name, fingerprint, data)
+        self.reused += 1
+        return result
+
+    def record(self, name, result):
+        '''write a freshly derived node result to this run's spool file; nothing of it is kept here'''
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._append(name, self.fingerprints.get(name), data)
+        self.derived += 1
+
+    def save(self):
+        '''make this run's results (re-used and derived) the stored ones, in place of the last run's'''
+        with self._lock:
+            if self._spool is None:
+                self._spool = open(self._spool_path, 'wb')
+            index_offset = self._spool.tell()
+            pickle.dump({'version': STORE_VERSION, 'source_path': self.source_path,
+                         'source': _source_stamp(self.source_path), 'nodes': self.current},
+                        self._spool, pickle.HIGHEST_PROTOCOL)
+            self._spool.write(TRAILER.pack(index_offset))
+            self._spool.close()
+            self._spool = None
+            self._close_stored()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self._spool_path, self.path)
+        logger.info('incremental: %s re-used %d, derived %d nodes', os.path.basename(self.source_path),
+                    self.reused, self.derived)
+
+    def _close_stored(self):
+        if self._stored_file is not None:
+            self._stored_file.close()
+            self._stored_file = None
+        self.stored = {}
+
+    def close(self):
+        '''close the files; this run's results are discarded unless save() was called'''
+        with self._lock:
+            self._close_stored()
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+                os.remove(self._spool_path)
@@ -8,37 +8,181 @@ Goal: build airport and runway achieved flight record entries--
 Created on Thu Oct 10 15:27:25 2013
 @author: KEITHC
 """
-import pdb
+import os
+import time
+import hashlib
+import logging
 import cPickle as pickle
+from collections import OrderedDict
+import numpy as np
 import fds_oracle       
+import analyser_custom_settings
+
+logger = logging.getLogger(__name__)
+
+# Jeppesen cycle (YYMM) of the airport/runway data, and where its snapshot is kept
+CYCLE_NUM = getattr(analyser_custom_settings, 'APT_RWY_CYCLE', 1204)
+APT_RWY_CACHE_PATH = getattr(analyser_custom_settings, 'APT_RWY_CACHE_PATH', None)
+SNAPSHOT_MAGIC = 'ASIAS-APTRWY-SNAPSHOT\n'
+SNAPSHOT_VERSION = 3   # bump when the layout or content of apt_dict or apt_rwy_dict changes
+                       # 2: S/W coordinates signed as a whole, not just their degrees
+                       # 3: runway 'start' is the runway's own threshold, 'end' the opposite one
 
 def jeplat2dd(jeplat):
     ns = jeplat[0]
     sign = 1.0 if ns=='N' else -1.0
     dms=jeplat[1:].split('-')
-    dd = sign* int(dms[0]) + float(dms[1])/60. + float(dms[2])/3600. 
+    dd = sign*(int(dms[0]) + float(dms[1])/60. + float(dms[2])/3600.)
     return dd
     
 def jeplon2dd(jeplon):
     ns = jeplon[0]
     sign = 1.0 if ns=='E' else -1.0
     dms=jeplon[1:].split('-')
-    dd = sign* int(dms[0]) + float(dms[1])/60. + float(dms[2])/3600. 
+    dd = sign*(int(dms[0]) + float(dms[1])/60. + float(dms[2])/3600.)
     return dd
-    
-def rows_to_dict_list(cursor):
-    columns = [i[0] for i in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor]
 
 
-def get_apt_dict(cur):
+### vectorized DMS parsing
+def _as_bytes_matrix(values):
+    '''(n, width) uint8 matrix of stripped strings; None becomes an empty string'''
+    arr = np.asarray(values)
+    if arr.dtype.kind != 'S':  # e.g. an object column from a cursor fetch
+        arr = np.array(['' if v is None else (v.encode('ascii', 'replace') if isinstance(v, unicode) else str(v))
+                        for v in arr.ravel()], dtype=np.string_)
+    def as_matrix(a):
+        width = max(a.dtype.itemsize, 1)
+        return np.frombuffer(a.astype('S%d' % width).tostring(), dtype=np.uint8).reshape(len(a), width)
+    arr = arr.ravel()
+    b = as_matrix(arr)
+    if (b == ord(' ')).any():  # e.g. char columns padded with blanks
+        b = as_matrix(np.char.strip(arr))
+    return b
+
+
+def _digits_value(block):
+    '''value of rows of ascii digit columns as one integer per row, and whether they are all digits'''
+    ok = ((block >= ord('0')) & (block <= ord('9'))).all(1)
+    powers = 10.0**np.arange(block.shape[1]-1, -1, -1)
+    return np.dot(block.astype(np.float64) - ord('0'), powers), ok
+
+
+def jep2dd_array(values, positive, negative, limit):
+    '''decimal degrees and a validity mask for an array of 'N40-41-32.99' style strings.
+       Same arithmetic as jeplat2dd/jeplon2dd.
+       Invalid entries (format, hemisphere letter, |dd| > limit) are NaN and False in the mask.
+    '''
+    b = _as_bytes_matrix(values)
+    n, width = b.shape
+    is_dash = b == ord('-')
+    is_dot = b == ord('.')
+    d1 = np.argmax(is_dash, axis=1)
+    d2 = width - 1 - np.argmax(is_dash[:, ::-1], axis=1)
+    end = (b != 0).sum(1)
+    dot = np.where(is_dot.any(1), width - 1 - np.argmax(is_dot[:, ::-1], axis=1), end)
+    dot = np.where(dot > d2, dot, end)  # a '.' before the seconds fails the digit checks below
+    dd = np.empty(n)
+    dd.fill(np.nan)
+    valid = np.zeros(n, dtype=bool)
+
+    # the data comes in a few fixed layouts: parse each as column blocks
+    layout = ((d1.astype(np.int64)*(width+1) + d2)*(width+1) + dot)*(width+1) + end
+    layouts, layout_of_row = np.unique(layout, return_inverse=True)
+    for k, key in enumerate(layouts):
+        key, pend = divmod(key, width+1)
+        key, pdot = divmod(key, width+1)
+        p1, p2 = divmod(key, width+1)
+        if not 1 < p1 < p2-1 or (pdot == pend and pend <= p2+1):  # an empty field
+            continue
+        rows = np.flatnonzero(layout_of_row == k)
+        block = b[rows]
+        degrees, ok = _digits_value(block[:, 1:p1])
+        minutes, ok_min = _digits_value(block[:, p1+1:p2])
+        # integer mantissa, then one division by 10**decimals: the same rounding as float()
+        mantissa, ok_sec = _digits_value(np.hstack((block[:, p2+1:pdot], block[:, pdot+1:pend])))
+        seconds = mantissa / 10.0**max(pend-pdot-1, 0)
+        hemisphere = block[:, 0]
+        sign = np.where(hemisphere == ord(positive), 1.0, -1.0)
+        dd[rows] = sign*(degrees + minutes/60. + seconds/3600.)
+        valid[rows] = ok & ok_min & ok_sec & (is_dash[rows].sum(1) == 2) & \
+                      ((hemisphere == ord(positive)) | (hemisphere == ord(negative)))
+    with np.errstate(invalid='ignore'):
+        valid &= np.abs(dd) <= limit
+    dd[~valid] = np.nan
+    return dd, valid
+
+
+def jeplat2dd_array(values):
+    '''vectorized jeplat2dd: (float array, valid mask)'''
+    return jep2dd_array(values, 'N', 'S', 90.0)
+
+
+def jeplon2dd_array(values):
+    '''vectorized jeplon2dd: (float array, valid mask)'''
+    return jep2dd_array(values, 'E', 'W', 180.0)
+
+
+def _checked(dd, valid, raw, what, key):
+    '''python floats, None (with a warning) where invalid'''
+    for i in np.flatnonzero(~valid):
+        logger.warning('bad %s %r for %s', what, raw[i], key[i])
+    return [float(v) if ok else None for v, ok in zip(dd, valid)]
+
+
+def synthetic_dms(n, seed=0):
+    '''n random latitude and longitude strings in Jeppesen format, for benchmarks'''
+    r = np.random.RandomState(seed)
+    def fmt(hem, deg, width):
+        return ['%s%0*d-%02d-%05.2f' % (h, width, d, m, s) for h, d, m, s in
+                zip(hem, deg, r.randint(0, 60, n), r.uniform(0, 59.99, n))]
+    lats = fmt(r.choice(['N', 'S'], n), r.randint(0, 90, n), 2)
+    lons = fmt(r.choice(['E', 'W'], n), r.randint(0, 180, n), 3)
+    return lats, lons
+
+
+def benchmark_dms(lats, lons, repeat=3):
+    '''seconds for the scalar and vectorized converters over the same columns; checks they agree'''
+    timings = {}
+    for label, convert in (('scalar', lambda: ([jeplat2dd(v) for v in lats], [jeplon2dd(v) for v in lons])),
+                           ('vectorized', lambda: (jeplat2dd_array(lats)[0], jeplon2dd_array(lons)[0]))):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            result = convert()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[label] = (best, result)
+    for scalar, vectorized in zip(timings['scalar'][1], timings['vectorized'][1]):
+        assert np.array_equal(np.array(scalar), vectorized), 'scalar and vectorized DMS parsing differ'
+    print '%d values: scalar %.4f s, vectorized %.4f s' % (len(lats)+len(lons), timings['scalar'][0], timings['vectorized'][0])
+    return timings['scalar'][0], timings['vectorized'][0]
+
+
+FETCH_ARRAYSIZE = 5000  # rows per fetchmany round trip
+
+def fetch_chunks(cur, sql, binds, arraysize=FETCH_ARRAYSIZE):
+    '''execute sql; returns ({column name: position}, generator of fetchmany row chunks)
+       so rows can be grouped as they arrive instead of all being turned into dicts first'''
+    cur.arraysize = arraysize
+    cur.execute(sql, binds)
+    col = OrderedDict((d[0], i) for i, d in enumerate(cur.description))
+    def chunks():
+        while True:
+            rows = cur.fetchmany(arraysize)
+            if not rows:
+                return
+            yield rows
+    return col, chunks()
+
+
+def get_apt_dict(cur, cycle_num=CYCLE_NUM):
     '''build apt afrs in a dictionary keyed by ICAO id, with entries like:
     {
      'code': {'icao': 'KEWR', 'iata': ''}, 'icao': 'KEWR', 
      'name': 'NEWARK LIBERTY INTL', 
      'update_month': 1204, 'region': 'USA', 
-     'APT_LONGITUDE': 'W074-10-07.18', 'longitude': -73.83055555555555, 
-     'APT_LATITUDE':  'N40-41-32.99',  'latitude': 40.69472222222222, 
+     'APT_LONGITUDE': 'W074-10-07.18', 'longitude': -74.16866111111111, 
+     'APT_LATITUDE':  'N40-41-32.99',  'latitude': 40.69249722222222, 
      'elevation': '18', 
      'magnetic_variation': 'W013.0', 
    }
@@ -52,27 +196,27 @@ def get_apt_dict(cur):
                        apt_mag_var as "magnetic_variation",    
                        ap.cycle_num as "update_month"
                 from crs_prod.jep_ge_apt@crsprod ap
-                where cycle_num=1204'''
+                where cycle_num=:cycle_num'''
                     
-    cur.execute(apt_sql)
-    apt_dictlist = rows_to_dict_list(cur)
+    col, chunks = fetch_chunks(cur, apt_sql, {'cycle_num': cycle_num})
+    names = col.keys()
+    icao_i, lat_i, lon_i = col['icao'], col['APT_LATITUDE'], col['APT_LONGITUDE']
     apt_dict = {}
-    for apd in apt_dictlist:
-        icao = apd['icao']
-        apd['code'] = {'icao':icao, 'iata':''}
-        apd['latitude']= jeplat2dd(apd['APT_LATITUDE'])
-        apd['longitude']= jeplon2dd(apd['APT_LONGITUDE'])
-        if apd['latitude']<-90.0 or apd['latitude']>90.0:
-            print "BAD LAT!!!", icao, apd['latitude']
-            pdb.set_trace()
-        if apd['longitude']<-180.0 or apd['longitude']>180.0:
-            print "BAD LON!!!", icao, apd['longitude']
-            pdb.set_trace()
-            
-        apt_dict[icao] = apd
+    for rows in chunks:
+        icaos = [row[icao_i] for row in rows]
+        raw_lats = [row[lat_i] for row in rows]
+        raw_lons = [row[lon_i] for row in rows]
+        lats = _checked(*jeplat2dd_array(raw_lats), raw=raw_lats, what='airport latitude', key=icaos)
+        lons = _checked(*jeplon2dd_array(raw_lons), raw=raw_lons, what='airport longitude', key=icaos)
+        for row, icao, lat, lon in zip(rows, icaos, lats, lons):
+            apd = dict(zip(names, row))
+            apd['code'] = {'icao':icao, 'iata':''}
+            apd['latitude']= lat
+            apd['longitude']= lon
+            apt_dict[icao] = apd
     return apt_dict
 
-def get_runways(cur):
+def get_runways(cur, cycle_num=CYCLE_NUM):
     ''' AFR runways: need to pull together start and end of each. Example:
       URL: 'https://polaris-test.flightdataservices.com/api/airport/2744/runway/nearest.json?ll=40.683101%2C-74.171306&heading=37.265625'
       Response: {
@@ -101,7 +245,7 @@ def get_runways(cur):
         (
         select *
             from crs_prod.jep_ge_rwy@crsprod rwy
-            where cycle_num=1204 
+            where cycle_num=:cycle_num 
           ---rwy_apt_id ='KEWR' and --data_year>=2011 
         ) rw left join
         (
@@ -119,31 +263,34 @@ def get_runways(cur):
         'RWY_LANDING_THRESHOLD_ELEV': '636', 'RWY_THRESHOLD_DISTANCE': '0', 
         'SURFACE': None, 'RWY_WIDTH': None}'''
         
-    cur.execute(rwy_sql)
-    rwy_dictlist = rows_to_dict_list(cur)                
-    #group runways by apt
+    col, chunks = fetch_chunks(cur, rwy_sql, {'cycle_num': cycle_num})
+    apt_i, rwy_i, cycle_i = col['RWY_APT_ID'], col['RWY_ID'], col['CYCLE_NUM']
+    lat_i, lon_i, bearing_i = col['RWY_LATITUDE'], col['RWY_LONGITUDE'], col['RWY_MAG_BEARING']
+    width_i, length_i = col['WIDTH'], col['RWY_LENGTH']
+    #group runways by apt, a chunk at a time
     apt_rwy = {}        
-    for rw in rwy_dictlist:
-        apid  = rw['RWY_APT_ID']
-        #if apid=='KGAD':
-        #   pdb.set_trace()
-        apd = apt_rwy[apid] if apt_rwy.has_key(apid) else {} #apt group of rwy dicts
-        
-        rwd = {}
-        rwid = rw['RWY_ID'][2:].strip()        
-        rwd['identifier']=rwid        
-        rwd['id']=None
-        rwd['cycle_num']=rw['CYCLE_NUM']
-        rwd['magnetic_heading'] = rw['RWY_MAG_BEARING']
-        
-        rwd['RWY_LATITUDE']=rw['RWY_LATITUDE']
-        rwd['RWY_LONGITUDE']=rw['RWY_LONGITUDE']
-        end_lat=jeplat2dd(rw['RWY_LATITUDE'])
-        end_lon=jeplon2dd(rw['RWY_LONGITUDE'])
-        rwd['end'] = {'latitude':end_lat, 'longitude':end_lon}
-        rwd['strip'] = {'width':rw['WIDTH'], 'length':rw['RWY_LENGTH'], 'id':None, 'surface':None}
-        apd[rwid] = rwd #add runway dict to apt grouping
-        apt_rwy[apid]=apd
+    for rows in chunks:
+        rwy_keys = [(row[apt_i], row[rwy_i]) for row in rows]
+        raw_lats = [row[lat_i] for row in rows]
+        raw_lons = [row[lon_i] for row in rows]
+        start_lats = _checked(*jeplat2dd_array(raw_lats), raw=raw_lats, what='runway latitude', key=rwy_keys)
+        start_lons = _checked(*jeplon2dd_array(raw_lons), raw=raw_lons, what='runway longitude', key=rwy_keys)
+        for rw, start_lat, start_lon in zip(rows, start_lats, start_lons):
+            apid  = rw[apt_i]
+            apd = apt_rwy.setdefault(apid, {}) #apt group of rwy dicts
+            
+            rwd = {}
+            rwid = rw[rwy_i][2:].strip()        
+            rwd['identifier']=rwid        
+            rwd['id']=None
+            rwd['cycle_num']=rw[cycle_i]
+            rwd['magnetic_heading'] = rw[bearing_i]
+            
+            rwd['RWY_LATITUDE']=rw[lat_i]
+            rwd['RWY_LONGITUDE']=rw[lon_i]
+            rwd['start'] = {'latitude':start_lat, 'longitude':start_lon} #threshold of this runway
+            rwd['strip'] = {'width':rw[width_i], 'length':rw[length_i], 'id':None, 'surface':None}
+            apd[rwid] = rwd #add runway dict to apt grouping
     return apt_rwy
     
 
@@ -158,8 +305,8 @@ def opposite_runway(rwid):
     oppid = '0'+str(oppdir)+oppsfx if oppdir<10 else str(oppdir)+oppsfx
     return oppid        
 
-def add_start(apt_rwy):
-    #add start lat/lon using opposite direction : populate in 2nd pass
+def add_end(apt_rwy):
+    #add end lat/lon using opposite direction's threshold : populate in 2nd pass
     for apt, aprwys in apt_rwy.items():
         #aprwys is a group of rwy dicts for a given airport
         for rw in aprwys.values():
@@ -167,15 +314,15 @@ def add_start(apt_rwy):
             oppid = opposite_runway(rwid)
             opprw= aprwys.get(oppid) #get rwy dict for opposite direction rwy
             if opprw:
-                rw['start'] = {'latitude':opprw['end']['latitude'], 'longitude':opprw['end']['longitude']}
+                rw['end'] = {'latitude':opprw['start']['latitude'], 'longitude':opprw['start']['longitude']}
             else:
-                rw['start'] = {'latitude':None, 'longitude':None}
+                rw['end'] = {'latitude':None, 'longitude':None}
             if  rw['start']['latitude']==rw['end']['latitude'] and rw['start']['longitude']==rw['end']['longitude']:
                 print 'same start and end loc',apt, rwid, oppid                
                 #pdb.set_trace()
     return apt_rwy
     
-def add_ils(cur, apt_rwy):
+def add_ils(cur, apt_rwy, cycle_num=CYCLE_NUM):
     '''add glideslope and localizer dicts'''
     ils_sql = '''select ge.*, 
                        glideslopelatitude, glideslopelongitude, gs_threshold_distance,
@@ -193,7 +340,7 @@ def add_ils(cur, apt_rwy):
                                    ILS_LOC_LATITUDE,      --localizer|latitude (convert dms)
                                    ILS_LOC_LONGITUDE     --localizer|longitude (convert dms)   
                             from crs_prod.jep_ge_ils@crsprod
-                            where cycle_num=1204 
+                            where cycle_num=:cycle_num 
                             --      and ils_apt_id ='KDTW'
                 ) ge
                 left join
@@ -209,9 +356,7 @@ def add_ils(cur, apt_rwy):
                  on jo.jepcode=ge.ils_apt_id and trim(jo.runwayid)=trim(ge.ils_runway_id)
                  '''
  
-    cur.execute(ils_sql)
-    ils_dictlist = rows_to_dict_list(cur)
-    print ils_dictlist[0]
+    col, chunks = fetch_chunks(cur, ils_sql, {'cycle_num': cycle_num})
     '''{'ILS_APT_ID': 'KDTW', 'ILS_RUNWAY_ID': 'RW04L', 'CYCLE_NUM': 1204, 
         'ILS_LOC_LATITUDE': 'N42-13-43.23', 'ILS_LOC_LONGITUDE': 'W083-21-52.16', 
         'LOCALIZERWIDTH': 0.0, 'ILS_LOC_FREQ': '111.95', 
@@ -225,42 +370,112 @@ def add_ils(cur, apt_rwy):
      #'glideslope': {'latitude': 40.682664, 'longitude': -74.169414, 
      #                 'angle': 3.0, 'threshold_distance': 1060}, 
 
-    for ils in ils_dictlist:
-        #aprwys is a group of rwy dicts for a given airport
-        apid = ils['ILS_APT_ID']
-        rwid = ils['ILS_RUNWAY_ID'][2:]
-        #print 'add ils: ', apid, rwid
-        loc = { 'latitude':   jeplat2dd(ils['ILS_LOC_LATITUDE']), 
-                'longitude':  jeplon2dd(ils['ILS_LOC_LONGITUDE']), 
-                'frequency':  float(ils['ILS_LOC_FREQ'])*1000.0, 
-                'heading':    int(float(ils['ILS_BEARING'])), 
-                'beam_width': ils['LOCALIZERWIDTH'] 
-              }   
-        try:
-            gs_angle = float(ils['ILS_GLIDE_SLOPE_ANGLE']) 
-        except: 
-            #print 'bad angle', ils['ILS_GLIDE_SLOPE_ANGLE']
-            gs_angle = None
-        gs =  { 'latitude':  ils['GLIDESLOPELATITUDE'],
-                'longitude': ils['GLIDESLOPELONGITUDE'],
-
-                'angle': gs_angle, 
-                'threshold_distance': ils['GS_THRESHOLD_DISTANCE']
-              }
-        if apt_rwy.has_key(apid) and apt_rwy[apid].has_key(rwid):
-            apt_rwy[apid][rwid]['localizer']=loc
-            apt_rwy[apid][rwid]['glideslope']=gs    
-        else:
-            print 'not found in apt_rwy', apid, rwid
+    apt_i, rwy_i = col['ILS_APT_ID'], col['ILS_RUNWAY_ID']
+    lat_i, lon_i = col['ILS_LOC_LATITUDE'], col['ILS_LOC_LONGITUDE']
+    freq_i, bearing_i, width_i = col['ILS_LOC_FREQ'], col['ILS_BEARING'], col['LOCALIZERWIDTH']
+    angle_i, gs_lat_i, gs_lon_i = col['ILS_GLIDE_SLOPE_ANGLE'], col['GLIDESLOPELATITUDE'], col['GLIDESLOPELONGITUDE']
+    gs_dist_i = col['GS_THRESHOLD_DISTANCE']
+    for rows in chunks:
+        ils_keys = [(ils[apt_i], ils[rwy_i]) for ils in rows]
+        raw_lats = [ils[lat_i] for ils in rows]
+        raw_lons = [ils[lon_i] for ils in rows]
+        loc_lats = _checked(*jeplat2dd_array(raw_lats), raw=raw_lats, what='localizer latitude', key=ils_keys)
+        loc_lons = _checked(*jeplon2dd_array(raw_lons), raw=raw_lons, what='localizer longitude', key=ils_keys)
+        for ils, loc_lat, loc_lon in zip(rows, loc_lats, loc_lons):
+            #aprwys is a group of rwy dicts for a given airport
+            apid = ils[apt_i]
+            rwid = ils[rwy_i][2:]
+            loc = { 'latitude':   loc_lat, 
+                    'longitude':  loc_lon, 
+                    'frequency':  float(ils[freq_i])*1000.0, 
+                    'heading':    int(float(ils[bearing_i])), 
+                    'beam_width': ils[width_i] 
+                  }   
+            try:
+                gs_angle = float(ils[angle_i]) 
+            except: 
+                gs_angle = None
+            gs =  { 'latitude':  ils[gs_lat_i],
+                    'longitude': ils[gs_lon_i],
+                    'angle': gs_angle, 
+                    'threshold_distance': ils[gs_dist_i]
+                  }
+            if apt_rwy.has_key(apid) and apt_rwy[apid].has_key(rwid):
+                apt_rwy[apid][rwid]['localizer']=loc
+                apt_rwy[apid][rwid]['glideslope']=gs    
+            else:
+                print 'not found in apt_rwy', apid, rwid
     
     return apt_rwy
 
-def get_apt_rwy_dict(cur):
-    apt_rwy = get_runways(cur)          
-    apt_rwy = add_start( apt_rwy)        
-    apt_rwy = add_ils(cur, apt_rwy)        
+def get_apt_rwy_dict(cur, cycle_num=CYCLE_NUM):
+    apt_rwy = get_runways(cur, cycle_num)          
+    apt_rwy = add_end( apt_rwy)        
+    apt_rwy = add_ils(cur, apt_rwy, cycle_num)        
     return apt_rwy
 
+
+### snapshot cache
+def snapshot_path(cache_dir, cycle_num=CYCLE_NUM):
+    return os.path.join(cache_dir, 'apt_rwy_%s.snapshot' % cycle_num)
+
+
+def save_snapshot(cache_dir, apt_dict, apt_rwy_dict, cycle_num=CYCLE_NUM):
+    '''write apt_dict and apt_rwy_dict for cycle_num, with a version, length and sha1 header'''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    payload = pickle.dumps((apt_dict, apt_rwy_dict), pickle.HIGHEST_PROTOCOL)
+    header = '%d %s %d %s\n' % (SNAPSHOT_VERSION, cycle_num, len(payload), hashlib.sha1(payload).hexdigest())
+    path = snapshot_path(cache_dir, cycle_num)
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + header + payload)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+    return path
+
+
+def load_snapshot(cache_dir, cycle_num=CYCLE_NUM):
+    '''(apt_dict, apt_rwy_dict) for cycle_num, or None if there is no snapshot or it does not verify'''
+    path = snapshot_path(cache_dir, cycle_num)
+    try:
+        with open(path, 'rb') as f:
+            magic = f.read(len(SNAPSHOT_MAGIC))
+            header = f.readline().split()
+            payload = f.read()
+    except IOError:
+        return None
+    if magic != SNAPSHOT_MAGIC or len(header) != 4 or header[0] != str(SNAPSHOT_VERSION) or header[1] != str(cycle_num):
+        logger.warning('apt/rwy snapshot: ignoring %s, wrong version or cycle', path)
+        return None
+    if int(header[2]) != len(payload) or hashlib.sha1(payload).hexdigest() != header[3]:
+        logger.warning('apt/rwy snapshot: ignoring corrupt %s', path)
+        return None
+    return pickle.loads(payload)
+
+
+def cached_apt_rwy(cn, cache_dir, cycle_num=CYCLE_NUM):
+    '''(apt_dict, apt_rwy_dict) from the snapshot for cycle_num, built from the database
+       through cn (and saved) if it is missing or invalid.
+       With no cache_dir this always queries; with no cn a missing snapshot gives empty dicts.
+    '''
+    if cache_dir:
+        snapshot = load_snapshot(cache_dir, cycle_num)
+        if snapshot is not None:
+            return snapshot
+    if cn is None:
+        logger.warning('apt/rwy snapshot: none for cycle %s, airport/runway attributes will be missing', cycle_num)
+        return {}, {}
+    cur = cn.cursor()
+    apt_dict = get_apt_dict(cur, cycle_num)
+    apt_rwy_dict = get_apt_rwy_dict(cur, cycle_num)
+    cur.close()
+    if cache_dir:
+        path = save_snapshot(cache_dir, apt_dict, apt_rwy_dict, cycle_num)
+        logger.warning('apt/rwy snapshot: saved ' + path)
+    return apt_dict, apt_rwy_dict
+
 ####################################################################
 if __name__=='__main__':
     mylat='N40-41-32.99'
@@ -273,7 +488,8 @@ if __name__=='__main__':
     print '36', opposite_runway('36')
     print '01', opposite_runway('01')
     print '18', opposite_runway('18')
-
+    print 'DMS parsing, synthetic:'
+    benchmark_dms(*synthetic_dms(100000))
 
     cn = fds_oracle.get_connection()
     print 'connected'
@@ -285,22 +501,24 @@ if __name__=='__main__':
     
     cur.close()
     cn.close()   
+    print 'DMS parsing, full airport and runway tables:'
+    benchmark_dms([apd['APT_LATITUDE'] for apd in apt_dict.values()] + 
+                  [rw['RWY_LATITUDE'] for rwys in apt_rwy.values() for rw in rwys.values()],
+                  [apd['APT_LONGITUDE'] for apd in apt_dict.values()] + 
+                  [rw['RWY_LONGITUDE'] for rwys in apt_rwy.values() for rw in rwys.values()])
     print apt_rwy['KEWR']['22R']
     '''
     {'identifier': '22R', 'id': None
-     'start': {'latitude': 40.67777777777778, 'longitude': -73.83055555555555}, 
-     'end': {'latitude': 40.69472222222222, 'longitude': -73.8475}, 
+     'start': {'latitude': 40.69472222222222, 'longitude': -74.1525}, 
+     'end': {'latitude': 40.67777777777778, 'longitude': -74.16944444444445}, 
      'cycle_num': 1204, 
      'localizer': {'latitude': 40.67777777777778, 'beam_width': 3.83, 'frequency': 110750.0, 
-                   'heading': 219, 'longitude': -73.83055555555555}, 
+                   'heading': 219, 'longitude': -74.16944444444445}, 
      'glideslope': {'latitude': 40.696388999999996, 'angle': 3.0, 'longitude': -74.165, 
                     'threshold_distance': 914}, 
       'magnetic_heading': '218.9', 
       'strip': {'width': 150, 'length': '11000', 'id': None, 'surface': None}, 
       }
     '''
-    with open('apt.pkl','wb') as fa:
-        pickle.dump(apt_dict, fa)
-    with open('apt_rwy.pkl','wb') as fr:        
-        pickle.dump(apt_rwy, fr)
+    print save_snapshot(APT_RWY_CACHE_PATH or '.', apt_dict, apt_rwy)
     print 'done'
\ No newline at end of file
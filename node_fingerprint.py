@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Fingerprints of the node modules used by an analysis
+
+Used as part of cache keys, so that anything cached for one version of the
+node code (dependency plans, precomputed parameters, stored results) is not
+reused once a node module changes.  node_fingerprints() goes down to single
+node classes for incremental re-analysis.
+"""
+import os
+import sys
+import inspect
+import hashlib
+
+from analysis_engine import __version__ as analyzer_version
+
+_file_digests = {}  # source path -> (mtime, size, sha1 hex)
+
+
+def file_digest(path):
+    '''sha1 of a file's contents, remembered while its mtime and size are unchanged'''
+    st = os.stat(path)
+    cached = _file_digests.get(path)
+    if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+        return cached[2]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    _file_digests[path] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+
+def module_digest(module_name):
+    '''sha1 of a module's source file, or of its name if the source cannot be found'''
+    module = sys.modules.get(module_name)
+    path = None
+    if module is not None:
+        try:
+            path = inspect.getsourcefile(module)
+        except TypeError:  # built-in
+            path = None
+    if not path or not os.path.exists(path):
+        return hashlib.sha1(module_name).hexdigest()
+    return file_digest(path)
+
+
+def node_modules(derived_nodes):
+    '''sorted names of the modules defining the node classes in a {name: class} dict'''
+    return sorted(set(cls.__module__ for cls in derived_nodes.values()))
+
+
+def module_fingerprint(derived_nodes):
+    '''one sha1 over the analyzer version and the source of every module defining a node in derived_nodes'''
+    sha = hashlib.sha1(analyzer_version)
+    for module_name in node_modules(derived_nodes):
+        sha.update(module_name)
+        sha.update(module_digest(module_name))
+    return sha.hexdigest()
+
+
+def class_source(node_class):
+    '''source of a node class, or of its whole module if the class source cannot be found'''
+    try:
+        return inspect.getsource(node_class)
+    except (IOError, TypeError):
+        return module_digest(node_class.__module__)
+
+
+def node_fingerprints(derived_nodes):
+    '''{node name: sha1 of its class source and, transitively, the fingerprints of its dependencies}
+       Recorded parameters (not in derived_nodes) contribute only their names, so changing one
+       node changes its own fingerprint and those of all its descendants.
+    '''
+    fingerprints = {}
+    in_progress = set()
+
+    def fingerprint(name):
+        if name in fingerprints:
+            return fingerprints[name]
+        node_class = derived_nodes.get(name)
+        if node_class is None or name in in_progress:  # recorded parameter, or a dependency loop
+            return 'hdf:' + name
+        in_progress.add(name)
+        sha = hashlib.sha1(analyzer_version)
+        sha.update(name)
+        sha.update(class_source(node_class))
+        for dep_name in sorted(node_class.get_dependency_names()):
+            sha.update(fingerprint(dep_name))
+        in_progress.discard(name)
+        fingerprints[name] = sha.hexdigest()
+        return fingerprints[name]
+
+    for name in derived_nodes:
+        fingerprint(name)
+    return fingerprints
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Per-node timing for derive_parameters_series
+
+A NodeProfiler passed to derive_parameters_series records, for every node it
+derives, the seconds spent in get_deps_series (gathering and aligning the
+dependencies), in derive and in post_process_node, and the bytes of the
+node's output array.
+
+Stats are a plain dict, so pool workers can send them back with a flight's
+status and run_analyzer can merge them over the run:
+
+    {node name: [node type, calls, deps seconds, derive seconds, post seconds, output bytes]}
+
+report() ranks nodes by total time; save() writes one row per node to
+fds_node_timing (see asias_fds_oracle.sql), next to fds_processing_time.
+Turn it on with run_analyzer(profile_nodes=True) or settings.PROFILE_NODES.
+"""
+import logging
+
+import fds_oracle
+
+logger = logging.getLogger(__name__)
+
+TYPE, CALLS, DEPS, DERIVE, POST, NBYTES = range(6)
+
+NODE_TIMING_SQL = '''insert into fds_node_timing (run_time, stage, profile, node_name, node_type, calls,
+                     deps_seconds, derive_seconds, post_seconds, total_seconds, output_mb)
+                     values (:run_time, :stage, :profile, :node_name, :node_type, :calls,
+                     :deps_seconds, :derive_seconds, :post_seconds, :total_seconds, :output_mb)'''
+
+
+class NodeProfiler(object):
+    '''see module docstring'''
+    def __init__(self, stats=None):
+        self.stats = stats if stats is not None else {}
+        self.flights = 0
+
+    def record(self, name, node_type, deps_seconds, derive_seconds, post_seconds, nbytes):
+        entry = self.stats.get(name)
+        if entry is None:
+            entry = self.stats[name] = [node_type, 0, 0.0, 0.0, 0.0, 0]
+        entry[CALLS] += 1
+        entry[DEPS] += deps_seconds
+        entry[DERIVE] += derive_seconds
+        entry[POST] += post_seconds
+        entry[NBYTES] += nbytes
+
+    def merge(self, stats):
+        '''add the stats of another profiler (e.g. one flight in a pool worker)'''
+        for name, other in stats.items():
+            entry = self.stats.get(name)
+            if entry is None:
+                self.stats[name] = list(other)
+            else:
+                for i in (CALLS, DEPS, DERIVE, POST, NBYTES):
+                    entry[i] += other[i]
+        self.flights += 1
+
+    def ranked(self):
+        '''[(name, entry)] by total seconds, slowest first'''
+        return sorted(self.stats.items(), key=lambda item: -(item[1][DEPS]+item[1][DERIVE]+item[1][POST]))
+
+    def report(self, top=40):
+        total = sum(e[DEPS]+e[DERIVE]+e[POST] for e in self.stats.values()) or 1.0
+        lines = ['%-48s %-22s %6s %9s %9s %9s %9s %6s %9s' % ('node', 'type', 'calls', 'deps s', 'derive s',
+                                                                'post s', 'total s', '%', 'out MB')]
+        for name, e in self.ranked()[:top]:
+            seconds = e[DEPS]+e[DERIVE]+e[POST]
+            lines.append('%-48s %-22s %6d %9.3f %9.3f %9.3f %9.3f %6.1f %9.1f' % (
+                name[:48], e[TYPE][:22], e[CALLS], e[DEPS], e[DERIVE], e[POST], seconds,
+                100.*seconds/total, e[NBYTES]/1048576.))
+        lines.append('%d nodes, %d flights, %.1f s in nodes' % (len(self.stats), self.flights, total))
+        return '\n'.join(lines)
+
+    def rows(self, run_time, stage, profile):
+        return [[run_time, stage, profile, name, e[TYPE], e[CALLS], e[DEPS], e[DERIVE], e[POST],
+                 e[DEPS]+e[DERIVE]+e[POST], e[NBYTES]/1048576.] for name, e in self.ranked()]
+
+    def save(self, cn, run_time, stage, profile):
+        '''one fds_node_timing row per node'''
+        rows = self.rows(run_time, stage, profile)
+        if rows:
+            fds_oracle.oracle_executemany(cn, NODE_TIMING_SQL, rows)
+        return len(rows)
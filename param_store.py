@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed store of precomputed (base-derived) parameters
+
+A base run stores the KPV, KTI, phase, approach and attribute nodes it derived
+for each output file.  Profiles over that file then start from these nodes
+instead of recomputing them; derived time series are not stored as they are
+already in the base hdf5.
+
+Entries are keyed by
+    sha1 of the source file contents + analyzer version + fingerprint of the FDS node modules
+so a changed file, a new analyzer or edited node code simply misses.
+Each entry carries its key and a payload checksum, and anything that does not
+verify is logged, removed and treated as a miss rather than loaded.
+
+Writers build an entry in a temporary file and rename it into place, so readers
+never see partial entries.  Hits touch the entry's mtime.  Each store keeps a
+running total of the bytes in the folder, from one scan plus its own writes;
+once that crosses max_bytes the folder is rescanned and the oldest entries are
+removed until it is under max_bytes (LRU).  Writes by other workers are only
+seen at a rescan, so with several workers the store may overshoot max_bytes
+until one of them rescans.
+"""
+import os
+import hashlib
+import logging
+import cPickle as pickle
+
+from analysis_engine import settings
+from analysis_engine.node import DerivedParameterNode
+from analysis_engine.process_flight import get_derived_nodes
+
+import node_fingerprint
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 'ASIAS-PARAMSTORE-1\n'
+ENTRY_SUFFIX = '.params'
+
+_stores = {}  # (store_dir, max_bytes) -> ParamStore, one per process
+
+
+class ParamStore(object):
+    '''see module docstring'''
+    def __init__(self, store_dir, max_bytes=None):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.digest_dir = os.path.join(store_dir, 'digests')
+        for folder in (store_dir, self.digest_dir):
+            if not os.path.exists(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:  # another worker made it
+                    pass
+        base_nodes = get_derived_nodes(settings.NODE_MODULES)
+        self.node_names = frozenset(base_nodes.keys())
+        self.fingerprint = node_fingerprint.module_fingerprint(base_nodes)
+        self.hits = 0
+        self.misses = 0
+        self.invalid = 0
+        self.size = None  # running total of entry bytes, None until the first scan
+
+    ### keys
+    def source_digest(self, source_path):
+        '''sha1 of a source file's contents, remembered on disk by path, size and mtime'''
+        st = os.stat(source_path)
+        stamp = '%d %r' % (st.st_size, st.st_mtime)
+        memo = os.path.join(self.digest_dir, hashlib.sha1(os.path.abspath(source_path)).hexdigest())
+        try:
+            with open(memo) as f:
+                memo_stamp, digest = f.read().rsplit(' ', 1)
+            if memo_stamp == stamp:
+                return digest
+        except (IOError, ValueError):
+            pass
+        digest = node_fingerprint.file_digest(source_path)
+        self._write_atomic(memo, stamp + ' ' + digest)
+        return digest
+
+    def key(self, source_path):
+        return hashlib.sha1(' '.join([self.source_digest(source_path),
+                                      node_fingerprint.analyzer_version,
+                                      self.fingerprint])).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.store_dir, key + ENTRY_SUFFIX)
+
+    ### read / write
+    def _write_atomic(self, path, data):
+        tmp = path + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(tmp, path)
+        except OSError:  # on Windows the target exists: same key, same content
+            os.remove(tmp)
+
+    def _discard(self, path, reason):
+        logger.warning('param_store: skipping %s entry %s', reason, path)
+        self.invalid += 1
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, key):
+        '''dict of stored nodes for key, or None if missing or invalid'''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                magic = f.read(len(MAGIC))
+                header = f.readline().split()
+                payload = f.read()
+        except IOError:  # missing, or evicted by another process
+            self.misses += 1
+            return None
+        if magic != MAGIC or len(header) != 3 or header[0] != key:
+            self._discard(path, 'bad header')
+            return None
+        if int(header[1]) != len(payload) or hashlib.sha1(payload).hexdigest() != header[2]:
+            self._discard(path, 'corrupt')
+            return None
+        try:
+            params = pickle.loads(payload)
+        except Exception:
+            self._discard(path, 'unreadable')
+            return None
+        try:
+            os.utime(path, None)  # most recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return params
+
+    def put(self, key, params):
+        '''store the base-derived, non time series nodes in params under key'''
+        stored = {}
+        for name in params.keys():
+            if name not in self.node_names:
+                continue
+            value = params[name]
+            if isinstance(value, DerivedParameterNode):
+                continue
+            stored[name] = value
+        payload = pickle.dumps(stored, pickle.HIGHEST_PROTOCOL)
+        header = '%s %d %s\n' % (key, len(payload), hashlib.sha1(payload).hexdigest())
+        self._write_atomic(self._path(key), MAGIC + header + payload)
+        if self.size is not None:
+            self.size += len(MAGIC) + len(header) + len(payload)
+        if self.size is None or (self.max_bytes and self.size > self.max_bytes):
+            self.evict()
+        return stored
+
+    def evict(self):
+        '''rescan the store and remove least recently used entries until it is within max_bytes'''
+        if not self.max_bytes:
+            return
+        entries = []
+        for fname in os.listdir(self.store_dir):
+            if not fname.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.store_dir, fname))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum(e[1] for e in entries)
+        for mtime, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.store_dir, fname))
+            except OSError:  # already evicted by another process
+                pass
+            total -= size
+        self.size = total
+
+
+def get_store(store_dir, max_bytes=None):
+    '''the ParamStore of this process for store_dir, or None if store_dir is None'''
+    if not store_dir:
+        return None
+    if (store_dir, max_bytes) not in _stores:
+        _stores[(store_dir, max_bytes)] = ParamStore(store_dir, max_bytes)
+    return _stores[(store_dir, max_bytes)]
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Dependency plan cache
+
+dependency_order() rebuilds the node graph for every flight, although flights of
+one LFL almost always give the same process_order.  PlanCache keeps process_order
+keyed by everything the plan depends on:
+    LFL, recorded/precomputed parameter names, requested params, available
+    aircraft/AFR attributes, the aircraft-level info values can_operate checks
+    (AIRCRAFT_INFO_KEYS), analyzer version and node module sources.
+Plans are held in memory and, given a cache folder, persisted as one json file
+per key so later runs and other workers can reuse them.
+"""
+import os
+import hashlib
+import logging
+
+import simplejson as json
+
+from analysis_engine.dependency_graph import dependency_order
+
+import node_fingerprint
+
+logger = logging.getLogger(__name__)
+
+_caches = {}  # cache_dir -> PlanCache, one per process
+
+
+# aircraft info values can_operate may check, which can differ between tails of one LFL.
+# Other values (Tail Number, Download Date, Myfile, ...) differ per flight and are left out of the key.
+AIRCRAFT_INFO_KEYS = ('Manufacturer', 'Family', 'Series', 'Model', 'Frame', 'Frame Qualifier', 'Frame Doubled',
+                      'Engine Count', 'Engine Manufacturer', 'Engine Series', 'Engine Type', 'Engine Propulsion',
+                      'Precise Positioning')
+
+
+def attribute_names(node_mgr):
+    '''names of the aircraft info and achieved flight record values a NodeManager can offer'''
+    names = [k for k, v in node_mgr.aircraft_info.items() if v is not None]
+    names += [k for k, v in node_mgr.achieved_flight_record.items() if v is not None]
+    return sorted(names)
+
+
+def attribute_values(node_mgr):
+    '''[name, repr(value)] of the AIRCRAFT_INFO_KEYS a NodeManager can offer.
+       Achieved flight record values are per-flight airports and runways, so only their
+       names count (see attribute_names).'''
+    return sorted([k, repr(v)] for k, v in node_mgr.aircraft_info.items()
+                  if v is not None and k in AIRCRAFT_INFO_KEYS)
+
+
+class PlanCache(object):
+    '''process_order lookups by plan key; see module docstring'''
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # another worker made it
+                pass
+        self.plans = {}
+        self.hits = 0
+        self.misses = 0
+        self._fingerprints = {}  # id(derived_nodes) -> (derived_nodes, fingerprint)
+
+    def fingerprint(self, derived_nodes):
+        cached = self._fingerprints.get(id(derived_nodes))
+        if cached is None or cached[0] is not derived_nodes:
+            cached = (derived_nodes, node_fingerprint.module_fingerprint(derived_nodes))
+            self._fingerprints[id(derived_nodes)] = cached
+        return cached[1]
+
+    def key(self, lfl, node_mgr):
+        '''sha1 of everything that determines process_order for this NodeManager'''
+        key_parts = {'lfl': lfl,
+                     'hdf_keys': sorted(node_mgr.hdf_keys),
+                     'requested': sorted(node_mgr.requested),
+                     'attributes': attribute_names(node_mgr),
+                     'attribute_values': attribute_values(node_mgr),
+                     'nodes': self.fingerprint(node_mgr.derived_nodes),
+                    }
+        return hashlib.sha1(json.dumps(key_parts, sort_keys=True)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, 'plan_' + key + '.json')
+
+    def get(self, key):
+        '''process_order for key, or None'''
+        if key in self.plans:
+            return self.plans[key]
+        if not self.cache_dir or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with open(self._path(key)) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            logger.warning('ignoring unreadable plan file: ' + self._path(key))
+            return None
+        if stored.get('key') != key or not isinstance(stored.get('process_order'), list):
+            logger.warning('ignoring invalid plan file: ' + self._path(key))
+            return None
+        self.plans[key] = stored['process_order']
+        return self.plans[key]
+
+    def put(self, key, process_order, lfl=None):
+        self.plans[key] = process_order
+        if not self.cache_dir:
+            return
+        tmp = self._path(key) + '.tmp%d' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'lfl': lfl, 'process_order': process_order}, f)
+        try:
+            os.rename(tmp, self._path(key))
+        except OSError:  # on Windows, another worker already saved this plan
+            os.remove(tmp)
+
+    def process_order(self, node_mgr, lfl):
+        '''cached process_order for node_mgr, computing and saving it on a miss'''
+        key = self.key(lfl, node_mgr)
+        process_order = self.get(key)
+        if process_order is not None:
+            self.hits += 1
+            return process_order
+        self.misses += 1
+        process_order, gr_st = dependency_order(node_mgr, draw=False)
+        logger.info('new plan for LFL %s: %d nodes', lfl, len(process_order))
+        self.put(key, process_order, lfl)
+        return process_order
+
+
+def get_cache(cache_dir=None):
+    '''the PlanCache of this process for cache_dir (None: memory only)'''
+    if cache_dir not in _caches:
+        _caches[cache_dir] = PlanCache(cache_dir)
+    return _caches[cache_dir]
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Single-file container for the analyzer results of one flight
+
+Replaces the six per-flight pickles (params, kti, kpv, phases, approach and
+flight attributes).  The container is an uncompressed .npz (zip) file:
+    header         json: format version, analyzer version, name tables, units,
+                   and the names/frequency/offset of derived series (whose
+                   arrays are already in the base hdf5 and are not repeated)
+    kpv_*          name (index into header name table), index, value
+    kti_*          name, index
+    phase_*        name, start, stop, start_edge, stop_edge (NaN for None)
+    objects        pickled approaches and flight attributes, which are few
+                   but hold nested dicts and datetimes
+Each member can be read on its own, e.g. read_results(path, parts=['kpv']).
+"""
+import os
+import cPickle as pickle
+
+import numpy as np
+import simplejson as json
+
+from analysis_engine import __version__ as analyzer_version
+from analysis_engine.node import DerivedParameterNode, KeyPointValue, KeyTimeInstance, Section
+
+CONTAINER_VERSION = 1
+PARTS = ('kpv', 'kti', 'phase', 'approach', 'attr')
+
+
+def results_path(output_path_and_file):
+    '''container path next to an output hdf5 file, versioned like the old pickles: eg _results_ver0_0_5.npz'''
+    return output_path_and_file.replace('.hdf5', '_results_ver' + analyzer_version.replace('.', '_') + '.npz')
+
+
+def _as_float(x):
+    return np.nan if x is None else float(x)
+
+
+def _as_none(x):
+    return None if np.isnan(x) else x
+
+
+def _name_codes(items):
+    '''(sorted name table, int32 array of each item's position in it)'''
+    names = sorted(set(item.name for item in items))
+    lookup = dict((name, i) for i, name in enumerate(names))
+    return names, np.array([lookup[item.name] for item in items], dtype=np.int32)
+
+
+def _series_info(params):
+    series = {}
+    for name in params.keys():
+        value = params[name]
+        if isinstance(value, DerivedParameterNode):
+            series[name] = {'frequency': value.frequency, 'offset': value.offset,
+                            'units': getattr(value, 'units', None)}
+    return series
+
+
+def write_results(path, res, params):
+    '''write res (as returned by derive_parameters_series) and series metadata from params to one container'''
+    arrays = {}
+    header = {'version': CONTAINER_VERSION, 'analyzer_version': analyzer_version, 'names': {}}
+
+    header['names']['kpv'], arrays['kpv_name'] = _name_codes(res['kpv'])
+    arrays['kpv_index'] = np.array([float(k.index) for k in res['kpv']], dtype=np.float64)
+    arrays['kpv_value'] = np.array([float(k.value) for k in res['kpv']], dtype=np.float64)
+    units = {}
+    for name in header['names']['kpv']:
+        units[name] = getattr(params.get(name), 'units', None)
+    header['kpv_units'] = units
+
+    header['names']['kti'], arrays['kti_name'] = _name_codes(res['kti'])
+    arrays['kti_index'] = np.array([float(k.index) for k in res['kti']], dtype=np.float64)
+
+    header['names']['phase'], arrays['phase_name'] = _name_codes(res['phase'])
+    arrays['phase_start'] = np.array([_as_float(p.slice.start) for p in res['phase']], dtype=np.float64)
+    arrays['phase_stop'] = np.array([_as_float(p.slice.stop) for p in res['phase']], dtype=np.float64)
+    arrays['phase_start_edge'] = np.array([_as_float(p.start_edge) for p in res['phase']], dtype=np.float64)
+    arrays['phase_stop_edge'] = np.array([_as_float(p.stop_edge) for p in res['phase']], dtype=np.float64)
+
+    header['series'] = _series_info(params)
+    objects = {'approach': list(res['approach']), 'attr': list(res['attr'])}
+    arrays['objects'] = np.frombuffer(pickle.dumps(objects, pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+    arrays['header'] = np.frombuffer(json.dumps(header), dtype=np.uint8)
+
+    tmp = path + '.tmp%d' % os.getpid()
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp, path)
+    return path
+
+
+def read_header(container):
+    '''header dict of an open container (np.load result) or a path'''
+    if hasattr(container, 'files'):
+        return json.loads(container['header'].tostring())
+    container = np.load(container)
+    try:
+        return json.loads(container['header'].tostring())
+    finally:
+        container.close()
+
+
+def read_arrays(path, part):
+    '''raw arrays of one part ('kpv', 'kti' or 'phase') plus its name table, without building node objects'''
+    container = np.load(path)
+    try:
+        header = read_header(container)
+        prefix = part + '_'
+        arrays = dict((k[len(prefix):], container[k]) for k in container.files if k.startswith(prefix))
+    finally:
+        container.close()
+    arrays['names'] = header['names'][part]
+    return arrays
+
+
+def read_results(path, parts=PARTS):
+    '''dict of the requested parts as lists of KeyPointValue, KeyTimeInstance, Section,
+       ApproachItem and Attribute objects, reading only the members those parts need'''
+    container = np.load(path)
+    try:
+        header = read_header(container)
+        results = {}
+        if 'kpv' in parts:
+            names = header['names']['kpv']
+            results['kpv'] = [KeyPointValue(index=i, value=v, name=names[n]) for n, i, v in
+                              zip(container['kpv_name'], container['kpv_index'], container['kpv_value'])]
+        if 'kti' in parts:
+            names = header['names']['kti']
+            results['kti'] = [KeyTimeInstance(index=i, name=names[n]) for n, i in
+                              zip(container['kti_name'], container['kti_index'])]
+        if 'phase' in parts:
+            names = header['names']['phase']
+            results['phase'] = [Section(names[n], slice(_as_none(start), _as_none(stop)), _as_none(start_edge), _as_none(stop_edge))
+                                for n, start, stop, start_edge, stop_edge in
+                                zip(container['phase_name'], container['phase_start'], container['phase_stop'],
+                                    container['phase_start_edge'], container['phase_stop_edge'])]
+        if 'approach' in parts or 'attr' in parts:
+            objects = pickle.loads(container['objects'].tostring())
+            for part in ('approach', 'attr'):
+                if part in parts:
+                    results[part] = objects[part]
+    finally:
+        container.close()
+    return results
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Background, batched writer for analyzer result rows
+
+A BatchedResultWriter can be passed wherever fds_oracle expects a connection
+(analyzer_to_oracle, report_timing, ...).  Instead of an executemany and a
+commit per table per flight, rows are put on a bounded queue and a writer
+thread accumulates them across flights.  A batch is flushed, with a single
+commit, once it holds batch_rows rows or flush_seconds have passed.
+
+Within a batch, statements run in the order they were queued, except that
+rows for a statement already in the batch join it when nothing queued since
+conflicts: inserts only conflict with deletes or updates of the same table
+(e.g. a flight record's delete and insert, or run_journal.clear_unfinished), and
+those never move past each other.  Each run of rows is sent in one executemany
+(through a prepared, typed fds_oracle.BulkInserter for the KPV/KTI/phase
+inserts).  With staging=True, result rows go to the tables' staging copies and
+are swapped in when the writer is closed.
+
+If the queue is full, producers wait: the time spent waiting is reported as
+back-pressure in stats().  A batch that fails is rolled back and counted in
+stats()['lost_rows']; producers then get the error on their next queue_rows()
+and close() raises it.
+"""
+import re
+import time
+import logging
+import threading
+import Queue
+
+import fds_oracle
+
+logger = logging.getLogger(__name__)
+
+BATCH_ROWS = 5000
+FLUSH_SECONDS = 5.0
+MAX_QUEUE = 1000   # queued statements, not rows
+
+_STOP = object()
+_TABLE = re.compile(r'^\s*(insert\b.*?\binto|delete\b(?:\s+from)?|update)\s+(\w+)', re.I | re.S)
+
+
+def statement_table(sql):
+    '''(kind, table) of an insert, delete or update: kind is 'insert' or 'change', table lower case.
+       (None, None) for anything else'''
+    match = _TABLE.match(sql)
+    if match is None:
+        return None, None
+    kind = 'insert' if match.group(1).lower().startswith('insert') else 'change'
+    return kind, match.group(2).lower()
+
+
+def commute(a, b):
+    '''True if statements a and b, each a (kind, table), give the same result in either order'''
+    if a[1] is None or b[1] is None:
+        return False
+    return a[1] != b[1] or a[0] == b[0] == 'insert'
+
+
+class BatchedResultWriter(object):
+    '''see module docstring'''
+    def __init__(self, connection=None, batch_rows=BATCH_ROWS, flush_seconds=FLUSH_SECONDS, max_queue=MAX_QUEUE,
+                 staging=False):
+        self.connection = connection or fds_oracle.get_connection()
+        self.staging = staging
+        self._inserters = {}            # sql -> fds_oracle.BulkInserter, prepared once
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.queue = Queue.Queue(max_queue)
+        self.error = None
+        self._pending = []              # [sql, (kind, table), bind rows] runs in execution order
+        self._pending_rows = 0
+        self._last_flush = time.time()
+        self._stats = {'rows': 0, 'flushes': 0, 'flush_seconds': 0.0, 'max_flush_seconds': 0.0,
+                       'blocked_seconds': 0.0, 'blocked_puts': 0, 'max_queue_depth': 0, 'lost_rows': 0}
+        self._thread = threading.Thread(target=self._run, name='BatchedResultWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    ### producer side
+    def queue_rows(self, sql, rows):
+        '''queue rows (a list of bind lists; None for a statement without binds) for sql'''
+        if self.error is not None:
+            raise RuntimeError('result writer failed: %s' % self.error)
+        item = (sql, list(rows))
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            start = time.time()
+            self.queue.put(item)
+            self._stats['blocked_seconds'] += time.time() - start
+            self._stats['blocked_puts'] += 1
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], self.queue.qsize())
+
+    def close(self, raise_error=True):
+        '''flush everything still queued, stop the writer thread and log its stats.
+           If a batch failed, raise its error, or with raise_error=False (e.g. while another
+           exception is on its way up) only log it.  The connection is left open.'''
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join()
+        for inserter in self._inserters.values():
+            inserter.close()
+        if self.staging and self.error is None:
+            for table in set(inserter.table for inserter in self._inserters.values()):
+                fds_oracle.swap_in_staging(self.connection, table)
+        logger.warning('result writer: ' + ', '.join('%s=%s' % kv for kv in sorted(self.stats().items())))
+        if self.error is not None:
+            message = 'result writer failed, %d rows lost: %s' % (self._stats['lost_rows'], self.error)
+            if raise_error:
+                raise RuntimeError(message)
+            logger.error(message)
+
+    def stats(self):
+        '''rows written and lost, flush count and latency (mean/max seconds) and back-pressure on producers'''
+        stats = dict(self._stats)
+        stats['mean_flush_seconds'] = stats['flush_seconds'] / stats['flushes'] if stats['flushes'] else 0.0
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    ### writer thread
+    def _run(self):
+        while True:
+            timeout = max(0.0, self.flush_seconds - (time.time() - self._last_flush))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                item = None
+            if item is _STOP:
+                self._flush()
+                return
+            if item is not None:
+                self._add(*item)
+            if self._pending_rows >= self.batch_rows or time.time() - self._last_flush >= self.flush_seconds:
+                self._flush()
+
+    def _add(self, sql, rows):
+        '''join the latest run of sql if every run queued after it commutes with sql, else start a run'''
+        statement = statement_table(sql)
+        for run in reversed(self._pending):
+            if run[0] == sql:
+                run[2].extend(rows)
+                break
+            if not commute(run[1], statement):
+                self._pending.append([sql, statement, list(rows)])
+                break
+        else:
+            self._pending.append([sql, statement, list(rows)])
+        self._pending_rows += len(rows)
+
+    def _inserter(self, sql):
+        if sql not in self._inserters:
+            if self.staging:
+                fds_oracle.create_staging_table(self.connection, fds_oracle.TYPED_INSERTS[sql][0])
+            self._inserters[sql] = fds_oracle.BulkInserter(self.connection, sql, staging=self.staging)
+        return self._inserters[sql]
+
+    def _flush(self):
+        self._last_flush = time.time()
+        if not self._pending:
+            return
+        start = time.time()
+        try:
+            cur = self.connection.cursor()
+            for sql, statement, rows in self._pending:
+                if sql in fds_oracle.TYPED_INSERTS and fds_oracle.is_oracle(self.connection):
+                    self._inserter(sql).insert(rows)
+                elif any(r is None for r in rows):
+                    for r in rows:
+                        if r is None:
+                            cur.execute(sql)
+                        else:
+                            cur.execute(sql, r)
+                else:
+                    cur.executemany(sql, rows)
+            self.connection.commit()
+            cur.close()
+            self._stats['rows'] += self._pending_rows
+        except Exception, e:
+            logger.exception('result writer: flush of %d rows failed, they are lost', self._pending_rows)
+            self.error = e
+            self._stats['lost_rows'] += self._pending_rows
+            try:
+                self.connection.rollback()
+            except Exception:
+                pass
+        elapsed = time.time() - start
+        self._stats['flushes'] += 1
+        self._stats['flush_seconds'] += elapsed
+        self._stats['max_flush_seconds'] = max(self._stats['max_flush_seconds'], elapsed)
+        logger.debug('result writer: flushed %d rows in %.3f s', self._pending_rows, elapsed)
+        self._pending = []
+        self._pending_rows = 0
+        self._last_flush = time.time()
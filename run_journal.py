@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Run journal for checkpointing and resuming run_analyzer
+
+Every flight a run finishes gets a journal entry keyed by run time, stage,
+profile and source file.  run_analyzer(resume_from=<run time of the failed
+run>) re-uses that run time, skips the flights journaled 'ok' and processes the
+rest, so restarting after a crash costs only the remaining work.
+
+With save_oracle the journal is the fds_run_journal table (run_analyzer skips
+journaling, with a warning, on schemas without it).  Its row goes through the
+same connection as the flight's KPV/KTI/phase rows, after them, so it is not
+committed before they are.  The reverse does not hold: results may be stored
+and the run stop before the journal row is.  So a resumed run first deletes,
+once and set-based, the KPV/KTI/phase and timing rows left under the run time
+by the flights it will process again (clear_unfinished).
+
+Without a database, a FileJournal appends one line per flight to
+<RUN_JOURNAL_PATH>/<stage>-<profile>-<run time>.journal, fsynced per line.
+"""
+import os
+import logging
+
+import fds_oracle
+
+logger = logging.getLogger(__name__)
+
+RUN_TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+JOURNAL_INSERT_SQL = '''insert into fds_run_journal (run_time, stage, profile, source_file, status, file_repository)
+                        values (:run_time, :stage, :profile, :source_file, :status, :file_repository)'''
+COMPLETED_SQL = '''select source_file from fds_run_journal
+                   where run_time=:run_time and stage=:stage and profile=:profile and status='ok' '''
+TABLE_CHECK_SQL = 'select count(*) from fds_run_journal where 1=0'
+UNFINISHED_DELETE_SQL = ['''delete from %s where run_time=:run_time and profile=:profile
+                            and source_file not in (%s)''' % (table, COMPLETED_SQL)
+                         for table in ('fds_kpv', 'fds_kti', 'fds_phase')]
+UNFINISHED_DELETE_SQL.append('''delete from fds_processing_time
+                                where run_time=:run_time and stage=:stage and profile=:profile
+                                and source_file not in (%s)''' % COMPLETED_SQL)
+
+
+def has_table(cn):
+    '''True if the database has fds_run_journal; schemas from before it was added do not'''
+    cur = cn.cursor()
+    try:
+        cur.execute(TABLE_CHECK_SQL)
+        cur.fetchall()
+        return True
+    except Exception:
+        return False
+    finally:
+        cur.close()
+
+
+def mark_done(cn, run_time, stage, profile, flight_path_and_file, status, file_repository=None):
+    '''journal a finished flight; cn may be a BatchedResultWriter'''
+    fds_oracle.oracle_execute(cn, JOURNAL_INSERT_SQL, [run_time, stage, profile, os.path.basename(flight_path_and_file),
+                                                       status, file_repository])
+
+
+def completed(cn, run_time, stage, profile):
+    '''source file names journaled 'ok' for the run'''
+    cur = cn.cursor()
+    cur.execute(COMPLETED_SQL, [run_time, stage, profile])
+    done = set(row[0] for row in cur.fetchall())
+    cur.close()
+    return done
+
+
+def clear_unfinished(cn, run_time, stage, profile):
+    '''delete the KPV/KTI/phase and fds_processing_time rows of the run for flights not journaled 'ok',
+       one statement per table; call once, before resuming'''
+    for sql in UNFINISHED_DELETE_SQL:
+        fds_oracle.oracle_execute(cn, sql, {'run_time': run_time, 'stage': stage, 'profile': profile})
+
+
+def journal_path(journal_dir, stage, profile, run_time):
+    return os.path.join(journal_dir, '%s-%s-%s.journal' % (stage, profile, run_time.strftime(RUN_TIME_FORMAT)))
+
+
+class FileJournal(object):
+    '''see module docstring'''
+    def __init__(self, path):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def mark_done(self, flight_path_and_file, status):
+        with open(self.path, 'a') as f:
+            f.write('%s\t%s\n' % (status, os.path.basename(flight_path_and_file)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def completed(self):
+        '''source file names journaled 'ok'; a torn last line (crash while writing) is ignored'''
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                status, _, name = line.rstrip('\n').partition('\t')
+                if status=='ok' and name:
+                    done.add(name)
+        return done
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped sidecar cache for base hdf5 files
+
+A sidecar is a folder next to a _base.hdf5 file, e.g.
+   myflight_base.hdf5  ->  myflight_base_sidecar/
+holding index.json (flight and parameter attributes) and, per parameter,
+an uncompressed .npy data file and, if anything is masked, a .npy mask file.
+
+Profiles re-run over the same base files can then build ParameterNodes over
+np.memmap views instead of decompressing every dataset through h5py, and worker
+processes share the page cache for the same flight.
+A sidecar is only used while the size and mtime of its hdf5 file are unchanged.
+"""
+import os
+import shutil
+import logging
+from datetime import datetime
+
+import numpy as np
+import simplejson as json
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_VERSION = 1
+INDEX_FILE = 'index.json'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def sidecar_path(hdf5_path):
+    '''folder holding the sidecar for an hdf5 file'''
+    return os.path.splitext(hdf5_path)[0] + '_sidecar'
+
+
+def _source_stamp(hdf5_path):
+    st = os.stat(hdf5_path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def _plain(value):
+    '''numpy scalars (e.g. from hdf5 attributes) as python values for json'''
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def write_sidecar(hdf5_path, flight):
+    '''write the ParameterNodes in flight.parameters, as saved to hdf5_path, into a sidecar.
+       Call after the hdf5 file is complete: its size and mtime are recorded for the staleness check.
+       The sidecar is built in a temporary folder and renamed into place.
+    '''
+    dest = sidecar_path(hdf5_path)
+    tmp = dest + '.tmp%d' % os.getpid()
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    start_datetime = flight.start_datetime.strftime(DATETIME_FORMAT) if flight.start_datetime else None
+    index = {'version': SIDECAR_VERSION,
+             'source': _source_stamp(hdf5_path),
+             'duration': _plain(flight.duration),
+             'start_epoch': _plain(flight.start_epoch),
+             'start_datetime': start_datetime,
+             'superframe_present': _plain(flight.superframe_present),
+             'hdfaccess_version': _plain(flight.hdfaccess_version),
+             'reliable_frame_counter': _plain(flight.reliable_frame_counter),
+             'parameters': {},
+            }
+    for i, name in enumerate(sorted(flight.parameters.keys())):
+        param = flight.parameters[name]
+        array = param.array
+        data_file = '%04d.data.npy' % i
+        np.save(os.path.join(tmp, data_file), np.ascontiguousarray(np.ma.getdata(array)))
+        mask = np.ma.getmaskarray(array)
+        if mask.any():
+            mask_file = '%04d.mask.npy' % i
+            np.save(os.path.join(tmp, mask_file), mask)
+        else:
+            mask_file = None
+        values_mapping = getattr(param, 'values_mapping', None)
+        if values_mapping:
+            values_mapping = dict((str(k), v) for k, v in values_mapping.items())
+        index['parameters'][name] = {'data': data_file, 'mask': mask_file,
+                                     'frequency': _plain(param.frequency), 'offset': _plain(param.offset),
+                                     'units': getattr(param, 'units', None),
+                                     'data_type': getattr(param, 'data_type', None),
+                                     'lfl': _plain(getattr(param, 'lfl', None)),
+                                     'values_mapping': values_mapping,
+                                    }
+    with open(os.path.join(tmp, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    os.rename(tmp, dest)
+    logger.info('wrote sidecar ' + dest)
+    return dest
+
+
+def read_index(hdf5_path):
+    '''index dict for a current sidecar, or None if it is missing, another version, or stale'''
+    index_path = os.path.join(sidecar_path(hdf5_path), INDEX_FILE)
+    if not os.path.exists(index_path) or not os.path.exists(hdf5_path):
+        return None
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        logger.warning('unreadable sidecar index: ' + index_path)
+        return None
+    if index.get('version') != SIDECAR_VERSION:
+        return None
+    stamp = _source_stamp(hdf5_path)
+    if index['source']['size'] != stamp['size'] or index['source']['mtime'] != stamp['mtime']:
+        logger.info('stale sidecar: ' + index_path)
+        return None
+    return index
+
+
+def load_array(folder, entry):
+    '''masked array over copy-on-write memmaps of the data and mask files'''
+    data = np.load(os.path.join(folder, entry['data']), mmap_mode='c')
+    if entry['mask']:
+        mask = np.load(os.path.join(folder, entry['mask']), mmap_mode='c')
+    else:
+        mask = np.ma.nomask
+    return np.ma.MaskedArray(data, mask=mask, copy=False)
+
+
+def load_sidecar(hdf5_path, required_series=[]):
+    '''returns (index, {name: hdfaccess Parameter over memmap views}) or (None, None) if no current sidecar.
+       required_series limits the parameters returned, as in Flight.load_from_hdf5
+    '''
+    from hdfaccess.parameter import Parameter
+    index = read_index(hdf5_path)
+    if index is None:
+        return None, None
+    folder = sidecar_path(hdf5_path)
+    names = index['parameters'].keys()
+    if required_series:
+        names = frozenset(required_series).intersection(names)
+    series = {}
+    for name in names:
+        entry = index['parameters'][name]
+        values_mapping = entry['values_mapping']
+        if values_mapping:
+            values_mapping = dict((int(k), v) for k, v in values_mapping.items())
+        series[name] = Parameter(name, array=load_array(folder, entry),
+                                 values_mapping=values_mapping,
+                                 frequency=entry['frequency'], offset=entry['offset'],
+                                 units=entry['units'], data_type=entry['data_type'],
+                                 lfl=entry['lfl'])
+    return index, series
+
+
+def parse_start_datetime(index):
+    '''start_datetime as saved by write_sidecar'''
+    if index.get('start_datetime') is None:
+        return None
+    return datetime.strptime(index['start_datetime'], DATETIME_FORMAT)
@@ -9,11 +9,14 @@ Created on Sat Aug 10 16:19:48 2013
 """
 import glob
 import os
+import logging
 
 import pandas as pd
 
 import analyser_custom_settings as settings 
 import fds_oracle  # db connection
+import flight_catalog
+import frame_list
 
 def _flight_list(files_to_process, aircraft_info, repo):
     flight_list=[]
@@ -119,3 +122,20 @@ def fll_local():
     files_to_process = fds_oracle.flight_record_filepaths(query) #[:40]
     aircraft_info={'Frame': 'A320_SFIM_ED45_CFM', 'Manufacturer': 'Airbus', 'Precise Positioning': True, 'Series': 'A320-200', 'Family': 'A320', 'Frame Doubled': False}
     return _flight_list(files_to_process, aircraft_info, repo)
+
+
+def catalog_flights(repo='local', refresh_folder=None, **query):
+    '''flight set from the flight catalog (settings.FLIGHT_CATALOG_PATH), without opening any file.
+       query: filters of flight_catalog.FlightCatalog.files, e.g. frame='A320_SFIM_ED45_CFM',
+       folder=settings.BASE_DATA_PATH + 'test10/', recorded=['Airspeed'], start_from=datetime(2013,1,1).
+       refresh_folder: first bring the catalog up to date for the hdf5 files in this folder,
+       looking up their aircraft info in the frame list
+    '''
+    catalog = flight_catalog.get_catalog(getattr(settings, 'FLIGHT_CATALOG_PATH', None) or 'flight_catalog.sqlite')
+    if refresh_folder:
+        frame_dict = frame_list.build_frame_list(logging.getLogger(__name__))
+        catalog.refresh_folder(refresh_folder, file_repository=repo, frame_dict=frame_dict)
+    query.setdefault('file_repository', repo)
+    files_to_process = catalog.files(**query)
+    aircraft_info = catalog.aircraft_info(files_to_process)
+    return [{'filepath': f, 'aircraft_info': aircraft_info.get(f, {}), 'repo': repo} for f in files_to_process]
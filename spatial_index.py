@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index over load_apt_rwy's airport and runway dictionaries
+
+AirportIndex answers "nearest airport to lat/lon" and "best runway at an
+airport for a position and heading" locally, from apt_dict and apt_rwy_dict,
+instead of through the remote API handler.
+
+Airports are kept as unit vectors sorted by latitude.  A query only scores the
+airports in a latitude band around the position, widening the band until the
+best match found is closer than the band's edge, so the answer is exact.
+
+SpatialAPIHandler wraps an index in the get_nearest_airport /
+get_nearest_runway interface of the analysis_engine API handlers:
+    API_HANDLER = 'spatial_index.SpatialAPIHandler'
+analysis_engine makes a new handler for every lookup, so the snapshot is
+loaded and its index built once per process (get_index).
+"""
+import logging
+
+import numpy as np
+
+import load_apt_rwy
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_NM = 3440.065
+BAND_DEGREES = 1.0          # first latitude band searched either side of a position
+HEADING_TOLERANCE = 30.0    # degrees between runway and aircraft heading
+
+_indexes = {}  # (snapshot folder, cycle) -> AirportIndex, one per process
+
+
+def unit_vectors(lats, lons):
+    '''(n, 3) array of points on the unit sphere for degree latitudes and longitudes'''
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    return np.column_stack((np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    '''initial true bearing in degrees from point 1 to point 2'''
+    lat1, lon1, lat2, lon2 = np.radians([lat1, lon1, lat2, lon2])
+    y = np.sin(lon2-lon1)*np.cos(lat2)
+    x = np.cos(lat1)*np.sin(lat2) - np.sin(lat1)*np.cos(lat2)*np.cos(lon2-lon1)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+def heading_difference(a, b):
+    '''smallest angle in degrees between headings a and b'''
+    return np.abs((np.asarray(a) - b + 180.0) % 360.0 - 180.0)
+
+
+class AirportIndex(object):
+    '''see module docstring'''
+    def __init__(self, apt_dict, apt_rwy_dict):
+        self.apt_dict = apt_dict
+        self.apt_rwy_dict = apt_rwy_dict
+        located = [(apt['latitude'], apt['longitude'], icao) for icao, apt in apt_dict.items()
+                   if apt.get('latitude') is not None and apt.get('longitude') is not None]
+        located.sort()
+        self.lats = np.array([a[0] for a in located], dtype=np.float64)
+        self.vectors = unit_vectors(self.lats, [a[1] for a in located]).reshape(-1, 3)
+        self.icaos = [a[2] for a in located]
+        self._runways = {}  # icao -> (runway dicts, true headings, start vectors, end vectors)
+
+    ### airports
+    def nearest_airport(self, latitude, longitude):
+        '''(icao, distance in nm) of the airport nearest to latitude/longitude, or (None, None)'''
+        if not self.icaos:
+            return None, None
+        point = unit_vectors([latitude], [longitude])[0]
+        band = BAND_DEGREES
+        while True:
+            lo = np.searchsorted(self.lats, latitude - band, 'left')
+            hi = np.searchsorted(self.lats, latitude + band, 'right')
+            if hi > lo:
+                cosines = np.dot(self.vectors[lo:hi], point)
+                best = np.argmax(cosines)
+                angle = np.degrees(np.arccos(min(1.0, cosines[best])))
+                # anything outside the band is more than band degrees away
+                if angle <= band or (lo == 0 and hi == len(self.lats)):
+                    return self.icaos[lo+best], np.radians(angle)*EARTH_RADIUS_NM
+            elif lo == 0 and hi == len(self.lats):
+                return None, None
+            band *= 2.0
+
+    def nearest_airports(self, latitudes, longitudes):
+        '''nearest_airport for each position: (list of icao, array of distances in nm)'''
+        found = [self.nearest_airport(lat, lon) for lat, lon in zip(latitudes, longitudes)]
+        return [f[0] for f in found], np.array([f[1] for f in found], dtype=np.float64)
+
+    ### runways
+    def _airport_runways(self, icao):
+        if icao not in self._runways:
+            # start is the runway's own threshold, end the opposite one (as in the API's runway dicts)
+            runways = [rw for rw in self.apt_rwy_dict.get(icao, {}).values() if rw['start']['latitude'] is not None]
+            headings, starts, ends = [], [], []
+            for rw in runways:
+                start, end = rw['start'], rw.get('end', {})
+                if end.get('latitude') is not None:
+                    headings.append(bearing(start['latitude'], start['longitude'], end['latitude'], end['longitude']))
+                    ends.append((end['latitude'], end['longitude']))
+                else:  # no opposite end: magnetic heading is the best there is
+                    headings.append(float(rw.get('magnetic_heading') or np.nan))
+                    ends.append((start['latitude'], start['longitude']))
+                starts.append((start['latitude'], start['longitude']))
+            self._runways[icao] = (runways, np.array(headings, dtype=np.float64),
+                                   unit_vectors(*zip(*starts)).reshape(-1, 3) if runways else np.zeros((0, 3)),
+                                   unit_vectors(*zip(*ends)).reshape(-1, 3) if runways else np.zeros((0, 3)))
+        return self._runways[icao]
+
+    def best_runway(self, icao, heading, latitude=None, longitude=None, ils_freq=None):
+        '''runway dict at icao best matching an aircraft heading (degrees true) and, if given,
+           position and localizer frequency (kHz, as in the runway dict), or None'''
+        runways, headings, starts, ends = self._airport_runways(icao)
+        if not runways:
+            return None
+        candidates = np.arange(len(runways))
+        close = heading_difference(headings, heading) <= HEADING_TOLERANCE
+        if close.any():
+            candidates = candidates[close]
+        if ils_freq:
+            tuned = [i for i in candidates if runways[i].get('localizer', {}).get('frequency') == ils_freq]
+            if tuned:
+                candidates = np.array(tuned)
+        if latitude is None or longitude is None or len(candidates) == 1:
+            return runways[candidates[np.argmin(heading_difference(headings[candidates], heading))]]
+        # distance from the runway centreline: component along the normal of the start/end great circle
+        point = unit_vectors([latitude], [longitude])[0]
+        normals = np.cross(starts[candidates], ends[candidates])
+        lengths = np.sqrt((normals**2).sum(axis=1))
+        lengths[lengths == 0] = np.inf  # no end: rank by heading only
+        cross_track = np.abs(np.dot(normals, point)) / lengths
+        order = np.lexsort((heading_difference(headings[candidates], heading), cross_track))
+        return runways[candidates[order[0]]]
+
+
+def get_index(cache_dir=None, cycle_num=None):
+    '''the AirportIndex of this process for the load_apt_rwy snapshot of cycle_num in cache_dir
+       (default settings.APT_RWY_CACHE_PATH and APT_RWY_CYCLE), loaded and built on first use'''
+    key = (cache_dir or load_apt_rwy.APT_RWY_CACHE_PATH, cycle_num or load_apt_rwy.CYCLE_NUM)
+    if key not in _indexes:
+        _indexes[key] = AirportIndex(*load_apt_rwy.cached_apt_rwy(None, *key))
+    return _indexes[key]
+
+
+class SpatialAPIHandler(object):
+    '''local stand-in for the analysis_engine API handler, from the load_apt_rwy snapshot
+       or, if given, from apt_dict and apt_rwy_dict'''
+    def __init__(self, apt_dict=None, apt_rwy_dict=None):
+        if apt_dict is None or apt_rwy_dict is None:
+            self.index = get_index()
+        else:
+            self.index = AirportIndex(apt_dict, apt_rwy_dict)
+
+    def _not_found(self, what):
+        from analysis_engine.api_handler import NotFoundError
+        raise NotFoundError(what)
+
+    def get_nearest_airport(self, latitude, longitude, **kwargs):
+        icao, distance = self.index.nearest_airport(latitude, longitude)
+        if icao is None:
+            self._not_found('no airport near %s, %s' % (latitude, longitude))
+        airport = dict(self.index.apt_dict[icao])
+        airport.setdefault('id', icao)
+        airport['distance'] = distance
+        return airport
+
+    def get_nearest_runway(self, airport, heading, latitude=None, longitude=None, ils_freq=None, **kwargs):
+        icao = airport.get('id', airport.get('icao')) if isinstance(airport, dict) else airport
+        runway = self.index.best_runway(icao, heading, latitude, longitude, ils_freq)
+        if runway is None:
+            self._not_found('no runway at %s for heading %s' % (icao, heading))
+        return runway
@@ -5,8 +5,9 @@
     @author: KEITHC
 """
 import pdb
-import sys, traceback, os, glob, shutil, logging, time, copy
+import sys, traceback, os, glob, shutil, logging, time, copy, threading
 import cPickle as pickle
+from collections import MutableMapping, OrderedDict
 from datetime import datetime
 
 import numpy as np
@@ -32,15 +33,232 @@ import fds_oracle
 import frame_list # map of tail# to LFLs
 from frame_list import get_aircraft_info
 import load_apt_rwy
+import sidecar_cache
+import plan_cache
+import param_store
+import result_container
+import incremental
+import result_writer
+import fds_db
+import columnar_sink
+import align_engine
+import node_profiler
+import dag_scheduler
+import work_scheduler
+import run_journal
+import flight_catalog
+import hdf5_storage
 logger = logging.getLogger(__name__) #for process_short)_
 
 
+def param_node_from_hdf(hdf_param):
+    '''ParameterNode for an hdfaccess Parameter, carrying over units, lfl and data_type'''
+    param_node = node.derived_param_from_hdf( hdf_param )
+    param_node.units = hdf_param.units #better
+    param_node.lfl = hdf_param.lfl
+    param_node.data_type = hdf_param.data_type 
+    return param_node
+
+
+def series_nbytes(array):
+    '''bytes held by a (masked) array, counting data and an expanded mask'''
+    if array is None:
+        return 0
+    nbytes = np.ma.getdata(array).nbytes
+    mask = np.ma.getmask(array)
+    if mask is not np.ma.nomask:
+        nbytes += mask.nbytes
+    return nbytes
+
+
+def last_uses(process_order, derived_nodes):
+    '''dependency name -> last position in process_order of a node that consumes it'''
+    last_use = {}
+    for step, name in enumerate(process_order):
+        node_class = derived_nodes.get(name)
+        if node_class is None:
+            continue
+        for dep_name in node_class.get_dependency_names():
+            last_use[dep_name] = step
+    return last_use
+
+
+class HDFSeriesReader(object):
+    '''Reads single series from an hdf5 file the first time they are asked for.
+       Shared by the LazySeries and LazyParameters proxies of one Flight.
+
+       With a byte_budget, loaded series are evicted whenever the resident total
+       exceeds the budget, after each read and each derived node: first those past
+       their last use in the process order (see plan()), then least recently used.
+       So reading every series (e.g. to save the flight) keeps at most about the
+       budget resident.  Evicted series are simply re-read if asked for again.
+
+       The file is opened on the first read and kept open until close().
+    '''
+    def __init__(self, filepath, byte_budget=None):
+        self.filepath = filepath
+        self.byte_budget = byte_budget
+        self.resident_bytes = 0
+        self.read_count = 0
+        self.evict_count = 0
+        self.last_use = {}           # series name -> position of last consumer in process_order
+        self.step = -1               # last position of process_order derived, see advance()
+        self._loaded = OrderedDict() # series name -> (hdf_param, param_node), least recent first
+        self._lock = threading.RLock()  # nodes may be derived in several threads
+        self._file = None            # open hdf_file, or None
+
+    def get(self, name):
+        '''returns (hdfaccess Parameter, ParameterNode or None if invalid)'''
+        with self._lock:
+            return self._get(name)
+
+    def _get(self, name):
+        if name in self._loaded:
+            entry = self._loaded.pop(name)
+            self._loaded[name] = entry  #most recently used
+            return entry
+        if self._file is None:
+            self._file = hdfaccess.file.hdf_file(self.filepath)
+        hdf_param = self._file.get_param(name, valid_only=False)
+        is_invalid = hdf_param.invalid
+        if is_invalid is None or is_invalid==False:
+            param_node = param_node_from_hdf(hdf_param)
+        else:
+            param_node = None
+        entry = (hdf_param, param_node)
+        self._loaded[name] = entry
+        self.resident_bytes += series_nbytes(hdf_param.array)
+        self.read_count += 1
+        logger.debug('lazy read %s (%d bytes resident)', name, self.resident_bytes)
+        self._enforce_budget(keep=name)
+        return entry
+
+    def evict(self, name):
+        entry = self._loaded.pop(name, None)
+        if entry is not None:
+            self.resident_bytes -= series_nbytes(entry[0].array)
+            self.evict_count += 1
+
+    def plan(self, process_order, derived_nodes):
+        '''record, for each dependency name, the last position in process_order that consumes it'''
+        self.last_use = last_uses(process_order, derived_nodes)
+
+    def advance(self, step):
+        '''called after process_order[step] has been derived; enforces the byte budget'''
+        with self._lock:
+            self._advance(step)
+
+    def _advance(self, step):
+        self.step = step
+        self._enforce_budget()
+
+    def _enforce_budget(self, keep=None):
+        '''evict series until within the byte budget; keep, the series just read, stays'''
+        if self.byte_budget is None or self.resident_bytes <= self.byte_budget:
+            return
+        finished = [k for k in self._loaded.keys() if self.last_use.get(k, -1) <= self.step and k != keep]
+        for k in finished:
+            self.evict(k)
+            if self.resident_bytes <= self.byte_budget:
+                return
+        for k in [k for k in self._loaded.keys() if k != keep]:
+            if self.resident_bytes <= self.byte_budget:
+                return
+            self.evict(k)
+
+    def close(self):
+        '''close the file; a later read opens it again'''
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __getstate__(self):
+        # loaded arrays can always be re-read from the file, so don't pickle them
+        state = self.__dict__.copy()
+        state['_loaded'] = OrderedDict()
+        state['resident_bytes'] = 0
+        state['_file'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+class LazySeries(MutableMapping):
+    '''dict-like proxy over the series of an hdf5 file.
+       Keys are known up front; values are read through an HDFSeriesReader on first access.
+       Values assigned explicitly are held locally, like a plain dict.
+    '''
+    _entry_index = 0  #hdfaccess Parameter
+
+    def __init__(self, reader, names):
+        self.reader = reader
+        self._names = set(names)  # still backed by the file
+        self._local = {}
+
+    def __getitem__(self, name):
+        if name in self._local:
+            return self._local[name]
+        if name in self._names:
+            return self.reader.get(name)[self._entry_index]
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        self._names.discard(name)
+        self._local[name] = value
+
+    def __delitem__(self, name):
+        if name in self._local:
+            del self._local[name]
+        elif name in self._names:
+            self._names.discard(name)
+        else:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._local or name in self._names
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for name in self._names:
+            yield name
+        for name in self._local:
+            yield name
+
+    def __len__(self):
+        return len(self._names) + len(self._local)
+
+    def copy(self):
+        '''shallow copy sharing the same reader'''
+        other = self.__class__(self.reader, self._names)
+        other._local = self._local.copy()
+        return other
+
+    def plan(self, process_order, derived_nodes):
+        self.reader.plan(process_order, derived_nodes)
+
+    def advance(self, step):
+        self.reader.advance(step)
+
+    def close(self):
+        self.reader.close()
+
+
+class LazyParameters(LazySeries):
+    '''dict-like proxy of ParameterNodes for the valid series of an hdf5 file'''
+    _entry_index = 1  #ParameterNode
+
+
 class Flight(object):
     '''Container for data describing a single flight, principally from an hdf5 file
         used in conjunction with get_deps_series(), derive_parameters_series(), and derive()
         
        These support profile development.  Also make be useful for processing FFDs.
-       TODO: in profile, load and process only time series that are dependencies
+       With lazy=True, series are only read when a node first asks for them.
     '''
     def __init__(self):
         self.filepath = None
@@ -59,9 +277,13 @@ class Flight(object):
         self.hdfaccess_version = 1 #=version in hdf5 attributes
         self.reliable_frame_counter = 1
 
-    def load_from_hdf5(self, flight_dict, required_series=[]): #all_hdfseries, 
+    def load_from_hdf5(self, flight_dict, required_series=[], lazy=False, byte_budget=None, use_sidecar=False): #all_hdfseries, 
         '''load data from an hdf flight data file
             flight_series is a dictionary with fields:  'filepath', 'aircraft_info', 'repo'        
+            lazy: only read parameter attributes now; series data is read on first use, from
+               a handle kept open until close()
+            byte_budget: with lazy, evict loaded series when more than this many bytes are resident
+            use_sidecar: if a current memory-mapped sidecar exists (see sidecar_cache), load from it instead
         '''
         # look up aircraft info by tail number
         self.filepath = flight_dict['filepath']
@@ -69,6 +291,8 @@ class Flight(object):
         if not os.path.exists(self.filepath):
             logger.warning('cannot find: '+ self.filepath)
             #pdb.set_trace()
+        if use_sidecar and self.load_from_sidecar(required_series):
+            return
                 
         with hdfaccess.file.hdf_file(self.filepath) as ff:
             self.duration = ff.duration
@@ -83,6 +307,21 @@ class Flight(object):
                  series_to_load = ff.keys() #all_hdfseries
             else:
                 series_to_load = frozenset(required_series).intersection( frozenset(ff.keys()) )
+
+            if lazy:
+                # attributes only; no datasets are read here
+                valid_names = []
+                for k in series_to_load:
+                    attrs = ff.hdf['series'][k].attrs
+                    if attrs.get('lfl')==True:
+                        self.lfl_params.append(k)
+                    is_invalid = attrs.get('invalid')
+                    if is_invalid is None or is_invalid==False:
+                        valid_names.append(k)
+                reader = HDFSeriesReader(self.filepath, byte_budget=byte_budget)
+                self.series = LazySeries(reader, series_to_load)
+                self.parameters = LazyParameters(reader, valid_names)
+                return
                             
             for k in series_to_load:
                 self.series[k] =  ff.get_param(k, valid_only=False)
@@ -90,15 +329,37 @@ class Flight(object):
                     self.lfl_params.append(k)                     
                 is_invalid =self.series[k].invalid
                 if is_invalid is None or is_invalid==False:
-                    param_node = node.derived_param_from_hdf( self.series[k] )
-                    param_node.units = self.series[k].units #better
-                    param_node.lfl = self.series[k].lfl
-                    param_node.data_type =self.series[k].data_type 
-                    self.parameters[k] = param_node
+                    self.parameters[k] = param_node_from_hdf(self.series[k])
 
     
-    def save_to_hdf5(self, hdf5_path):
-        '''this will overwrite any existing file with the same name'''
+    def load_from_sidecar(self, required_series=[]):
+        '''build series and ParameterNodes over memmap views of the sidecar for self.filepath.
+           returns False, loading nothing, if there is no current sidecar.
+        '''
+        index, series = sidecar_cache.load_sidecar(self.filepath, required_series)
+        if index is None:
+            return False
+        logger.info('loading from sidecar: '+ self.filepath)
+        self.duration = index['duration']
+        self.start_datetime = sidecar_cache.parse_start_datetime(index)
+        self.start_epoch = index['start_epoch']
+        self.superframe_present = index['superframe_present']
+        self.hdfaccess_version = index['hdfaccess_version']
+        self.reliable_frame_counter = index['reliable_frame_counter']
+        for k, hdf_param in series.items():
+            self.series[k] = hdf_param
+            if hdf_param.lfl==True:
+                self.lfl_params.append(k)
+            self.parameters[k] = param_node_from_hdf(hdf_param)
+        return True
+
+    def save_to_hdf5(self, hdf5_path, storage='settings'):
+        '''this will overwrite any existing file with the same name
+           storage: hdf5_storage.StoragePolicy for the series datasets, None for hdfaccess's defaults,
+              or 'settings' for hdf5_storage.default_policy()
+        '''
+        if storage=='settings':
+            storage = hdf5_storage.default_policy()
         with hdf_file(hdf5_path, cache_param_list=[], create=True) as hfile:
             # set attributes
             hfile.hdf.attrs['duration'] = self.duration
@@ -109,9 +370,14 @@ class Flight(object):
             hfile.hdf.attrs['aircraft_info'] = json.dumps(self.aircraft_info)           
             # save time series
             for k in self.parameters.keys():
-                hfile.set_param( self.parameters[k])
+                hdf5_storage.set_param(hfile, self.parameters[k], storage)
         return
     
+    def close(self):
+        '''close the hdf5 file kept open by lazy loading, if any'''
+        if isinstance(self.series, LazySeries):
+            self.series.close()
+
     def __repr__(self):
         s='class Flight'
         s = s+ '\n  filepath:       ' + str(self.filepath)
@@ -176,49 +442,30 @@ def make_kml_file(start_datetime, flight_attrs, kti, kpv, flight_file, REPORTS_D
     track_to_kml(output_path_and_file, kti, kpv, flight_attrs, dest_path=report_path_and_file)
     
 
-def pkl_suffix():
-    '''file suffix versioning'''
-    return 'ver'+analyzer_version.replace('.','_') +'.pkl'  # eg 0.0.5 => ver0_0_5.pkl
-
-def get_precomputed_parameters(flight):    #flight_path_and_file, flight):    
-    ''' if pkl file exists and matches version, read it into params dict'''
-    # suffix includes FDS version as a compatibility check
-    #source_file = flight_path_and_file.replace('.hdf5', pkl_suffix())
-    #precomputed_parameters={}
+def get_precomputed_parameters(flight, store=None):    #flight_path_and_file, flight):    
+    ''' flight parameters plus, if a param_store.ParamStore is given and holds a valid entry
+        for this file, analyzer version and node code, the base-derived nodes stored for it
+    '''
     precomputed_parameters = flight.parameters.copy()        
-    #if flight.filepath.find('.hdf5')<0:
-    if True:
+    if store is None:
         return precomputed_parameters
         
-    source_file = flight.filepath.replace('.hdf5', pkl_suffix()) 
-    if os.path.isfile(source_file):
-        logger.info('get_precomputed_profiles. found: '+ source_file)
-        #pdb.set_trace()
-        with open(source_file, 'rb') as pkl_file:
-            pickled_parameters = pickle.load(pkl_file)
-        precomputed_parameters.update(pickled_parameters)
+    stored_parameters = store.get(store.key(flight.filepath))
+    if stored_parameters is not None:
+        logger.info('get_precomputed_parameters. found %d stored nodes for %s', len(stored_parameters), flight.filepath)
+        precomputed_parameters.update(stored_parameters)
     else:
-        logger.info('No compatible precomputed profile found')
+        logger.info('No compatible precomputed parameters found')
     return precomputed_parameters
 
 
-def dump_pickles(output_path_and_file, params, kti, kpv, phases, approach, flight_attrs, logger):
-    #dump params to pickle file -- versioned
-    pkl_end = pkl_suffix()
-    pickle_file=output_path_and_file.replace('.hdf5',pkl_end )
-    with open(pickle_file, 'wb') as output:
-        pickle.dump(params, output)
-    with open( pickle_file.replace(pkl_end,'_kti_'+pkl_end), 'wb') as output:
-        pickle.dump(kti, output)
-    with open(pickle_file.replace(pkl_end,'_kpv_'+pkl_end), 'wb') as output:
-        pickle.dump(kpv, output)
-    with open(pickle_file.replace(pkl_end,'_phases_'+pkl_end), 'wb') as output:
-        pickle.dump(phases, output)
-    with open(pickle_file.replace(pkl_end,'_approach_'+pkl_end), 'wb') as output:
-        pickle.dump(approach, output)
-    with open(pickle_file.replace(pkl_end,'_fltattr_'+pkl_end), 'wb') as output:
-        pickle.dump(flight_attrs, output)
-    logger.info('saved '+ pickle_file)
+def dump_results(output_path_and_file, params, res, logger):
+    '''save kpv, kti, phases, approach and flight attributes in one versioned result container.
+       derived series are only listed, as their arrays are in the base hdf5 already.
+    '''
+    results_file = result_container.results_path(output_path_and_file)
+    result_container.write_results(results_file, res, params)
+    logger.info('saved '+ results_file)
 
 
 def report_sql(PROFILE_NAME, timestamp):
@@ -291,10 +538,13 @@ def prep_nodes(short_profile, module_names):
     return requested_params, available_nodes
                
 
-def prep_order(flight, frame_dict, start_datetime, derived_nodes, required_params):
-    ''' open example HDF to see recorded params and build process order'''
+def prep_order(flight, frame_dict, start_datetime, derived_nodes, required_params, plans=None, store=None):
+    ''' open example HDF to see recorded params and build process order
+        plans: optional plan_cache.PlanCache to look up / save the process order
+        store: optional param_store.ParamStore of precomputed base nodes
+    '''
     derived_nodes_copy = derived_nodes   #copy.deepcopy(derived_nodes)  #
-    precomputed_parameters = get_precomputed_parameters(flight)
+    precomputed_parameters = get_precomputed_parameters(flight, store)
     precomputed_keys=precomputed_parameters.keys()
     for k in flight.series.keys():
         if k not in precomputed_keys:
@@ -307,7 +557,10 @@ def prep_order(flight, frame_dict, start_datetime, derived_nodes, required_param
                             achieved_flight_record=flight.achieved_flight_record
                             )
     # calculate dependency tree
-    process_order, gr_st = dependency_order(node_mgr, draw=False)     
+    if plans is not None:
+        process_order = plans.process_order(node_mgr, flight.aircraft_info.get('Frame'))
+    else:
+        process_order, gr_st = dependency_order(node_mgr, draw=False)     
     logger.warning( 'process order: ' + str(process_order[:5]) + '...' ) #, gr_st
     return node_mgr, process_order  # a list of node names
     
@@ -451,10 +704,10 @@ def get_frequency_offset(mynode, deps):
         return frequency, offset, dependencies_to_align
 
 
-def get_deps_series(node_class, params, node_mgr, pre_aligned):
+def get_deps_series(node_class, params, node_mgr, aligner):
         # build ordered and aligned dependencies without touching an hdf file
         # 'params' is a dictionary of previously computed nodes: time series, kpv, etc.
-        # pre_aligned is a dictionary of pre-aligned params, key=(name, frequency, offset)
+        # aligner is the flight's align_engine.AlignmentEngine; it keeps the aligned deps, key=(name, frequency, offset)
         deps = []
         nd = node_class()
         node_deps = node_class.get_dependency_names()
@@ -481,26 +734,83 @@ def get_deps_series(node_class, params, node_mgr, pre_aligned):
         frequency, offset, deps_to_align = get_frequency_offset(node_class, deps) 
         nd.frequency = frequency
         nd.offset = offset
-        #pre-align
+        #pre-align: all deps needing alignment in one batch
+        to_align = [d if d in deps_to_align else None for d in deps]
+        aligned = aligner.align(to_align, nd)
         aligned_deps = []        
-        for d in deps:
-            if d in deps_to_align:
-                nodestr= '\t  dep_name:'+ d.name + ',  hdf?'+ str(d.name in node_mgr.hdf_keys) + ',  freq:'+str(frequency) + ',  offset:'+str(offset)
-                if pre_aligned.has_key((d.name, frequency, offset)):
-                    logger.debug( nodestr +  '---using pre-aligned')
-                    aligned_deps.append(  pre_aligned[(d.name, frequency, offset)]  )
-                else: 
-                    logger.debug( nodestr +  '***pre-aligning')
-                    pre_aligned[(d.name, frequency, offset)] = d.get_aligned(nd)
-                    aligned_deps.append(  pre_aligned[(d.name, frequency, offset)]  )
+        for d, a in zip(deps, aligned):
+            if a is not None:
+                logger.debug('\t  dep_name:'+ d.name + ',  hdf?'+ str(d.name in node_mgr.hdf_keys) + ',  freq:'+str(frequency) + ',  offset:'+str(offset))
+                aligned_deps.append( a )
             else: #no need to worry about alignment
                 aligned_deps.append( d )
-        return aligned_deps, pre_aligned, nd
+        return aligned_deps, aligner, nd
         
 
             
 
-def derive_parameters_series(flight, node_mgr, process_order, precomputed={}):
+def post_process_node(node, param_name, result, res, params, duration):
+    '''check and align a derived node's result, adding it to params and to the res lists by node type'''
+    if node.node_type is KeyPointValueNode:
+        #Q: track node instead of result here??
+        params[param_name] = result
+        for one_hz in result.get_aligned(P(frequency=1, offset=0)):
+            if not (0 <= one_hz.index <= duration):
+                raise IndexError("KPV '%s' index %.2f is not between 0 and %d" % (one_hz.name, one_hz.index, duration))
+            res['kpv'].append(one_hz)
+    
+    elif node.node_type is KeyTimeInstanceNode:
+        params[param_name] = result
+        for one_hz in result.get_aligned(P(frequency=1, offset=0)):
+            if not (0 <= one_hz.index <= duration):
+                raise IndexError("KTI '%s' index %.2f is not between 0 and %d" % (one_hz.name, one_hz.index, duration))
+            res['kti'].append(one_hz)
+    
+    elif node.node_type is FlightAttributeNode:
+        params[param_name] = result
+        try:
+            res['attr'].append(Attribute(result.name, result.value)) # only has one Attribute result
+        except:
+            logger.warning("Flight Attribute Node '%s' returned empty handed.", param_name)
+                
+    elif issubclass(node.node_type, SectionNode):
+        aligned_section, res['phase'] = align_section(result, duration, res['phase'])
+        params[param_name] = aligned_section  ### 
+        
+    elif issubclass(node.node_type, DerivedParameterNode):
+        logger.info('series: ' + param_name)
+        result = check_derived_array(param_name, result, duration)
+        #print str(result
+        res['series'][param_name] = result  
+        res['series'][param_name].name = param_name
+        params[param_name] = result
+        
+    elif issubclass(node.node_type, ApproachNode):
+        aligned_approach, res['approach'] = check_approach(result, duration, res['approach'])   
+        params[param_name] = aligned_approach
+    else:
+        raise NotImplementedError("Unknown Type %s" % node.__class__)
+
+
+def release_finished(names, aligner, params, res, keep, derived):
+    '''after the last consumer of names: drop their aligned copies and, unless keep is None,
+       the series derived in this flight that are not in keep.  KPV/KTI/section nodes are small
+       and their units are still looked up when results are saved, so they stay.
+       returns bytes released'''
+    released = 0
+    for name in names:
+        released += aligner.release(name)
+        if keep is None or name in keep or name not in derived:
+            continue
+        if name in params and hasattr(params[name], 'array'):
+            released += series_nbytes(params[name].array)
+            del params[name]
+            res['series'].pop(name, None)
+    return released
+
+
+def derive_parameters_series(flight, node_mgr, process_order, precomputed={}, incremental=None, profiler=None,
+                             keep=None, threads=1):
     '''
     Non HDF5 version. Suitable for FFD and Notebook profile development.
     
@@ -514,10 +824,30 @@ def derive_parameters_series(flight, node_mgr, process_order, precomputed={}):
     :type node_mgr: NodeManager
     :param process_order: Parameter / Node class names in the required order to be processed
     :type process_order: list of strings
+    :param precomputed: previously computed nodes; may be a LazyParameters proxy
+    :type precomputed: dict
+    :param incremental: stored results of an earlier run; unchanged nodes are re-used, not derived
+    :type incremental: incremental.IncrementalResults
+    :param profiler: records each derived node's time in get_deps_series, derive and post-processing
+    :type profiler: node_profiler.NodeProfiler
+    :param keep: names to keep to the end.  If given, derived nodes not in keep are dropped from params
+                 (and res['series']) after their last consumer.  Aligned copies are always dropped then.
+    :type keep: set of strings
+    :param threads: derive up to this many independent nodes at once (see dag_scheduler).  Results are
+                    committed in process_order either way, so res and params come out the same.
+    :type threads: int
     '''
     duration = flight.duration
     params    = precomputed #{}   # dictionary of derived params that aren't masked arrays
-    pre_aligned = {} #key = (name, frequency, offset)
+    aligner = align_engine.AlignmentEngine() # aligned deps, key = (name, frequency, offset)
+    lazy = isinstance(params, LazySeries)
+    if lazy:  # lets the reader evict series after their last consumer
+        params.plan(process_order, node_mgr.derived_nodes)
+    releases = {}  # step -> names whose last consumer is process_order[step]
+    for name, step in last_uses(process_order, node_mgr.derived_nodes).items():
+        releases.setdefault(step, []).append(name)
+    keep = frozenset(keep) if keep is not None else None
+    derived = set()  # nodes derived (or re-used from incremental) here
     res     = {'series':{}, 
               'approach': ApproachNode(restrict_names=False),
               'kpv': KeyPointValueNode(restrict_names=False),
@@ -530,7 +860,8 @@ def derive_parameters_series(flight, node_mgr, process_order, precomputed={}):
     #for p in process_order:
     #    print '  ',p
    
-    for param_name in process_order:
+    steps = {}  # nodes to derive -> position in process_order
+    for step, param_name in enumerate(process_order):
         #if param_name in node_mgr.hdf_keys:
         #   logger.info('_derive_: hdf '+param_name)            
         #   continue        
@@ -538,88 +869,87 @@ def derive_parameters_series(flight, node_mgr, process_order, precomputed={}):
 
         if node_mgr.get_attribute(param_name) is not None:
             logger.info('_derive_: get_attribute '+param_name)
-            continue
-        elif param_name in params.keys():  # already calculated
+        elif param_name in params:  # already calculated
             logger.info('_derive_: re-using precomputed'+param_name)
-            continue
         elif not node_mgr.derived_nodes.has_key(param_name):
             logger.info('_derive_: in process_order but not derived_nodes: '+param_name)
-            continue
-        elif param_name in res['series'].keys():
-            print 'derive_parameters: in series but not params:', param_name
-            #logger.info('_derive_: series'+param_name)
-            #continue
+        else:
+            steps[param_name] = step
+    to_derive = sorted(steps, key=steps.get)
+    incremental_lock = threading.Lock()
+    state = {'finished': -1, 'released': 0}  # steps whose consumers are all committed
+
+    def compute(param_name):
+        '''in a worker thread when threads > 1: only reads params'''
+        node_class = node_mgr.derived_nodes[param_name]  #NB raises KeyError if Node is "unknown"
+        if incremental is not None:
+            with incremental_lock:
+                stored = incremental.lookup(param_name)
+            if stored is not None:
+                logger.info('_derive_: re-using unchanged '+param_name)
+                return stored, True, 0.0, 0.0
 
         ####compute###########################################################    
         logger.info('_derive_: computing '+param_name)        
-        node_class = node_mgr.derived_nodes[param_name]  #NB raises KeyError if Node is "unknown"
 
+        started = time.time()
         try:        
-            deps, pre_aligned, node = get_deps_series(node_class, params, node_mgr, pre_aligned )
+            deps, _, node = get_deps_series(node_class, params, node_mgr, aligner )
         except Exception, e:
             logger.exception('ERROR '+param_name+' get_deps')
             raise
         
+        deps_done = time.time()
         try:
             node.derive(*deps) #node.get_derived(deps)
-            result = node
         except  Exception, e:
             logger.exception('ERROR '+param_name+' get_derived')
             raise            
-        
-        ###############################################################
-        #def post_process_node(flight, node, param_name, result, res, params)
-
-        #post-process (node, result, params, res)
-        if node.node_type is KeyPointValueNode:
-            #Q: track node instead of result here??
-            params[param_name] = result
-            for one_hz in result.get_aligned(P(frequency=1, offset=0)):
-                if not (0 <= one_hz.index <= duration):
-                    raise IndexError("KPV '%s' index %.2f is not between 0 and %d" % (one_hz.name, one_hz.index, duration))
-                res['kpv'].append(one_hz)
-        
-        elif node.node_type is KeyTimeInstanceNode:
-            params[param_name] = result
-            for one_hz in result.get_aligned(P(frequency=1, offset=0)):
-                if not (0 <= one_hz.index <= duration):
-                    raise IndexError("KTI '%s' index %.2f is not between 0 and %d" % (one_hz.name, one_hz.index, duration))
-                res['kti'].append(one_hz)
-        
-        elif node.node_type is FlightAttributeNode:
-            params[param_name] = result
-            try:
-                res['attr'].append(Attribute(result.name, result.value)) # only has one Attribute result
-            except:
-                logger.warning("Flight Attribute Node '%s' returned empty handed.", param_name)
-                    
-        elif issubclass(node.node_type, SectionNode):
-            aligned_section, res['phase'] = align_section(result, duration, res['phase'])
-            params[param_name] = aligned_section  ### 
-            
-        elif issubclass(node.node_type, DerivedParameterNode):
-            logger.info('series: ' + param_name)
-            result = check_derived_array(param_name, result, duration)
-            #print str(result
-            res['series'][param_name] = result  
-            res['series'][param_name].name = param_name
-            params[param_name] = result
-            
-        elif issubclass(node.node_type, ApproachNode):
-            aligned_approach, res['approach'] = check_approach(result, duration, res['approach'])   
-            params[param_name] = aligned_approach
-        else:
-            raise NotImplementedError("Unknown Type %s" % node.__class__)
-        continue
+        return node, False, deps_done-started, time.time()-deps_done
+
+    def finish_steps(last):
+        '''the nodes of process_order[:last+1] are committed: free what only they needed'''
+        for step in xrange(state['finished']+1, last+1):
+            if lazy:
+                params.advance(step)
+            state['released'] += release_finished(releases.get(step, ()), aligner, params, res, keep, derived)
+        state['finished'] = max(state['finished'], last)
+
+    def commit(param_name, computed):
+        '''on this thread, in process_order'''
+        result, reused, deps_seconds, derive_seconds = computed
+        finish_steps(steps[param_name]-1)
+        committed = time.time()
+        if not reused and incremental is not None:
+            incremental.record(param_name, result)
+        post_process_node(result, param_name, result, res, params, duration)
+        derived.add(param_name)
+        if profiler is not None and not reused:
+            profiler.record(param_name, result.node_type.__name__, deps_seconds, derive_seconds,
+                            time.time()-committed, series_nbytes(getattr(result, 'array', None)))
+
+    dependencies = dict((name, node_mgr.derived_nodes[name].get_dependency_names()) for name in to_derive)
+    dag_scheduler.run_in_order(to_derive, dependencies, compute, commit, threads)
+    released = state['released']
+    logger.info('_derive_: '+aligner.report()+', %.1f MB of nodes and copies released early' % (released/1048576.))
     return res, params
 
 ###################################################################################################
 
-def analyze_one(flight, output_path, profile, requested_params, available_nodes): 
+def analyze_one(flight, output_path, profile, requested_params, available_nodes, write_sidecar=False, plans=None,
+                store=None, incremental_dir=None, profiler=None, threads=1): 
         # , test_param_names, test_node_mgr, test_process_order):
-        '''analyze one flight'''
+        '''analyze one flight.  write_sidecar: for base, also write a memory-mapped sidecar of the output
+           plans: optional plan_cache.PlanCache; flights with the same plan key share one process order
+           store: optional param_store.ParamStore; base saves its derived nodes there, profiles start from them
+           incremental_dir: folder of per-flight stored node results; only nodes whose fingerprint
+              changed since the last run of this profile (and their descendants) are derived
+           profiler: optional node_profiler.NodeProfiler for per-node timing
+           threads: derive independent nodes of the flight in up to this many threads
+        '''
         #precomputed_parameters = flight.parameters.copy()        
-        precomputed_parameters = get_precomputed_parameters(flight)
+        # base input files are never in the store, so only profiles look there
+        precomputed_parameters = get_precomputed_parameters(flight, store if profile!='base' else None)
         available_nodes_copy        = available_nodes #copy.deepcopy(available_nodes)
         #if flight.parameters.keys() != test_param_names: #rats, have to redo this
         node_mgr = node.NodeManager( 
@@ -629,14 +959,35 @@ def analyze_one(flight, output_path, profile, requested_params, available_nodes)
                 achieved_flight_record=flight.achieved_flight_record
               )                  
         #pdb.set_trace()
-        process_order, gr_st = dependency_order(node_mgr, draw=False) 
-        res, params = derive_parameters_series(flight, node_mgr, process_order, precomputed_parameters)
+        if plans is not None:
+            process_order = plans.process_order(node_mgr, flight.aircraft_info.get('Frame'))
+        else:
+            process_order, gr_st = dependency_order(node_mgr, draw=False) 
+        stored_results = None
+        if incremental_dir:
+            stored_results = incremental.IncrementalResults(incremental_dir, profile, flight.filepath,
+                                                            incremental.fingerprints_for(available_nodes))
+        # base saves every derived series; profiles only need their requested nodes at the end
+        try:
+            res, params = derive_parameters_series(flight, node_mgr, process_order, precomputed_parameters,
+                                                   stored_results, profiler,
+                                                   keep=None if profile=='base' else requested_params,
+                                                   threads=threads)
+            if stored_results is not None:
+                stored_results.save()
+        finally:
+            if stored_results is not None:
+                stored_results.close()
         #post-process: save
         for k in res['series'].keys():
                 flight.parameters[k] = res['series'][k]
         if profile=='base': 
             flight.save_to_hdf5(output_path)
-            dump_pickles(output_path, params, res['kti'], res['kpv'], res['phase'], res['approach'], res['attr'], logger)
+            if write_sidecar:
+                sidecar_cache.write_sidecar(output_path, flight)
+            if store is not None:
+                store.put(store.key(output_path), params)
+            dump_results(output_path, params, res, logger)
         return flight, res, params
 
 def load_afr(fltrec, apt_dict, apt_rwy_dict):
@@ -655,8 +1006,9 @@ def load_afr(fltrec, apt_dict, apt_rwy_dict):
 
 
 def load_flight(filepath, frame_dict, frame_hdfseries, file_repository, 
-                         series_to_load=[], flightrec_dict=None, apt_dict=None, apt_rwy_dict=None):
-    '''load a Flight object'''
+                         series_to_load=[], flightrec_dict=None, apt_dict=None, apt_rwy_dict=None,
+                         lazy=False, byte_budget=None, use_sidecar=False):
+    '''load a Flight object.  lazy, byte_budget and use_sidecar are passed to Flight.load_from_hdf5'''
     aircraft_info = get_aircraft_info( filepath, frame_dict)                
     aircraft_info['Myfile']=filepath
     logger.debug(aircraft_info)
@@ -671,7 +1023,8 @@ def load_flight(filepath, frame_dict, frame_hdfseries, file_repository,
         flight.achieved_flight_record = load_afr(fltrec, apt_dict, apt_rwy_dict)
 
     if filepath.endswith('.hdf5'):
-        flight.load_from_hdf5(flight_dict, required_series=series_to_load)        
+        flight.load_from_hdf5(flight_dict, required_series=series_to_load, lazy=lazy, byte_budget=byte_budget,
+                              use_sidecar=use_sidecar)
     #elif filepath.endswith('.ffd'):
     #   flight.load_from_flight(flight_dict)        
     else:
@@ -686,14 +1039,17 @@ def analyzer_fail(flight_file):
         return tracebck               
 
 
-def group_flights_by_fleet(files_to_process, frame_dict):
+def group_flights_by_fleet(files_to_process, frame_dict, catalog=None):
     '''group flights by LFL / fleet type : dict {lfl: [files using lfl]}
     for each flight
      1. get tail #
      2. look up frame
      3. add flight to dict under lfl key
+    catalog: optional flight_catalog.FlightCatalog; catalogued files are grouped by its frame
     ''' 
     lfl_flights = {}
+    if catalog is not None:
+        lfl_flights, files_to_process = catalog.fleet_groups(files_to_process)
     for flight_file in files_to_process:
         acinfo = get_aircraft_info(flight_file, frame_dict)    
         lfl=acinfo['Frame']
@@ -704,6 +1060,99 @@ def group_flights_by_fleet(files_to_process, frame_dict):
     return lfl_flights    
 
         
+def analyze_file(flight_path_and_file, job, fleet, cn, reraise=True, sink=None):
+    '''load, analyze and save results for one flight file.
+       job holds the per-run settings built by run_analyzer, fleet the per-LFL
+       requested_params, available_nodes and series_to_load.
+       sink: optional columnar_sink.ColumnarSink that also gets the KPV/KTI/phase rows.
+       Returns a status dict: filepath, status ('ok' or 'fail'), processing_seconds, error,
+       and node_timing (node_profiler stats) if job['profile_nodes'].
+       On failure the exception is re-raised if reraise, otherwise reported in 'error'.
+    '''
+    short_profile = job['short_profile']
+    status=None
+    error=None
+    file_start_time = time.time()
+    flight_file          = os.path.basename(flight_path_and_file)
+    logger.warning('starting '+ flight_file)
+    flight, frame_hdfseries = load_flight(flight_path_and_file, job['frame_dict'], {}, job['file_repository'], 
+                                                             series_to_load=fleet['series_to_load'], 
+                                                             flightrec_dict=job['flightrec_dict'],
+                                                             apt_dict=job['apt_dict'], apt_rwy_dict=job['apt_rwy_dict'],
+                                                             lazy=job['lazy_series'], byte_budget=job['series_byte_budget'],
+                                                             use_sidecar=job['use_sidecar'] )
+    output_path  = get_output_file(job['output_dir'], flight_path_and_file, short_profile)
+    profiler = node_profiler.NodeProfiler() if job['profile_nodes'] else None
+    logger.info(' *** Processing flight %s', flight_file)
+    try: 
+        flight, res, params = analyze_one(flight, output_path, short_profile, 
+                                                              fleet['requested_params'], fleet['available_nodes'],
+                                                              write_sidecar=job['use_sidecar'],
+                                                              plans=plan_cache.get_cache(job['plan_cache_dir']),
+                                                              store=param_store.get_store(job['param_store_dir'], job['param_store_max_bytes']),
+                                                              incremental_dir=job['incremental_dir'],
+                                                              profiler=profiler, threads=job['derive_threads']) 
+        status='ok'
+    except Exception, e: 
+        analyzer_fail(flight_file)
+        print e
+        status='fail'
+        error = traceback.format_exc()
+        if reraise:
+            raise
+    finally:
+        flight.close()  # everything needed from the file has been read
+        
+    processing_time = time.time()-file_start_time
+    proc_time = "{:2.4f}".format(processing_time)
+    logger.warning(' *** Processing flight %s finished ' + flight_file + ' time: ' + proc_time + ' status: '+status)
+    if status=='ok' and job['save_oracle']:  fds_oracle.analyzer_to_oracle(cn, short_profile, res, params, flight, job['output_dir'], output_path, job['timestamp'])
+    if job['save_oracle'] and job['journal']:  # after the results, so with batch_writes in the same commit
+        run_journal.mark_done(cn, job['timestamp'], job['stage'], short_profile, flight_path_and_file, status, job['file_repository'])
+    if status=='ok' and sink is not None:  sink.add_results(flight, res, params, output_path)
+    if status=='ok' and job['make_kml']:    make_kml_file(job['start_datetime'], res['attr'], res['kti'], res['kpv'], flight_file, job['reports_dir'], output_path)
+    return {'filepath': flight_path_and_file, 'status': status, 
+            'processing_seconds': processing_time, 'error': error,
+            'node_timing': profiler.stats if profiler is not None else None}
+
+
+# per-process state of run_analyzer pool workers, set up by _init_worker
+_worker = {}
+
+def _init_worker(job, stop=None):
+    '''multiprocessing.Pool initializer: keep the run settings and open this worker's connection
+       (or batched writer, flushed when the worker exits).  Once stop (a multiprocessing.Event)
+       is set, queued flights are skipped.'''
+    from multiprocessing.util import Finalize  # Finalize(None, ...): run at worker exit, highest priority first
+    logging.basicConfig(level=job['LOG_LEVEL'])
+    _worker.clear()
+    _worker['job'] = job
+    _worker['stop'] = stop
+    _worker['cn'] = fds_db.get_backend(job['db_backend']).connect() if job['save_oracle'] else None
+    if _worker['cn'] is not None:
+        Finalize(None, _worker['cn'].close, exitpriority=5)  # back to the pool, after the writer's flush
+    if job['save_oracle'] and job['batch_writes']:
+        _worker['cn'] = result_writer.BatchedResultWriter(_worker['cn'])
+        Finalize(None, _worker['cn'].close, exitpriority=10)
+    _worker['sink'] = None
+    if job['columnar_dir']:
+        _worker['sink'] = columnar_sink.ColumnarSink(job['columnar_dir'], job['short_profile'], job['timestamp'])
+        Finalize(None, _worker['sink'].close, exitpriority=10)
+
+
+def _analyze_task(task):
+    '''pool task: one flight file.  failures come back in the status dict, never as exceptions'''
+    flight_path_and_file, fleet = task
+    if _worker['stop'] is not None and _worker['stop'].is_set():
+        return {'filepath': flight_path_and_file, 'status': 'skipped', 'processing_seconds': None, 'error': None}
+    try:
+        return analyze_file(flight_path_and_file, _worker['job'], fleet, _worker['cn'], reraise=False, sink=_worker['sink'])
+    except Exception, e:  # e.g. the file could not be loaded
+        analyzer_fail(os.path.basename(flight_path_and_file))
+        return {'filepath': flight_path_and_file, 'status': 'fail',
+                'processing_seconds': None, 'error': traceback.format_exc()}
+
+
 def run_analyzer(short_profile,    module_names,
                  LOG_LEVEL,           files_to_process_all,   
                  input_dir,        output_dir,       reports_dir, 
@@ -712,10 +1161,55 @@ def run_analyzer(short_profile,    module_names,
                  save_oracle=True, comment='',
                  file_repository='linux', 
                  start_datetime = datetime(2012, 4, 1, 0, 0, 0), 
-                 mortal=True ):    
+                 mortal=True,
+                 lazy_series=False, series_byte_budget=None,
+                 use_sidecar=False,
+                 workers=1,
+                 plan_cache_dir=None,
+                 param_store_dir=None, param_store_max_mb=None,
+                 incremental_dir=None,
+                 batch_writes=False,
+                 db_backend=None,
+                 columnar_dir=None,
+                 profile_nodes=None,
+                 derive_threads=None,
+                 largest_first=True,
+                 journal=True, resume_from=None ):    
     '''
     run FlightDataAnalyzer for analyze and profile. mostly file mgmt and reporting.
     afr_dict is an optional dictionary mapping file paths to airport/runway attributes.
+    lazy_series reads each series from hdf5 only when a node first needs it;
+    series_byte_budget (bytes) then caps how much loaded series data is kept per flight.
+    use_sidecar: base writes a memory-mapped sidecar next to each _base.hdf5; profiles load from it.
+    workers: with more than 1, flights are handed one at a time to a local multiprocessing pool.
+       Each worker saves its own results to Oracle; status and timing come back to this process.
+       If mortal, the first failed flight stops the run.
+    plan_cache_dir: folder to persist dependency plans in, defaults to settings.PLAN_CACHE_PATH if set.
+       Plans are always shared between flights with the same LFL and recorded parameters.
+    param_store_dir: folder of the precomputed-parameter store (settings.PARAM_STORE_PATH if set),
+       capped at param_store_max_mb (settings.PARAM_STORE_MAX_MB).  Base fills it, profiles read it.
+    incremental_dir: keep per-flight node results there (settings.INCREMENTAL_PATH) and on later runs
+       derive only nodes whose source, or a dependency's source, changed.
+    batch_writes: KPV/KTI/phase/flight record/timing rows go through a background
+       result_writer.BatchedResultWriter, committed once per batch instead of per table and flight.
+    db_backend: 'oracle' or 'sqlite' (see fds_db), defaults to settings.DB_BACKEND.
+    columnar_dir: also write KPV/KTI/phase rows as column files there (settings.COLUMNAR_SINK_PATH),
+       partitioned by profile and run; see columnar_sink.
+    profile_nodes: time every node of every flight (settings.PROFILE_NODES); the slowest nodes are logged
+       at the end of the run and, with save_oracle, all of them go to fds_node_timing.  See node_profiler.
+    derive_threads: derive independent nodes of each flight in up to this many threads
+       (settings.DERIVE_THREADS, default 1).  Mostly for single long flights; with workers > 1 the
+       cores are usually busy already.
+    largest_first: within each fleet, process the flights expected to take longest first (estimated from
+       fds_processing_time with save_oracle, and file sizes, see work_scheduler), so no long flight is
+       left to the end.
+    journal: record each finished flight in fds_run_journal (with save_oracle; skipped with a warning if
+       the schema has no such table) or else, if settings.RUN_JOURNAL_PATH is set, in a journal file there.
+       See run_journal.
+    resume_from: the run time (timestamp) of an interrupted run.  Its flights journaled 'ok' are skipped,
+       the others processed again under the same run time.
+    With settings.FLIGHT_CATALOG_PATH set, the flight catalog is refreshed for files_to_process_all
+    (only new or changed files are opened) and used to group flights by frame and for their durations.
     '''
     print 'mortal', mortal
     logger = initialize_logger(LOG_LEVEL)
@@ -723,88 +1217,193 @@ def run_analyzer(short_profile,    module_names,
     if not files_to_process_all or len(files_to_process_all)==0:
         logger.warning('run_analyzer: No files to process.')
         return
-    timestamp = datetime.now()
+    timestamp = resume_from or datetime.now()
 
     # get frame info    
     frame_dict = frame_list.build_frame_list(logger)
     frame_hdfseries = {} # for each lfl, keep a list of available hdf series    
     
-    cn = fds_oracle.get_connection() 
-
-    #load airport and runway info
-    cur = cn.cursor()
-    apt_dict = load_apt_rwy.get_apt_dict(cur)
-    print  "apt_dict['KEWR']", apt_dict['KEWR']      
-    apt_rwy_dict = load_apt_rwy.get_apt_rwy_dict(cur)
-    cur.close()
-
-    '''process each fleet separately'''
-    lfl_flights = group_flights_by_fleet(files_to_process_all, frame_dict)
-    #start of fleet loop
-    for lfl in lfl_flights.keys():
-        print "processing LFL", lfl
-        files_to_process = lfl_flights[lfl]
+    backend = fds_db.get_backend(db_backend)
+    # the database is only needed to save results, or for airport/runway data for AFRs
+    cn = backend.connect() if save_oracle or flightrec_dict else None
+
+    if save_oracle and (journal or resume_from) and not run_journal.has_table(cn):
+        if resume_from:
+            raise ValueError('run_analyzer: resume_from needs the fds_run_journal table, see asias_fds_oracle.sql')
+        logger.warning('run_analyzer: no fds_run_journal table (see asias_fds_oracle.sql), flights are not journaled')
+        journal = False
+    file_journal = None
+    journal_dir = getattr(settings, 'RUN_JOURNAL_PATH', None)
+    if journal and not save_oracle and journal_dir:
+        file_journal = run_journal.FileJournal(run_journal.journal_path(journal_dir, stage, short_profile, timestamp))
+    if resume_from:
+        if save_oracle:
+            done = run_journal.completed(cn, timestamp, stage, short_profile)
+            run_journal.clear_unfinished(cn, timestamp, stage, short_profile)
+        elif file_journal is not None:
+            done = file_journal.completed()
+        else:
+            raise ValueError('run_analyzer: resume_from needs save_oracle or settings.RUN_JOURNAL_PATH')
+        files_to_process_all = [f for f in files_to_process_all if os.path.basename(f) not in done]
+        logger.warning('run_analyzer: resuming run %s, %d flights done, %d to go', timestamp, len(done),
+                       len(files_to_process_all))
+        if not files_to_process_all:
+            if cn is not None:
+                cn.close()
+            return {'timestamp': timestamp, 'file_count': 0, 'ok_count': 0, 'fail_count': 0}
+
+    #load airport and runway info, only used for AFRs
+    apt_dict, apt_rwy_dict = backend.load_apt_rwy(cn) if flightrec_dict else ({}, {})
+    print  "apt_dict['KEWR']", apt_dict.get('KEWR')      
+
+    job = {'short_profile': short_profile, 'LOG_LEVEL': LOG_LEVEL, 'timestamp': timestamp, 
+           'frame_dict': frame_dict, 'file_repository': file_repository, 
+           'flightrec_dict': flightrec_dict, 'apt_dict': apt_dict, 'apt_rwy_dict': apt_rwy_dict,
+           'output_dir': output_dir, 'reports_dir': reports_dir, 'start_datetime': start_datetime,
+           'save_oracle': save_oracle, 'make_kml': make_kml, 
+           'lazy_series': lazy_series, 'series_byte_budget': series_byte_budget, 'use_sidecar': use_sidecar,
+           'plan_cache_dir': plan_cache_dir or getattr(settings, 'PLAN_CACHE_PATH', None),
+           'param_store_dir': param_store_dir or getattr(settings, 'PARAM_STORE_PATH', None),
+           'param_store_max_bytes': None,
+           'incremental_dir': incremental_dir or getattr(settings, 'INCREMENTAL_PATH', None),
+           'batch_writes': batch_writes, 'db_backend': backend.name,
+           'columnar_dir': columnar_dir or getattr(settings, 'COLUMNAR_SINK_PATH', None),
+           'profile_nodes': profile_nodes if profile_nodes is not None else getattr(settings, 'PROFILE_NODES', False),
+           'derive_threads': derive_threads or getattr(settings, 'DERIVE_THREADS', 1),
+           'stage': stage, 'journal': journal,
+          }
+    run_profiler = node_profiler.NodeProfiler() if job['profile_nodes'] else None
+    param_store_max_mb = param_store_max_mb or getattr(settings, 'PARAM_STORE_MAX_MB', None)
+    if param_store_max_mb:
+        job['param_store_max_bytes'] = int(param_store_max_mb*1024*1024)
+    # results and timing rows go to writer; job records and queries use cn directly
+    writer = cn
+    sink = None
+    pool = None
+    run_failed = True
+    try:
+        if save_oracle and batch_writes:
+            writer = result_writer.BatchedResultWriter(backend.connect())
+        if job['columnar_dir'] and workers <= 1:
+            sink = columnar_sink.ColumnarSink(job['columnar_dir'], short_profile, timestamp)
+        if workers > 1:
+            import multiprocessing
+            stop = multiprocessing.Event()  # set on a mortal failure: workers skip the flights still queued
+            pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(job, stop))
+            logger.warning('run_analyzer: using a pool of '+str(workers)+' workers')
+
+        '''process each fleet separately'''
+        catalog = flight_catalog.get_catalog(getattr(settings, 'FLIGHT_CATALOG_PATH', None))
+        if catalog is not None:
+            catalog.refresh(files_to_process_all, file_repository, frame_dict)
+        lfl_flights = group_flights_by_fleet(files_to_process_all, frame_dict, catalog)
+        history, per_mb = {}, None
+        if largest_first and save_oracle:
+            try:
+                history = work_scheduler.processing_history(cn, stage, short_profile, files_to_process_all)
+                per_mb = work_scheduler.processing_rate(cn, stage, short_profile)
+            except Exception:  # e.g. a new database without timing rows
+                logger.warning('run_analyzer: no processing history, ordering by file size')
+
+        #start of fleet loop
+        for lfl in lfl_flights.keys():
+            print "processing LFL", lfl
+            files_to_process = lfl_flights[lfl]
+            if largest_first:
+                costs = work_scheduler.estimate_costs(files_to_process, history,
+                                                      catalog.durations(files_to_process) if catalog else None,
+                                                      per_mb)
+                files_to_process = work_scheduler.largest_first(files_to_process, costs)
+                if workers > 1:
+                    logger.warning('run_analyzer: ' + work_scheduler.schedule_report(
+                        costs, work_scheduler.lpt_assign(files_to_process, costs, workers)[1]))
     
-        requested_params, available_nodes = prep_nodes(short_profile, module_names)
-        test_file    = files_to_process[0]
+            requested_params, available_nodes = prep_nodes(short_profile, module_names)
+            test_file    = files_to_process[0]
         
-        test_flight, frame_hdfseries = load_flight( test_file, frame_dict, frame_hdfseries, file_repository, 
-                                                                           flightrec_dict=flightrec_dict, 
-                                                                           apt_dict=apt_dict, apt_rwy_dict=apt_rwy_dict  )
-        logger.warning( 'test_file for prep_order(): '+ test_file)
-        #test_param_names = test_flight.parameters.keys()
-        test_node_mgr, test_process_order = prep_order(test_flight, frame_dict, start_datetime, 
-                                                                                       available_nodes, requested_params)
-        if short_profile=='base':
-            series_to_load= []
-        else:
-            tpo=set(test_process_order)    
-            series_to_load = tpo.intersection(test_flight.series.keys())
+            # only the names of the recorded series are needed for planning, so don't read any data
+            test_flight, frame_hdfseries = load_flight( test_file, frame_dict, frame_hdfseries, file_repository, 
+                                                                               flightrec_dict=flightrec_dict, 
+                                                                               apt_dict=apt_dict, apt_rwy_dict=apt_rwy_dict,
+                                                                               lazy=True )
+            logger.warning( 'test_file for prep_order(): '+ test_file)
+            #test_param_names = test_flight.parameters.keys()
+            test_node_mgr, test_process_order = prep_order(test_flight, frame_dict, start_datetime, 
+                                                                                           available_nodes, requested_params,
+                                                                                           plans=plan_cache.get_cache(job['plan_cache_dir']),
+                                                                                           store=param_store.get_store(job['param_store_dir'], job['param_store_max_bytes']) if short_profile!='base' else None)
+            if short_profile=='base':
+                series_to_load= []
+            else:
+                tpo=set(test_process_order)    
+                series_to_load = tpo.intersection(test_flight.series.keys())
+            test_flight.close()
+            fleet = {'requested_params': requested_params, 'available_nodes': available_nodes,
+                     'series_to_load': series_to_load}
             
-        ### loop over files and compute nodes for each
-        file_count = len(files_to_process)
-        ok_count = 0
-        fail_count = 0
-        logger.warning( 'Processing '+str(file_count)+' files.' )
-        start_time = time.time()
-        for flight_path_and_file in files_to_process:
-            status=None
-            file_start_time = time.time()
-            flight_file          = os.path.basename(flight_path_and_file)
-            logger.warning('starting '+ flight_file)
-            flight, frame_hdfseries = load_flight(flight_path_and_file, frame_dict, frame_hdfseries, file_repository, 
-                                                                     series_to_load=series_to_load, 
-                                                                     flightrec_dict=flightrec_dict,
-                                                                     apt_dict=apt_dict, apt_rwy_dict=apt_rwy_dict  )
-            output_path  = get_output_file(output_dir, flight_path_and_file, short_profile)
-            logger.info(' *** Processing flight %s', flight_file)
-            try: 
-                flight, res, params = analyze_one(flight, output_path, short_profile, 
-                                                                      requested_params, available_nodes) 
-                status='ok'
-                ok_count += 1
-            except Exception, e: 
-                analyzer_fail(flight_file)
-                print e
-                status='fail'
-                fail_count += 1
-                if not mortal: 
-                    continue
+            ### loop over files and compute nodes for each
+            file_count = len(files_to_process)
+            ok_count = 0
+            fail_count = 0
+            logger.warning( 'Processing '+str(file_count)+' files.' )
+            start_time = time.time()
+            if pool:
+                # hand out one file at a time so long flights don't hold up a static share
+                flight_results = pool.imap_unordered(_analyze_task, [(f, fleet) for f in files_to_process], chunksize=1)
+            else:
+                flight_results = (analyze_file(f, job, fleet, writer, reraise=mortal, sink=sink) for f in files_to_process)
+            for flight_result in flight_results:
+                flight_path_and_file = flight_result['filepath']
+                status = flight_result['status']
+                if file_journal is not None:
+                    file_journal.mark_done(flight_path_and_file, status)
+                if status=='ok':
+                    ok_count += 1
                 else:
-                    raise
-                
-            proc_time = "{:2.4f}".format(time.time()-file_start_time)
-            logger.warning(' *** Processing flight %s finished ' + flight_file + ' time: ' + proc_time + ' status: '+status)
-            processing_time = time.time()-file_start_time
-            if save_oracle: fds_oracle.report_timing(timestamp, stage, short_profile, flight_path_and_file, processing_time, status, logger, cn, file_repository)
-            if status=='ok' and save_oracle:  fds_oracle.analyzer_to_oracle(cn, short_profile, res, params, flight, output_dir, output_path, timestamp)
-            if status=='ok' and make_kml:    make_kml_file(start_datetime, res['attr'], res['kti'], res['kpv'], flight_file, reports_dir, output_path)
-            #end of fleet loop                    
-
+                    fail_count += 1
+                    if not mortal: 
+                        continue
+                    else:  # only a pool worker gets here; serial runs have already raised
+                        # let the workers exit normally, so their writers flush what finished flights queued
+                        stop.set()
+                        pool.close()
+                        pool.join()
+                        raise RuntimeError('ANALYZER ERROR '+flight_path_and_file+'\n'+flight_result['error'])
+                processing_time = flight_result['processing_seconds']
+                if run_profiler is not None:
+                    run_profiler.merge(flight_result['node_timing'])
+                if save_oracle: fds_oracle.report_timing(timestamp, stage, short_profile, flight_path_and_file, processing_time, status, logger, writer, file_repository)
+                #end of fleet loop                    
+        run_failed = False
+    finally:
+        # keep rows already queued for finished flights, even if a flight failed,
+        # without hiding that failure behind a writer error
+        if writer is not cn:
+            try:
+                writer.close(raise_error=not run_failed)
+            finally:
+                writer.connection.close()
+        if sink is not None:
+            sink.close()
+        if run_failed:
+            if pool:
+                pool.terminate()
+                pool.join()
+            if cn is not None:
+                cn.close()
+    if run_profiler is not None:
+        logger.warning('run_analyzer: node timing\n' + run_profiler.report())
+        if save_oracle:
+            run_profiler.save(cn, timestamp, stage, short_profile)
+    if pool:
+        pool.close()
+        pool.join()
     fds_oracle.report_job(timestamp, stage, short_profile, comment, 
                                       file_repository, input_dir, output_dir, 
-                                      len(files_to_process), (time.time()-start_time), logger, db_connection=cn)
-    cn.close()
+                                      len(files_to_process), (time.time()-start_time), logger,
+                                      db_connection=cn if save_oracle else None)
+    if cn is not None:
+        cn.close()
     #for handler in logger.handlers(): handler.close()
     analyzer_status = {'timestamp':timestamp, 'file_count':file_count, 
                                    'ok_count':ok_count, 'fail_count':fail_count 
@@ -814,8 +1413,11 @@ def run_analyzer(short_profile,    module_names,
 
 def parallel_directview_generic(PROFILE_NAME, module_names, FILE_REPOSITORY, LOG_LEVEL, 
                FILES_TO_PROCESS, input_dir, output_dir, reports_dir,
-               COMMENT, MAKE_KML_FILES ):
-    '''sets up worker namespaces for ipython parallel runs'''
+               COMMENT, MAKE_KML_FILES, history=None ):
+    '''sets up worker namespaces for ipython parallel runs.
+       files are split across engines by estimated cost, largest first (see work_scheduler);
+       history: optional work_scheduler.processing_history(..., FILES_TO_PROCESS) for the estimates
+    '''
     print "Run 'ipcluster start -n 10' from the command line first!"
     #from IPython import parallel
     from IPython.parallel import Client
@@ -831,7 +1433,11 @@ def parallel_directview_generic(PROFILE_NAME, module_names, FILE_REPOSITORY, LOG
     dview['PROFILE_NAME'] = PROFILE_NAME
     dview['COMMENT'] = COMMENT
     dview['LOG_LEVEL'] = LOG_LEVEL 
-    dview.scatter('files_to_process', FILES_TO_PROCESS)
+    costs = work_scheduler.estimate_costs(FILES_TO_PROCESS, history)
+    engine_files, loads = work_scheduler.lpt_assign(FILES_TO_PROCESS, costs, len(c.ids))
+    for engine_id, files in zip(c.ids, engine_files):
+        c[engine_id]['files_to_process'] = files
+    print work_scheduler.schedule_report(costs, loads)
     dview['file_repository'] = FILE_REPOSITORY    
     dview['MAKE_KML_FILES'] = MAKE_KML_FILES 
     
@@ -898,4 +1504,4 @@ if __name__=='__main__':
     files_to_process = fds_oracle.flight_record_filepaths(query)
     lfl_flights = group_flights_by_fleet(files_to_process, frame_dict)
     print lfl_flights
-    print 'loaded'
\ No newline at end of file
+    print 'loaded'
\ No newline at end of file
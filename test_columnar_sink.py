@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+test_columnar_sink.py
+
+ run 'nosetests -v test_columnar_sink.py'
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import fds_db
+import columnar_sink as cs
+
+RUN = datetime(2013, 5, 1, 10, 30, 15, 250000)
+
+
+class Value(object):
+    def __init__(self, name, index, value=None, stop_edge=None):
+        self.name = name
+        self.index = self.start_edge = index
+        self.value = value
+        self.stop_edge = stop_edge
+
+
+class Units(object):
+    units = 'kt'
+
+
+class FakeFlight(object):
+    filepath = '/data/a.hdf5'
+    file_repository = 'linux'
+
+
+class TestRoundTrip(unittest.TestCase):
+    '''sink -> read_table -> bulk_load, as a local run and its later load'''
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sink_dir = os.path.join(self.folder, 'sink')
+        res = {'kpv': [Value('Airspeed Max', 10.0, 250.0), Value('Pitch Max', 12.0, 9.5)],
+               'kti': [Value('Touchdown', 300.0), Value('Liftoff', 0)],
+               'phase': [Value('Airborne', 5.0, stop_edge=295.0)]}
+        sink = cs.ColumnarSink(self.sink_dir, 'base', RUN)
+        sink.add_results(FakeFlight(), res, {'Airspeed Max': Units()}, '/out/a_base.hdf5')
+        sink.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_read_table(self):
+        kpv = cs.read_table(self.sink_dir, 'kpv', profile='base')
+        self.assertEqual(sorted(kpv['name']), ['Airspeed Max', 'Pitch Max'])
+        self.assertEqual(set(kpv['units']), set(['kt', '']))
+        self.assertEqual(len(cs.read_table(self.sink_dir, 'kti')['name']), 1)  # no index, as kti_to_oracle
+        self.assertEqual(len(cs.read_table(self.sink_dir, 'kpv', names=['Pitch Max'])['name']), 1)
+        self.assertEqual(len(cs.read_table(self.sink_dir, 'kpv', run_from=datetime(2013, 5, 2))['name']), 0)
+
+    def test_bulk_load(self):
+        cn = fds_db.SQLiteBackend(os.path.join(self.folder, 'load.sqlite')).connect()
+        for table in cs.TABLES:
+            cs.bulk_load(cn, self.sink_dir, table)
+        rows = cn.execute('select profile, source_file, name, value, units, run_time from fds_kpv order by name').fetchall()
+        self.assertEqual(rows, [(u'base', u'a.hdf5', u'Airspeed Max', 250.0, u'kt', RUN),
+                                (u'base', u'a.hdf5', u'Pitch Max', 9.5, None, RUN)])
+        self.assertEqual(cn.execute('select duration, run_time from fds_phase').fetchall(), [(290.0, RUN)])
+        cn.close()
+
+    def test_old_partition_name(self):
+        os.rename(cs.partition_path(self.sink_dir, 'base', RUN),
+                  os.path.join(self.sink_dir, 'profile=base', 'run_time=20130501T103015'))
+        kpv = cs.read_table(self.sink_dir, 'kpv')
+        self.assertEqual(set(kpv['run_time']), set([datetime(2013, 5, 1, 10, 30, 15).strftime(cs.RUN_TIME_FORMAT)]))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+test_dag_scheduler.py
+
+ run 'nosetests -v test_dag_scheduler.py'
+"""
+import time
+import random
+import threading
+import unittest
+import dag_scheduler as ds
+
+# a diamond plus independent branches, in a valid process order
+NAMES = ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+DEPS = {'b': ['a'], 'c': ['a'], 'd': ['b', 'c'], 'f': ['e', 'precomputed'], 'g': ['d', 'f']}
+
+
+class Recorder(object):
+    def __init__(self):
+        self.committed = []
+        self.lock = threading.Lock()
+        self.started = {}
+
+    def compute(self, name):
+        with self.lock:
+            self.started[name] = list(self.committed)
+        time.sleep(random.random()*0.01)
+        return name.upper()
+
+    def commit(self, name, result):
+        self.committed.append((name, result))
+
+
+class TestRunInOrder(unittest.TestCase):
+    def check(self, threads):
+        rec = Recorder()
+        ds.run_in_order(NAMES, DEPS, rec.compute, rec.commit, threads)
+        self.assertEqual(rec.committed, [(n, n.upper()) for n in NAMES])
+        committed = lambda name: [c[0] for c in rec.started[name]]
+        for name, needs in DEPS.items():
+            for need in needs:
+                if need in NAMES:
+                    self.assertTrue(need in committed(name), (name, need))
+        return rec
+
+    def test_sequential(self):
+        self.check(1)
+
+    def test_threads(self):
+        for i in range(5):
+            self.check(4)
+
+    def test_overlap(self):
+        # e does not depend on a, so with threads it runs while a is still computing
+        e_started = threading.Event()
+        def compute(name):
+            if name == 'e':
+                e_started.set()
+            if name == 'a':
+                e_started.wait(5)
+                return e_started.is_set()
+            return name
+        results = {}
+        ds.run_in_order(NAMES, DEPS, compute, results.__setitem__, 2)
+        self.assertTrue(results['a'])
+
+    def test_error(self):
+        def compute(name):
+            if name == 'd':
+                raise ValueError(name)
+            return name
+        committed = []
+        self.assertRaises(ValueError, ds.run_in_order, NAMES, DEPS, compute,
+                          lambda n, r: committed.append(n), 3)
+        self.assertTrue('d' not in committed and 'g' not in committed)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+test_flight_catalog.py
+
+ run 'nosetests -v test_flight_catalog.py'
+"""
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+
+import flight_catalog as fc
+
+A320 = [['Airspeed', 1.0, 0.5], ['Altitude STD', 4.0, 0.25]]
+B737 = [['Airspeed', 2.0, 0.1], ['Heading', 4.0, 0.0]]
+
+
+class FakeReader(object):
+    '''metadata by file name instead of from hdf5'''
+    def __init__(self):
+        self.reads = []
+
+    def __call__(self, path, frame_dict=None):
+        self.reads.append(os.path.basename(path))
+        a320 = os.path.basename(path).startswith('a320')
+        info = {'Tail Number': 'N320' if a320 else 'N737', 'Frame': 'A320' if a320 else 'B737',
+                'Series': 'A320-200' if a320 else 'B737-300', 'Precise Positioning': True}
+        return {'tail': info['Tail Number'], 'frame': info['Frame'], 'aircraft_info': info,
+                'duration': 3600.0 if a320 else 7200.0, 'start_datetime': datetime(2013, 1, 1 if a320 else 2),
+                'params': A320 if a320 else B737}
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = os.path.join(self.folder, 'data')
+        os.makedirs(self.data)
+        for name in ('a320_1.hdf5', 'a320_2.hdf5', 'b737_1.hdf5'):
+            self.touch(name)
+        self.catalog = fc.FlightCatalog(os.path.join(self.folder, 'catalog', 'catalog.sqlite'))
+        self.reader = FakeReader()
+        self.catalog.refresh_folder(self.data, reader=self.reader)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.folder)
+
+    def touch(self, name, content='x'):
+        with open(os.path.join(self.data, name), 'w') as f:
+            f.write(content)
+        return os.path.join(self.data, name)
+
+    def test_incremental(self):
+        self.assertEqual(sorted(self.reader.reads), ['a320_1.hdf5', 'a320_2.hdf5', 'b737_1.hdf5'])
+        changed = self.touch('a320_2.hdf5', 'longer')
+        os.utime(changed, (time.time()+10, time.time()+10))
+        os.remove(os.path.join(self.data, 'b737_1.hdf5'))
+        self.reader.reads = []
+        self.assertEqual(self.catalog.refresh_folder(self.data, reader=self.reader), (1, 1))
+        self.assertEqual(self.reader.reads, ['a320_2.hdf5'])
+        self.assertEqual(len(self.catalog.files()), 2)
+
+    def test_queries(self):
+        self.assertEqual([os.path.basename(f) for f in self.catalog.files(frame='A320')], ['a320_1.hdf5', 'a320_2.hdf5'])
+        self.assertEqual(len(self.catalog.files(recorded=['Heading'])), 1)
+        self.assertEqual(self.catalog.files(recorded=['Pitch']), [])
+        self.assertEqual(len(self.catalog.files(start_from=datetime(2013, 1, 2))), 1)
+        self.assertEqual(len(self.catalog.files(folder=self.data, min_duration=4000)), 1)
+        self.assertEqual(self.catalog.files(folder=self.data + '_other'), [])
+
+    def test_planning(self):
+        files = self.catalog.files() + ['/not/catalogued.hdf5']
+        groups, missing = self.catalog.fleet_groups(files)
+        self.assertEqual(sorted((k, len(v)) for k, v in groups.items()), [('A320', 2), ('B737', 1)])
+        self.assertEqual(missing, ['/not/catalogued.hdf5'])
+        self.assertEqual(sorted(self.catalog.durations(files).values()), [3600.0, 3600.0, 7200.0])
+        self.assertEqual(self.catalog.parameters(groups['B737'][0]), sorted(B737))
+        info = self.catalog.aircraft_info(groups['A320'])[groups['A320'][0]]
+        self.assertEqual(info['Series'], 'A320-200')
+        self.assertEqual(info['Precise Positioning'], True)
+        # one parameter set per LFL
+        self.assertEqual(len(self.catalog.cn.execute('select * from param_set').fetchall()), 2)
+
+    def test_frame_dict_changed(self):
+        self.reader.reads = []
+        self.assertEqual(self.catalog.refresh_folder(self.data, frame_dict={'N320': 'A320'}, reader=self.reader), (3, 0))
+        self.assertEqual(self.catalog.refresh_folder(self.data, frame_dict={'N320': 'A320'}, reader=self.reader), (0, 3))
+        self.assertEqual(self.catalog.refresh_folder(self.data, reader=self.reader), (0, 3))
+        self.assertEqual(self.catalog.refresh_folder(self.data, frame_dict={'N320': 'A321'}, reader=self.reader), (3, 0))
+
+    def test_old_catalog(self):
+        path = os.path.join(self.folder, 'old.sqlite')
+        cn = sqlite3.connect(path)
+        cn.execute('''create table flight_file (path text primary key, size integer, mtime real, file_repository text,
+                      tail text, frame text, duration real, start_datetime timestamp, param_set_id integer)''')
+        cn.commit()
+        cn.close()
+        catalog = fc.FlightCatalog(path)
+        self.assertEqual(catalog.refresh_folder(self.data, reader=self.reader), (3, 0))
+        self.assertEqual(len(catalog.aircraft_info(catalog.files(frame='B737'))), 1)
+        catalog.close()
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
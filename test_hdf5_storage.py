@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+test_hdf5_storage.py
+
+ run 'nosetests -v test_hdf5_storage.py'
+"""
+import unittest
+import numpy as np
+import hdf5_storage as hs
+
+
+class TestStoragePolicy(unittest.TestCase):
+    def test_whole_series_chunk(self):
+        policy = hs.StoragePolicy('lzf')
+        kwargs = policy.dataset_kwargs('Airspeed', np.ma.zeros(14400))
+        self.assertEqual(kwargs, {'compression': 'lzf', 'shuffle': True, 'chunks': (14400,)})
+
+    def test_long_series_chunk(self):
+        policy = hs.StoragePolicy('deflate', chunk_bytes=8000)
+        kwargs = policy.dataset_kwargs('Acceleration Normal', np.ma.zeros(100000))
+        self.assertEqual(kwargs['chunks'], (1000,))
+        self.assertEqual(kwargs['compression_opts'], 4)
+
+    def test_rules(self):
+        policy = hs.StoragePolicy('lzf', rules=[('Latitude*', 'deflate'), ('Eng (*', None)])
+        self.assertEqual(policy.filter_for('Latitude Smoothed'), 'deflate')
+        self.assertEqual(policy.dataset_kwargs('Eng (1) N1', np.ma.zeros(10)), None)
+        self.assertEqual(policy.filter_for('Airspeed'), 'lzf')
+
+    def test_masks(self):
+        self.assertEqual(hs.StoragePolicy('lzf', compact_masks=False).mask_kwargs('x', np.ma.zeros(10)), None)
+        self.assertEqual(hs.StoragePolicy('lzf').mask_kwargs('x', np.ma.zeros(10))['compression_opts'], 9)
+
+    def test_unknown_filter(self):
+        self.assertRaises(ValueError, hs.StoragePolicy, 'zstd')
+
+
+class FakeGroup(dict):
+    def __init__(self):
+        dict.__init__(self)
+        self.created = []
+
+    def create_dataset(self, name, data=None, **kwargs):
+        self.created.append(name)
+        self[name] = (np.asarray(data), kwargs)
+
+
+class FakeFile(object):
+    '''hdfaccess-like file recording what set_param and create_dataset are asked for'''
+    DATASET_KWARGS = {'compression': 'gzip', 'compression_opts': 6}
+
+    def __init__(self):
+        self.hdf = {'series': {}}
+
+    def set_param(self, param, save_data=True, save_mask=True):
+        group = self.hdf['series'].setdefault(param.name.replace('/', '_'), FakeGroup())
+        if save_data:
+            group.create_dataset('data', data=np.ma.getdata(param.array), **self.DATASET_KWARGS)
+        if save_mask:
+            group.create_dataset('mask', data=np.ma.getmaskarray(param.array), **self.DATASET_KWARGS)
+
+
+class Param(object):
+    def __init__(self, name, array):
+        self.name = name
+        self.array = array
+
+
+class TestSetParam(unittest.TestCase):
+    def test_datasets_written_once(self):
+        hfile = FakeFile()
+        array = np.ma.array([1.0, 2.0, 3.0], mask=[False, True, False])
+        hs.set_param(hfile, Param('Airspeed', array), hs.StoragePolicy('lzf'))
+        group = hfile.hdf['series']['Airspeed']
+        self.assertEqual(group.created, ['data', 'mask'])
+        self.assertEqual(group['data'][1]['compression'], 'lzf')
+        self.assertEqual(group['mask'][1]['compression_opts'], 9)
+        self.assertEqual(list(group['mask'][0]), [False, True, False])
+
+    def test_hdfaccess_filter(self):
+        hfile = FakeFile()
+        hs.set_param(hfile, Param('Eng (1) N1', np.ma.zeros(4)), hs.StoragePolicy(None, compact_masks=False))
+        group = hfile.hdf['series']['Eng (1) N1']
+        self.assertEqual(group['data'][1], FakeFile.DATASET_KWARGS)
+        self.assertEqual(group['mask'][1], FakeFile.DATASET_KWARGS)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
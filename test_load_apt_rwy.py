@@ -7,6 +7,9 @@ from ipython,
  cd to this directory
  run '!nosetests -v test_apt_rwy.py'
 """
+import os
+import shutil
+import tempfile
 import unittest
 import load_apt_rwy as ld
 
@@ -42,7 +45,7 @@ class TestDD(unittest.TestCase):
     def test_lat_1(self):
         mylat='N40-41-32.99'
         print ld.jeplat2dd(mylat)
-        self.assertAlmostEqual(ld.jeplat2dd(mylat), 40.6947222222)   
+        self.assertAlmostEqual(ld.jeplat2dd(mylat), 40.6924972222)   
     def test_lat_2(self):
         mylat='N40-00-00.00'
         print ld.jeplat2dd(mylat)
@@ -53,10 +56,63 @@ class TestDD(unittest.TestCase):
         self.assertAlmostEqual(ld.jeplat2dd(mylat), 0.0 )    
     def test_lon_1(self):
         mylon='W074-10-07.18'
-        self.assertAlmostEqual(ld.jeplon2dd(mylon),-73.8305555556)    
+        self.assertAlmostEqual(ld.jeplon2dd(mylon),-74.1686611111)    
     def test_lon_2(self):
         mylon='W000-00-00.00'
         self.assertAlmostEqual(ld.jeplon2dd(mylon),0.0)
+    def test_lat_south(self):
+        self.assertAlmostEqual(ld.jeplat2dd('S33-56-46.00'), -33.9461111111)
+    def test_lon_west_minutes_only(self):
+        self.assertAlmostEqual(ld.jeplon2dd('W000-30-00.00'), -0.5)
+
+
+# jeplat/lon2dd_array()
+class TestDDArray(unittest.TestCase):
+    def test_matches_scalar(self):
+        lats = ['N40-41-32.99', 'N40-00-00.00', 'N00-00-00.00', 'S33-56-46.00', 'N89-59-59.99']
+        lons = ['W074-10-07.18', 'W000-00-00.00', 'E151-10-38.00', 'E179-59-59.99']
+        dd, valid = ld.jeplat2dd_array(lats)
+        self.assertTrue(valid.all())
+        self.assertEqual(list(dd), [ld.jeplat2dd(v) for v in lats])
+        dd, valid = ld.jeplon2dd_array(lons)
+        self.assertTrue(valid.all())
+        self.assertEqual(list(dd), [ld.jeplon2dd(v) for v in lons])
+    def test_synthetic(self):
+        lats, lons = ld.synthetic_dms(1000)
+        self.assertEqual(list(ld.jeplat2dd_array(lats)[0]), [ld.jeplat2dd(v) for v in lats])
+        self.assertEqual(list(ld.jeplon2dd_array(lons)[0]), [ld.jeplon2dd(v) for v in lons])
+    def test_invalid(self):
+        dd, valid = ld.jeplat2dd_array(['N40-41-32.99', None, '', 'X40-41-32.99', 'N40-41', 'N95-00-00.00', 'N4a-41-32.99'])
+        self.assertEqual(list(valid), [True, False, False, False, False, False, False])
+        self.assertAlmostEqual(dd[0], ld.jeplat2dd('N40-41-32.99'))
+    def test_object_column(self):
+        dd, valid = ld.jeplon2dd_array([u'W074-10-07.18 ', None])
+        self.assertEqual(list(valid), [True, False])
+        self.assertEqual(dd[0], ld.jeplon2dd('W074-10-07.18'))
+
+
+# snapshot cache
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.apt = {'KEWR': {'icao': 'KEWR', 'latitude': 40.69}}
+        self.rwy = {'KEWR': {'22R': {'identifier': '22R'}}}
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+    def test_round_trip(self):
+        ld.save_snapshot(self.cache_dir, self.apt, self.rwy, 1204)
+        self.assertEqual(ld.load_snapshot(self.cache_dir, 1204), (self.apt, self.rwy))
+    def test_other_cycle_missing(self):
+        ld.save_snapshot(self.cache_dir, self.apt, self.rwy, 1204)
+        self.assertEqual(ld.load_snapshot(self.cache_dir, 1205), None)
+    def test_corrupt(self):
+        path = ld.save_snapshot(self.cache_dir, self.apt, self.rwy, 1204)
+        with open(path, 'r+b') as f:
+            f.seek(-3, os.SEEK_END)
+            f.write('xyz')
+        self.assertEqual(ld.load_snapshot(self.cache_dir, 1204), None)
+    def test_no_connection(self):
+        self.assertEqual(ld.cached_apt_rwy(None, self.cache_dir, 1204), ({}, {}))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+test_result_writer.py
+
+ run 'nosetests -v test_result_writer.py'
+"""
+import sqlite3
+import unittest
+
+import result_writer as rw
+
+DELETE = 'delete from fds_flight_record where source_file=?'
+INSERT = 'insert into fds_flight_record (source_file, value) values (?, ?)'
+KPV = 'insert /*append*/ into fds_kpv (source_file, value) values (?, ?)'
+
+
+class TestWriterOrder(unittest.TestCase):
+    def setUp(self):
+        self.cn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.cn.execute('create table fds_flight_record (source_file text, value real)')
+        self.cn.execute('create table fds_kpv (source_file text, value real)')
+        self.cn.executemany(INSERT, [['a.hdf5', 0], ['b.hdf5', 0]])
+        self.cn.commit()
+        # no timed flushes: the test drives _add/_flush itself
+        self.writer = rw.BatchedResultWriter(self.cn, flush_seconds=3600)
+
+    def rows(self, table):
+        return sorted(self.cn.execute('select source_file, value from ' + table).fetchall())
+
+    def test_delete_insert_across_flush(self):
+        self.writer._add(DELETE, [['a.hdf5']])
+        self.writer._flush()
+        self.writer._add(INSERT, [['a.hdf5', 1]])
+        self.writer._add(DELETE, [['b.hdf5']])
+        self.writer._add(INSERT, [['b.hdf5', 2]])
+        self.writer.close()
+        self.assertEqual(self.rows('fds_flight_record'), [(u'a.hdf5', 1), (u'b.hdf5', 2)])
+
+    def test_inserts_batched_across_flights(self):
+        for i, name in enumerate(['a.hdf5', 'b.hdf5', 'c.hdf5']):
+            self.writer._add(KPV, [[name, i], [name, i+0.5]])
+            self.writer._add(DELETE, [[name]])
+            self.writer._add(INSERT, [[name, i]])
+        # one run of kpv inserts; the flight record statements stay in queue order
+        self.assertEqual([run[0] for run in self.writer._pending], [KPV] + [DELETE, INSERT]*3)
+        self.writer._add('delete from fds_kpv where source_file=?', [['c.hdf5']])
+        self.writer._add(KPV, [['c.hdf5', 9]])
+        self.assertEqual(self.writer._pending[-1][0], KPV)
+        self.writer.close()
+        self.assertEqual(len(self.rows('fds_kpv')), 5)
+        self.assertEqual(self.rows('fds_kpv')[-1], (u'c.hdf5', 9))
+
+    def test_failed_batch(self):
+        self.writer._add(INSERT, [['c.hdf5', 3]])
+        self.writer._add('insert into no_such_table values (?)', [[1], [2]])
+        self.writer._flush()
+        self.assertEqual(self.writer.stats()['lost_rows'], 3)
+        self.assertRaises(RuntimeError, self.writer.queue_rows, INSERT, [['d.hdf5', 4]])
+        self.writer.close(raise_error=False)
+        self.assertEqual(self.rows('fds_flight_record'), [(u'a.hdf5', 0), (u'b.hdf5', 0)])
+
+    def test_close_raises(self):
+        self.writer._add('insert into no_such_table values (?)', [[1]])
+        self.writer._flush()
+        self.assertRaises(RuntimeError, self.writer.close)
+
+
+class TestCommute(unittest.TestCase):
+    def test_statement_table(self):
+        self.assertEqual(rw.statement_table(KPV), ('insert', 'fds_kpv'))
+        self.assertEqual(rw.statement_table(DELETE), ('change', 'fds_flight_record'))
+        self.assertEqual(rw.statement_table('delete fds_kti where x=1'), ('change', 'fds_kti'))
+        self.assertEqual(rw.statement_table('update fds_job set a=1'), ('change', 'fds_job'))
+        self.assertEqual(rw.statement_table('truncate table fds_kpv'), (None, None))
+
+    def test_commute(self):
+        self.assertTrue(rw.commute(('insert', 'fds_kpv'), ('insert', 'fds_kpv')))
+        self.assertTrue(rw.commute(('change', 'fds_kpv'), ('insert', 'fds_kti')))
+        self.assertFalse(rw.commute(('change', 'fds_kpv'), ('insert', 'fds_kpv')))
+        self.assertFalse(rw.commute((None, None), ('insert', 'fds_kpv')))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
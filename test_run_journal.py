@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+test_run_journal.py
+
+ run 'nosetests -v test_run_journal.py'
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+
+import fds_db
+import result_writer
+import run_journal as rj
+
+RUN = datetime(2013, 5, 1, 10, 30, 15, 250000)
+
+
+class TestFileJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = rj.journal_path(os.path.join(self.folder, 'journals'), 'analyze', 'base', RUN)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resume(self):
+        journal = rj.FileJournal(self.path)
+        journal.mark_done('/data/a.hdf5', 'ok')
+        journal.mark_done('/data/b.hdf5', 'fail')
+        self.assertEqual(rj.FileJournal(self.path).completed(), set(['a.hdf5']))
+
+    def test_torn_line(self):
+        rj.FileJournal(self.path).mark_done('/data/a.hdf5', 'ok')
+        with open(self.path, 'a') as f:
+            f.write('ok\tc.hd')  # crashed mid-write
+        self.assertEqual(rj.FileJournal(self.path).completed(), set(['a.hdf5']))
+
+
+class TestTableJournal(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.backend = fds_db.SQLiteBackend(os.path.join(self.folder, 'journal.sqlite'))
+        self.cn = self.backend.connect()
+
+    def tearDown(self):
+        self.cn.close()
+        shutil.rmtree(self.folder)
+
+    def test_completed(self):
+        rj.mark_done(self.cn, RUN, 'analyze', 'base', '/data/a.hdf5', 'ok', 'linux')
+        rj.mark_done(self.cn, RUN, 'analyze', 'base', '/data/b.hdf5', 'fail', 'linux')
+        rj.mark_done(self.cn, datetime(2013, 5, 2), 'analyze', 'base', '/data/c.hdf5', 'ok', 'linux')
+        self.assertEqual(rj.completed(self.cn, RUN, 'analyze', 'base'), set(['a.hdf5']))
+
+    def test_batched(self):
+        writer = result_writer.BatchedResultWriter(self.backend.connect())
+        rj.clear_unfinished(writer, RUN, 'analyze', 'base')
+        rj.mark_done(writer, RUN, 'analyze', 'base', '/data/a.hdf5', 'ok', 'linux')
+        writer.close()
+        self.assertEqual(rj.completed(self.cn, RUN, 'analyze', 'base'), set(['a.hdf5']))
+
+    def test_clear_unfinished_results(self):
+        rj.mark_done(self.cn, RUN, 'analyze', 'base', '/data/b.hdf5', 'ok', 'linux')
+        for name, profile in (('a.hdf5', 'base'), ('b.hdf5', 'base'), ('a.hdf5', 'other')):
+            self.cn.execute("insert into fds_kpv (profile, source_file, name, run_time) values (?, ?, 'x', ?)",
+                            [profile, name, RUN])
+        self.cn.commit()
+        rj.clear_unfinished(self.cn, RUN, 'analyze', 'base')
+        self.assertEqual(self.cn.execute('select source_file, profile from fds_kpv order by profile').fetchall(),
+                         [(u'b.hdf5', u'base'), (u'a.hdf5', u'other')])
+
+    def test_clear_unfinished_timing(self):
+        rj.mark_done(self.cn, RUN, 'analyze', 'base', '/data/a.hdf5', 'ok', 'linux')
+        rj.mark_done(self.cn, RUN, 'analyze', 'base', '/data/b.hdf5', 'fail', 'linux')
+        for name, run_time in (('a.hdf5', RUN), ('b.hdf5', RUN), ('c.hdf5', RUN), ('b.hdf5', datetime(2013, 5, 2))):
+            self.cn.execute("insert into fds_processing_time (run_time, source_file, stage, profile, status) "
+                            "values (?, ?, 'analyze', 'base', 'ok')", [run_time, name])
+        self.cn.commit()
+        rj.clear_unfinished(self.cn, RUN, 'analyze', 'base')
+        rows = self.cn.execute('select source_file, run_time from fds_processing_time order by source_file').fetchall()
+        self.assertEqual(rows, [(u'a.hdf5', RUN), (u'b.hdf5', datetime(2013, 5, 2))])
+
+    def test_has_table(self):
+        self.assertTrue(rj.has_table(self.cn))
+        old_schema = sqlite3.connect(os.path.join(self.folder, 'old.sqlite'))
+        self.assertFalse(rj.has_table(old_schema))
+        old_schema.close()
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+test_spatial_index.py
+
+ run 'nosetests -v test_spatial_index.py'
+"""
+import shutil
+import tempfile
+import unittest
+import load_apt_rwy
+import spatial_index as si
+
+
+def runway(identifier, start, end, heading):
+    return {'identifier': identifier, 'magnetic_heading': heading,
+            'start': {'latitude': start[0], 'longitude': start[1]},
+            'end': {'latitude': end[0], 'longitude': end[1]}}
+
+APT = {'KEWR': {'icao': 'KEWR', 'latitude': 40.6925, 'longitude': -74.1687},
+       'KJFK': {'icao': 'KJFK', 'latitude': 40.6398, 'longitude': -73.7789},
+       'EGLL': {'icao': 'EGLL', 'latitude': 51.4775, 'longitude': -0.4614},
+       'NZAA': {'icao': 'NZAA', 'latitude': -37.0081, 'longitude': 174.7917},
+       'NOPOS': {'icao': 'NOPOS', 'latitude': None, 'longitude': None}}
+# KEWR 04L/22R and 04R/22L: parallel runways about 0.01 deg apart
+RWY = {'KEWR': {'04L': runway('04L', (40.6756, -74.1793), (40.6998, -74.1636), '038.7'),
+                '22R': runway('22R', (40.6998, -74.1636), (40.6756, -74.1793), '218.7'),
+                '04R': runway('04R', (40.6776, -74.1697), (40.7023, -74.1537), '038.7'),
+                '22L': runway('22L', (40.7023, -74.1537), (40.6776, -74.1697), '218.7')}}
+
+
+class TestNearestAirport(unittest.TestCase):
+    def setUp(self):
+        self.index = si.AirportIndex(APT, RWY)
+    def test_newark(self):
+        self.assertEqual(self.index.nearest_airport(40.69, -74.17)[0], 'KEWR')
+    def test_kennedy(self):
+        self.assertEqual(self.index.nearest_airport(40.65, -73.80)[0], 'KJFK')
+    def test_far_away(self):
+        # nothing within the first band: search widens
+        self.assertEqual(self.index.nearest_airport(-20.0, 170.0)[0], 'NZAA')
+    def test_across_dateline(self):
+        self.assertEqual(self.index.nearest_airport(-37.0, -179.9)[0], 'NZAA')
+    def test_distance(self):
+        icao, distance = self.index.nearest_airport(51.4775, -0.4614)
+        self.assertEqual(icao, 'EGLL')
+        self.assertAlmostEqual(distance, 0.0, places=3)
+    def test_batch(self):
+        icaos, distances = self.index.nearest_airports([40.69, 51.0], [-74.17, 0.0])
+        self.assertEqual(icaos, ['KEWR', 'EGLL'])
+
+
+class TestBestRunway(unittest.TestCase):
+    def setUp(self):
+        self.index = si.AirportIndex(APT, RWY)
+    def test_heading_only(self):
+        self.assertTrue(self.index.best_runway('KEWR', 215.0)['identifier'] in ('22R', '22L'))
+    def test_heading_and_position(self):
+        self.assertEqual(self.index.best_runway('KEWR', 40.0, 40.6877, -74.1715)['identifier'], '04L')
+        self.assertEqual(self.index.best_runway('KEWR', 40.0, 40.6899, -74.1617)['identifier'], '04R')
+        self.assertEqual(self.index.best_runway('KEWR', 220.0, 40.6899, -74.1617)['identifier'], '22L')
+    def test_unknown_airport(self):
+        self.assertEqual(self.index.best_runway('XXXX', 40.0), None)
+
+
+class FakeCursor(object):
+    '''answers load_apt_rwy's airport, runway and ILS queries from Jeppesen-style rows'''
+    TABLES = {
+        'jep_ge_apt': (['icao', 'name', 'region', 'APT_LATITUDE', 'APT_LONGITUDE', 'elevation',
+                        'magnetic_variation', 'update_month'],
+                       [('KEWR', 'NEWARK LIBERTY INTL', 'USA', 'N40-41-32.99', 'W074-10-07.18', '18', 'W013.0', 1204),
+                        ('KJFK', 'JOHN F KENNEDY INTL', 'USA', 'N40-38-23.28', 'W073-46-44.04', '13', 'W013.0', 1204),
+                        ('SBGR', 'GUARULHOS INTL', 'SAM', 'S23-26-08.00', 'W046-28-23.00', '2459', 'W021.0', 1204)]),
+        'jep_ge_rwy': (['RWY_APT_ID', 'RWY_ID', 'CYCLE_NUM', 'RWY_LATITUDE', 'RWY_LONGITUDE',
+                        'RWY_LANDING_THRESHOLD_ELEV', 'RWY_THRESHOLD_DISTANCE', 'RWY_MAG_BEARING', 'RWY_LENGTH',
+                        'SURFACE', 'WIDTH'],
+                       [('KEWR', 'RW04L', 1204, 'N40-40-32.16', 'W074-10-45.48', '10', '0', '038.7', '11000', None, 150),
+                        ('KEWR', 'RW22R', 1204, 'N40-41-59.28', 'W074-09-48.96', '18', '0', '218.7', '11000', None, 150),
+                        ('KEWR', 'RW04R', 1204, 'N40-40-39.36', 'W074-10-10.92', '11', '0', '038.7', '10000', None, 150),
+                        ('KEWR', 'RW22L', 1204, 'N40-42-08.28', 'W074-09-13.32', '12', '0', '218.7', '10000', None, 150)]),
+        'jep_ge_ils': (['ILS_APT_ID', 'ILS_RUNWAY_ID', 'CYCLE_NUM', 'ILS_GLIDE_SLOPE_ANGLE', 'ILS_GLIDE_SLOPE_ELEV',
+                        'ILS_LOC_FREQ', 'ILS_BEARING', 'ILS_LOC_LATITUDE', 'ILS_LOC_LONGITUDE',
+                        'GLIDESLOPELATITUDE', 'GLIDESLOPELONGITUDE', 'GS_THRESHOLD_DISTANCE', 'LOCALIZERWIDTH'], []),
+        }
+
+    def execute(self, sql, binds=None):
+        table = [t for t in self.TABLES if t in sql][0]
+        columns, self.rows = self.TABLES[table]
+        self.description = [(c,) for c in columns]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class TestFromJeppesen(unittest.TestCase):
+    '''the index built from DMS strings through load_apt_rwy, as SpatialAPIHandler gets it'''
+    def setUp(self):
+        apt_dict = load_apt_rwy.get_apt_dict(FakeCursor())
+        apt_rwy_dict = load_apt_rwy.get_apt_rwy_dict(FakeCursor())
+        self.index = si.AirportIndex(apt_dict, apt_rwy_dict)
+    def test_coordinates(self):
+        self.assertAlmostEqual(self.index.apt_dict['KEWR']['longitude'], -74.1687, places=4)
+        self.assertAlmostEqual(self.index.apt_dict['SBGR']['latitude'], -23.4356, places=4)
+    def test_nearest(self):
+        self.assertEqual(self.index.nearest_airport(40.69, -74.17)[0], 'KEWR')
+        self.assertEqual(self.index.nearest_airport(-23.43, -46.47)[0], 'SBGR')
+    def test_runway_bearing(self):
+        runways, headings = self.index._airport_runways('KEWR')[:2]
+        bearings = dict((rw['identifier'], h) for rw, h in zip(runways, headings))
+        self.assertAlmostEqual(bearings['04L'], 26.0, delta=1.0)
+        self.assertAlmostEqual(bearings['22R'], 206.0, delta=1.0)
+        runway = self.index.apt_rwy_dict['KEWR']
+        self.assertEqual(runway['04L']['end'], runway['22R']['start'])
+    def test_best_runway(self):
+        self.assertEqual(self.index.best_runway('KEWR', 26.0, 40.6877, -74.1715)['identifier'], '04L')
+        self.assertEqual(self.index.best_runway('KEWR', 206.0, 40.6899, -74.1617)['identifier'], '22L')
+
+
+class TestGetIndex(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        load_apt_rwy.save_snapshot(self.cache_dir, APT, RWY, 1204)
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        si._indexes.clear()
+    def test_once_per_process(self):
+        index = si.get_index(self.cache_dir, 1204)
+        self.assertTrue(si.get_index(self.cache_dir, 1204) is index)
+        self.assertEqual(len(si._indexes), 1)
+        self.assertEqual(index.nearest_airport(40.69, -74.17)[0], 'KEWR')
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+test_work_scheduler.py
+
+ run 'nosetests -v test_work_scheduler.py'
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import work_scheduler as ws
+
+
+class TestLPT(unittest.TestCase):
+    def test_largest_first(self):
+        costs = {'a': 1.0, 'b': 5.0, 'c': 3.0, 'd': 3.0}
+        self.assertEqual(ws.largest_first(['a', 'b', 'c', 'd'], costs), ['b', 'c', 'd', 'a'])
+
+    def test_straggler(self):
+        # in file order a static split would put both long flights on one worker
+        costs = dict(('short%d' % i, 1.0) for i in range(8))
+        costs.update({'long1': 8.0, 'long2': 8.0})
+        files = ['long1', 'long2'] + ['short%d' % i for i in range(8)]
+        assigned, loads = ws.lpt_assign(files, costs, 2)
+        self.assertEqual(sorted(loads), [12.0, 12.0])
+        self.assertEqual(sorted(f for a in assigned for f in a), sorted(files))
+        self.assertTrue('long1' in assigned[0] and 'long2' in assigned[1])
+
+    def test_more_workers_than_files(self):
+        assigned, loads = ws.lpt_assign(['a'], {'a': 2.0}, 3)
+        self.assertEqual(assigned, [['a'], [], []])
+
+
+class TestEstimate(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.files = []
+        for name, mb in (('f1.hdf5', 2), ('f2.hdf5', 1), ('f3.hdf5', 4)):
+            path = os.path.join(self.folder, name)
+            with open(path, 'wb') as f:
+                f.write('\0' * (mb*1024*1024))
+            self.files.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_size_only(self):
+        costs = ws.estimate_costs(self.files)
+        self.assertAlmostEqual(costs[self.files[2]], 4*ws.DEFAULT_SECONDS_PER_MB)
+
+    def test_history(self):
+        # f1 took 20 s for 2 MB: 10 s/MB for the others
+        costs = ws.estimate_costs(self.files, {'f1.hdf5': (20.0, 2.0)})
+        self.assertAlmostEqual(costs[self.files[0]], 20.0)
+        self.assertAlmostEqual(costs[self.files[2]], 40.0)
+
+    def test_durations(self):
+        # f1 took 20 s for a 1000 s flight: f2, a 4000 s flight, should take 80 s whatever its size
+        durations = {self.files[0]: 1000.0, self.files[1]: 4000.0}
+        costs = ws.estimate_costs(self.files, {'f1.hdf5': (20.0, 2.0)}, durations)
+        self.assertAlmostEqual(costs[self.files[1]], 80.0)
+        self.assertAlmostEqual(costs[self.files[2]], 40.0)
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.cn = sqlite3.connect(':memory:')
+        self.cn.execute('create table fds_processing_time (run_time timestamp, source_file text, stage text, '
+                        'profile text, file_size_meg real, processing_seconds real, status text)')
+        rows = [(1, 'f1.hdf5', 30.0, 2.0), (2, 'f1.hdf5', 20.0, 2.0), (1, 'f2.hdf5', 5.0, 1.0),
+                (1, 'old.hdf5', 90.0, 3.0)]
+        self.cn.executemany("insert into fds_processing_time values (?, ?, 'analyze', 'base', ?, ?, 'ok')",
+                            [(t, f, mb, s) for t, f, s, mb in rows])
+
+    def test_only_given_files(self):
+        history = ws.processing_history(self.cn, 'analyze', 'base', ['/data/f1.hdf5', '/data/f3.hdf5'])
+        self.assertEqual(history, {'f1.hdf5': (20.0, 2.0)})
+
+    def test_chunks(self):
+        files = ['x%04d.hdf5' % i for i in range(2500)] + ['f2.hdf5']
+        self.assertEqual(ws.processing_history(self.cn, 'analyze', 'base', files), {'f2.hdf5': (5.0, 1.0)})
+
+    def test_rate(self):
+        self.assertAlmostEqual(ws.processing_rate(self.cn, 'analyze', 'base'), 145.0/8.0)
+        self.assertEqual(ws.processing_rate(self.cn, 'analyze', 'other'), None)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Cost-aware ordering and assignment of flight files to workers
+
+Flights differ a lot in processing time (a 15 hour flight against a short hop),
+so handing files out in query or glob order can leave one worker with most of
+the long ones.  estimate_costs() gives each file an expected processing time:
+
+    1. its own processing_seconds in fds_processing_time for this stage and
+       profile, if it was processed before (only the rows of the files at hand
+       are fetched)
+    2. else its flight duration (hdf5 attribute, only if durations are read)
+       times the seconds per flight second seen for files with a history
+    3. else its size in MB times the seconds per MB over all of
+       fds_processing_time for the stage and profile, summed in the database
+       (DEFAULT_SECONDS_PER_MB without any history)
+
+Longest processing time first: largest_first() orders files by estimate for a
+pool that hands out one file at a time (run_analyzer), lpt_assign() splits
+them into per-worker lists up front (ipython DirectView engines).  Either way
+the batch ends close to total work / workers instead of with one straggler.
+"""
+import os
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SECONDS_PER_MB = 1.0
+IN_LIST_SIZE = 500  # names per query: within Oracle's 1000-item in lists and older sqlite's 999 binds
+
+HISTORY_SQL = '''select source_file, processing_seconds, file_size_meg from fds_processing_time
+                 where stage=:stage and profile=:profile and status='ok' and processing_seconds > 0
+                 and source_file in (%s)
+                 order by run_time'''
+RATE_SQL = '''select sum(processing_seconds), sum(file_size_meg) from fds_processing_time
+              where stage=:stage and profile=:profile and status='ok' and processing_seconds > 0
+              and file_size_meg > 0'''
+
+
+def processing_history(cn, stage, profile, files):
+    '''{source file name: (processing_seconds, file_size_meg)} from fds_processing_time for files
+       (paths or names), latest run wins'''
+    names = sorted(set(os.path.basename(f) for f in files))
+    history = {}
+    cur = cn.cursor()
+    for i in range(0, len(names), IN_LIST_SIZE):
+        chunk = names[i:i+IN_LIST_SIZE]
+        binds = {'stage': stage, 'profile': profile}
+        binds.update(('f%d' % k, name) for k, name in enumerate(chunk))
+        cur.execute(HISTORY_SQL % ', '.join(':f%d' % k for k in range(len(chunk))), binds)
+        for source_file, seconds, size_mb in cur.fetchall():
+            history[source_file] = (float(seconds), float(size_mb or 0))
+    cur.close()
+    return history
+
+
+def processing_rate(cn, stage, profile):
+    '''seconds per MB over all of fds_processing_time for stage and profile, or None'''
+    cur = cn.cursor()
+    cur.execute(RATE_SQL, {'stage': stage, 'profile': profile})
+    seconds, size_mb = cur.fetchone()
+    cur.close()
+    if not seconds or not size_mb:
+        return None
+    return float(seconds) / float(size_mb)
+
+
+def flight_durations(files):
+    '''{file: duration in seconds} from the hdf5 attributes; opens every file'''
+    from hdfaccess.file import hdf_file
+    durations = {}
+    for f in files:
+        try:
+            with hdf_file(f) as ff:
+                durations[f] = float(ff.duration)
+        except Exception:
+            logger.warning('work_scheduler: no duration for %s', f)
+    return durations
+
+
+def _rate(pairs):
+    '''total seconds / total units for (seconds, units) pairs, or None'''
+    units = sum(u for s, u in pairs if u)
+    if not units:
+        return None
+    return sum(s for s, u in pairs if u) / units
+
+
+def estimate_costs(files, history=None, durations=None, per_mb=None):
+    '''{file: estimated processing seconds}; see module docstring.
+       history: from processing_history(); durations: from flight_durations();
+       per_mb: from processing_rate(), else taken from history'''
+    history = history or {}
+    durations = durations or {}
+    sizes = {}
+    for f in files:
+        try:
+            sizes[f] = os.path.getsize(f)/(1024.*1024.)
+        except OSError:
+            sizes[f] = 0.0
+    past = dict((f, history[os.path.basename(f)][0]) for f in files if os.path.basename(f) in history)
+    per_mb = per_mb or _rate(history.values()) or DEFAULT_SECONDS_PER_MB
+    per_flight_second = _rate([(past[f], durations[f]) for f in past if f in durations])
+    costs = {}
+    for f in files:
+        if f in past:
+            costs[f] = past[f]
+        elif f in durations and per_flight_second:
+            costs[f] = durations[f] * per_flight_second
+        else:
+            costs[f] = sizes[f] * per_mb
+    return costs
+
+
+def largest_first(files, costs):
+    '''files, most expensive first (ties keep their order)'''
+    return sorted(files, key=lambda f: -costs.get(f, 0.0))
+
+
+def lpt_assign(files, costs, workers):
+    '''split files into workers lists, each file to the least loaded worker, largest first.
+       returns (lists, estimated seconds per worker)'''
+    heap = [(0.0, i) for i in range(workers)]
+    assigned = [[] for i in range(workers)]
+    loads = [0.0] * workers
+    for f in largest_first(files, costs):
+        load, i = heapq.heappop(heap)
+        assigned[i].append(f)
+        loads[i] = load + costs.get(f, 0.0)
+        heapq.heappush(heap, (loads[i], i))
+    return assigned, loads
+
+
+def schedule_report(costs, loads):
+    total = sum(costs.values())
+    workers = len(loads) or 1
+    return 'estimated %.0f s of work on %d workers: makespan %.0f s (ideal %.0f s, longest file %.0f s)' % (
+        total, workers, max(loads) if loads else 0.0, total/workers, max(costs.values()) if costs else 0.0)